@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the native parallel tree copier against cp and rsync on a
+synthetic chroot. Run it from the git repo root, on the filesystem to
+benchmark:
+
+    python scripts/bench-tree-copy.py --workdir /var/tmp/bench
+
+Page cache is dropped before every run when executed as root.
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath("."))
+
+from src import tree_copy
+
+
+def make_chroot(path, files, seed=0):
+    """
+    Create a chroot-like tree: many small files, a few big ones,
+    symlinks and hardlinks, spread over a deep directory hierarchy.
+    """
+    rnd = random.Random(seed)
+    dirs = [path]
+    os.makedirs(path)
+    for index in range(files):
+        if index % 25 == 0:
+            parent = rnd.choice(dirs)
+            new_dir = os.path.join(parent, "d%d" % (index,))
+            os.mkdir(new_dir)
+            dirs.append(new_dir)
+        directory = rnd.choice(dirs)
+        name = os.path.join(directory, "f%d" % (index,))
+        kind = rnd.random()
+        if kind < 0.05:
+            os.symlink("../f%d" % (index - 1,), name)
+            continue
+        if kind < 0.07 and index > 0:
+            target = os.path.join(path, "hl_target")
+            if not os.path.exists(target):
+                with open(target, "wb") as f:
+                    f.write(b"x" * 4096)
+            os.link(target, name)
+            continue
+        if kind > 0.999:
+            size = rnd.randint(16, 64) * 1024 * 1024
+        else:
+            # mostly small files, like a real chroot
+            size = int(rnd.expovariate(1.0 / 8192))
+        with open(name, "wb") as f:
+            f.write(os.urandom(min(size, 65536)) * (size // 65536 + 1))
+            f.truncate(size)
+
+
+def drop_caches():
+    if os.geteuid() != 0:
+        return
+    subprocess.call(["sync"])
+    try:
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+    except (IOError, OSError):
+        pass
+
+
+def timed(func, dest):
+    if os.path.lexists(dest):
+        shutil.rmtree(dest)
+    drop_caches()
+    start = time.time()
+    rc = func()
+    elapsed = time.time() - start
+    shutil.rmtree(dest, True)
+    return rc, elapsed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="tree copy benchmark")
+    parser.add_argument("--workdir", default=None,
+                        help="directory to create the trees into")
+    parser.add_argument("--files", type=int, default=100000,
+                        help="number of files of the synthetic chroot")
+    parser.add_argument("--workers", default="1,4,8,16,32",
+                        help="comma separated native copier thread counts")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="runs per tool, the best one is reported")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench-tree-copy.", dir=args.workdir)
+    source = os.path.join(workdir, "source")
+    dest = os.path.join(workdir, "dest")
+    try:
+        sys.stdout.write("creating %d files in %s\n" % (args.files, source))
+        make_chroot(source, args.files)
+
+        def native(workers):
+            tree_copy.copy_tree(source, dest, workers=workers)
+            return 0
+
+        tools = []
+        for workers in args.workers.split(","):
+            workers = int(workers)
+            tools.append(("native (%d threads)" % (workers,),
+                          lambda w=workers: native(w)))
+        if os.path.exists("/bin/cp"):
+            tools.append(("cp -a", lambda: subprocess.call(
+                ["/bin/cp", "-a", source, dest])))
+        if os.path.exists("/usr/bin/rsync"):
+            tools.append(("rsync -aHAX", lambda: subprocess.call(
+                ["/usr/bin/rsync", "-aHAX", "--numeric-ids",
+                 source + "/", dest + "/"])))
+
+        for name, func in tools:
+            best = None
+            for run in range(args.runs):
+                rc, elapsed = timed(func, dest)
+                if rc:
+                    sys.stdout.write("%s failed: %s\n" % (name, rc))
+                    break
+                if best is None or elapsed < best:
+                    best = elapsed
+            if best is not None:
+                sys.stdout.write("%-24s %8.2fs %10.0f files/s\n" % (
+                    name, best, args.files / best))
+    finally:
+        shutil.rmtree(workdir, True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
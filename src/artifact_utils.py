@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# linux/fs.h
+FICLONE = 0x40049409
+_ZERO_CHUNK = b"\0" * COPY_CHUNK_SIZE
+
+SUPPORTED_CHECKSUM_ALGORITHMS = ["md5", "sha1", "sha256", "sha512",
+                                 "blake2b", "blake2s"]
+DEFAULT_CHECKSUM_ALGORITHMS = ["md5"]
+CHECKSUM_EXTS = {
+    "md5": ".md5",
+    "sha1": ".sha1",
+    "sha256": ".sha256",
+    "sha512": ".sha512",
+    "blake2b": ".blake2b",
+    "blake2s": ".blake2s",
+}
+
+
+def checksum_algorithms_supported(algorithms):
+    """
+    Return whether all the given checksum algorithms are supported by
+    molecule and available in hashlib.
+
+    @param algorithms: list of algorithm names
+    @type algorithms: list
+    @rtype: bool
+    """
+    available = getattr(hashlib, "algorithms_available",
+                        SUPPORTED_CHECKSUM_ALGORITHMS)
+    if not algorithms:
+        return False
+    for algorithm in algorithms:
+        if algorithm not in SUPPORTED_CHECKSUM_ALGORITHMS:
+            return False
+        if algorithm not in available:
+            return False
+    return True
+
+
+class MultiHasher(object):
+    """
+    Feed the same data to several hashlib objects at once. It can be used
+    wherever a hashlib object is accepted as hasher. With more than one
+    algorithm, every hash is computed by its own thread: hashlib releases
+    the GIL on large buffers, so a single read of the data is hashed in
+    parallel. Other consumers of the data, objects implementing update()
+    like the zsync control file generator, can be fed in the same pass.
+    Data passed to update() must not be modified afterwards. If a hasher
+    or consumer raises, the rest of the data is discarded and the error is
+    raised again by the next update(), close() or hexdigests() call.
+    """
+
+    # chunks queued per hashing thread, bounds the memory used
+    QUEUE_SIZE = 4
+
+    def __init__(self, algorithms, consumers=None):
+        self.algorithms = list(algorithms)
+        self._hashers = [hashlib.new(x) for x in self.algorithms]
+        self._feeders = self._hashers + list(consumers or [])
+        self._queues = []
+        self._threads = []
+        self._errors = []
+
+    def _start(self):
+        for hasher in self._feeders:
+            hash_queue = queue.Queue(MultiHasher.QUEUE_SIZE)
+            thread = threading.Thread(target=self._worker,
+                                      args=(hasher, hash_queue))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(hash_queue)
+            self._threads.append(thread)
+
+    def _worker(self, hasher, hash_queue):
+        failed = False
+        while True:
+            data = hash_queue.get()
+            if data is None:
+                return
+            if failed:
+                # keep draining the queue, update() must not block
+                continue
+            try:
+                hasher.update(data)
+            except Exception as err:
+                failed = True
+                self._errors.append(err)
+
+    def _raise_error(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def update(self, data):
+        if len(self._feeders) == 1:
+            self._feeders[0].update(data)
+            return
+        self._raise_error()
+        if not self._threads:
+            self._start()
+        for hash_queue in self._queues:
+            hash_queue.put(data)
+
+    def close(self):
+        """
+        Wait for all the queued data to be consumed and stop the threads.
+
+        @raises Exception: the first error raised by a hasher or consumer
+        """
+        for hash_queue in self._queues:
+            hash_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._threads = []
+        self._raise_error()
+
+    def hexdigests(self):
+        """
+        Return the list of (algorithm, hex digest) tuples, in the order
+        algorithms were given. No more data can be fed afterwards.
+        """
+        self.close()
+        return [(algorithm, hasher.hexdigest()) for algorithm, hasher in
+                zip(self.algorithms, self._hashers)]
+
+
+def checksum_path(path, algorithm):
+    """
+    Return the path of the checksum file of path for the given algorithm.
+    """
+    return path + CHECKSUM_EXTS[algorithm]
+
+
+def write_checksum_files(path, digests):
+    """
+    Write one checksum file per digest next to the file at path, in the
+    format expected by md5sum -c, sha256sum -c and friends.
+
+    @param path: file path
+    @type path: string
+    @param digests: list of (algorithm, hex digest) tuples
+    @type digests: list
+    @return: list of checksum file paths
+    @rtype: list
+    """
+    paths = []
+    for algorithm, digest in digests:
+        checksum_file = checksum_path(path, algorithm)
+        with open(checksum_file, "w") as f:
+            f.write("%s  %s\n" % (digest, os.path.basename(path),))
+            f.flush()
+        paths.append(checksum_file)
+    return paths
+
+
+def _data_extents(fd, size):
+    """
+    Yield the (start, end) offsets of the data extents of the file
+    referenced by fd, using SEEK_DATA and SEEK_HOLE. If the system or the
+    filesystem doesn't support them, the whole file is a data extent.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # only a hole is left
+                return
+            if err.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def iter_file_chunks(path):
+    """
+    Yield the content of the file at path in chunks, without reading its
+    holes from disk: they are yielded as in-memory zeroes.
+
+    @param path: file path
+    @type path: string
+    """
+    zeroes = memoryview(_ZERO_CHUNK)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        for start, end in _data_extents(fd, size):
+            while offset < start:
+                chunk = min(start - offset, COPY_CHUNK_SIZE)
+                yield zeroes[:chunk]
+                offset += chunk
+            os.lseek(fd, start, os.SEEK_SET)
+            while offset < end:
+                data = os.read(fd, min(end - offset, COPY_CHUNK_SIZE))
+                if not data:
+                    raise IOError(errno.EIO, "unexpected end of file")
+                yield data
+                offset += len(data)
+        while offset < size:
+            chunk = min(size - offset, COPY_CHUNK_SIZE)
+            yield zeroes[:chunk]
+            offset += chunk
+    finally:
+        os.close(fd)
+
+
+def _feed_zeroes(hashers, length):
+    while length > 0:
+        chunk = min(length, COPY_CHUNK_SIZE)
+        for hasher in hashers:
+            hasher.update(_ZERO_CHUNK[:chunk])
+        length -= chunk
+
+
+def _copy_extent_read(src_fd, dst_fd, start, end, hashers):
+    os.lseek(src_fd, start, os.SEEK_SET)
+    os.lseek(dst_fd, start, os.SEEK_SET)
+    remaining = end - start
+    while remaining > 0:
+        data = os.read(src_fd, min(remaining, COPY_CHUNK_SIZE))
+        if not data:
+            raise IOError(errno.EIO, "unexpected end of file")
+        for hasher in hashers:
+            hasher.update(data)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        remaining -= len(data)
+
+
+def _copy_extent_kernel(src_fd, dst_fd, start, end):
+    """
+    Copy a data extent without going through userspace, return False if
+    the kernel doesn't support it for these files.
+    """
+    offset = start
+    while offset < end:
+        count = min(end - offset, COPY_CHUNK_SIZE)
+        try:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dst_fd, count,
+                                            offset, offset)
+            elif hasattr(os, "sendfile"):
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            else:
+                return False
+        except OSError as err:
+            if offset == start and err.errno in (
+                    errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                    errno.EOPNOTSUPP):
+                return False
+            raise
+        if copied == 0:
+            raise IOError(errno.EIO, "unexpected end of file")
+        offset += copied
+    return True
+
+
+def copy_data(src_fd, dst_fd, size, hashers=None, sparse=True):
+    """
+    Copy size bytes of data between two file descriptors, preserving
+    holes. Data extents are copied by the kernel when possible
+    (copy_file_range() or sendfile()). If hashers are given, data is
+    copied through userspace instead and every hasher is fed with the
+    whole content, holes included.
+
+    @param src_fd: source file descriptor
+    @type src_fd: int
+    @param dst_fd: destination file descriptor
+    @type dst_fd: int
+    @param size: source file size
+    @type size: int
+    @keyword hashers: list of hashlib objects
+    @type hashers: list
+    @keyword sparse: look for holes, to be disabled when the file is
+        known to have none, to save some syscalls
+    @type sparse: bool
+    """
+    kernel_copy = not hashers
+    offset = 0
+    if sparse:
+        extents = _data_extents(src_fd, size)
+    else:
+        extents = [(0, size)]
+    for start, end in extents:
+        if hashers:
+            _feed_zeroes(hashers, start - offset)
+        if kernel_copy:
+            kernel_copy = _copy_extent_kernel(src_fd, dst_fd, start, end)
+        if not kernel_copy:
+            _copy_extent_read(src_fd, dst_fd, start, end, hashers or [])
+        offset = end
+    if hashers:
+        _feed_zeroes(hashers, size - offset)
+    if offset < size:
+        # trailing holes
+        os.ftruncate(dst_fd, size)
+
+
+def sparse_copy(source, dest, hashers=None):
+    """
+    Copy the file at source to dest, preserving holes. Data extents are
+    copied by the kernel when possible (copy_file_range() or sendfile()).
+    If hashers are given, data is copied through userspace instead and
+    every hasher is fed with the whole file content, holes included.
+
+    @param source: source file path
+    @type source: string
+    @param dest: destination file path
+    @type dest: string
+    @keyword hashers: list of hashlib objects
+    @type hashers: list
+    @raises IOError: if space is not enough
+    @raises OSError: well, sorry
+    """
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = os.fstat(src_fd).st_size
+            copy_data(src_fd, dst_fd, size, hashers=hashers)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    shutil.copystat(source, dest)
+
+
+def move_file(source, dest, hashers=None):
+    """
+    Move the file at source to dest. If they are on different filesystems,
+    the file is copied with sparse_copy() and source removed.
+
+    @param source: source file path
+    @type source: string
+    @param dest: destination file path
+    @type dest: string
+    @keyword hashers: list of hashlib objects, fed by sparse_copy()
+    @type hashers: list
+    @return: True if hashers have been fed with the file content
+    @rtype: bool
+    """
+    try:
+        os.rename(source, dest)
+        return False
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    try:
+        sparse_copy(source, dest, hashers=hashers)
+    except (IOError, OSError):
+        try:
+            os.remove(dest)
+        except OSError:
+            pass
+        raise
+    os.remove(source)
+    return bool(hashers)
+
+
+def _reflink(source, dest):
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except (IOError, OSError):
+            os.close(dst_fd)
+            os.remove(dest)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(source, dest)
+
+
+def clone_file(source, dest):
+    """
+    Make dest an independent copy of the file at source, as cheaply as
+    possible: a reflink (copy-on-write clone) if the filesystem supports
+    it, a sparse copy otherwise. Hardlinks are never used, artifacts are
+    rewritten in place by the next builds. dest must not exist.
+
+    @param source: source file path
+    @type source: string
+    @param dest: destination file path
+    @type dest: string
+    @return: the method used, one of "reflink", "copy"
+    @rtype: string
+    """
+    try:
+        _reflink(source, dest)
+        return "reflink"
+    except (IOError, OSError) as err:
+        if err.errno == errno.EEXIST:
+            raise
+    sparse_copy(source, dest)
+    return "copy"
+
+
+def hash_file(path, hashers):
+    """
+    Feed every hasher with the content of the file at path. Holes are not
+    read from disk, which makes hashing sparse images cheap.
+
+    @param path: file path
+    @type path: string
+    @param hashers: list of hashlib objects
+    @type hashers: list
+    """
+    for chunk in iter_file_chunks(path):
+        for hasher in hashers:
+            hasher.update(chunk)
+
+
+def _drain(source_f, dest_f, hashers):
+    """
+    Copy source_f to dest_f until EOF, feeding hashers along the way.
+    """
+    while True:
+        data = source_f.read(COPY_CHUNK_SIZE)
+        if not data:
+            break
+        for hasher in hashers:
+            hasher.update(data)
+        dest_f.write(data)
+
+
+def command_to_file(args, dest, hashers=None, cwd=None):
+    """
+    Execute a command writing its artifact to stdout, and store it into
+    dest. Hashers are fed while the artifact is written, so it doesn't
+    need to be read back.
+
+    @param args: command arguments
+    @type args: list
+    @param dest: destination file path
+    @type dest: string
+    @keyword hashers: list of hashlib objects fed with dest content
+    @type hashers: list
+    @keyword cwd: working directory of the command
+    @type cwd: string
+    @return: command exit status
+    @rtype: int
+    @raises IOError: if space is not enough
+    @raises OSError: well, sorry
+    """
+    with open(dest, "wb") as dest_f:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=cwd)
+        try:
+            _drain(proc.stdout, dest_f, hashers or [])
+        except (IOError, OSError):
+            proc.stdout.close()
+            proc.wait()
+            raise
+        return proc.wait()
+
+
+def compress_file(source, dest, compressor, raw_hashers=None,
+                  hashers=None):
+    """
+    Compress the file at source into dest, streaming it through an
+    external compressor command reading from stdin and writing to stdout.
+    Holes in source are not read from disk. Both the raw and the
+    compressed streams can be hashed in the same pass.
+
+    @param source: source file path
+    @type source: string
+    @param dest: destination file path
+    @type dest: string
+    @param compressor: compressor command arguments
+    @type compressor: list
+    @keyword raw_hashers: list of hashlib objects fed with source content
+    @type raw_hashers: list
+    @keyword hashers: list of hashlib objects fed with dest content
+    @type hashers: list
+    @return: compressor exit status
+    @rtype: int
+    @raises IOError: if space is not enough
+    @raises OSError: well, sorry
+    """
+    raw_hashers = raw_hashers or []
+    hashers = hashers or []
+    errors = []
+
+    with open(dest, "wb") as dest_f:
+        proc = subprocess.Popen(compressor, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+        def _writer():
+            try:
+                _drain(proc.stdout, dest_f, hashers)
+            except (IOError, OSError) as err:
+                errors.append(err)
+                # unblock the compressor
+                proc.stdout.close()
+
+        writer = threading.Thread(target=_writer)
+        writer.start()
+        try:
+            for chunk in iter_file_chunks(source):
+                for hasher in raw_hashers:
+                    hasher.update(chunk)
+                proc.stdin.write(chunk)
+        except (IOError, OSError) as err:
+            # EPIPE means that the compressor died, its exit status says why
+            if err.errno != errno.EPIPE:
+                errors.append(err)
+        finally:
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            writer.join()
+            rc = proc.wait()
+
+    if errors:
+        raise errors[0]
+    return rc
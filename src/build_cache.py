@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from . import artifact_utils
+
+# bump this to invalidate all the cache entries
+CACHE_KEY_VERSION = 2
+
+# metadata parameters pointing to directory trees used as build input
+INPUT_TREES = ("source_chroot", "merge_livecd_root", "source_boot_directory")
+# metadata parameters pointing to files used as build input
+INPUT_FILES = ("source_iso",)
+# environment variables affecting the build output
+INPUT_ENV_PREFIX = "MOLECULE_"
+
+# tools whose version affects the build output, only the existing ones
+# are taken into account
+TOOLS = [
+    "/usr/bin/mkisofs", "/usr/bin/genisoimage", "/usr/bin/xorriso",
+    "/usr/bin/mksquashfs", "/usr/bin/unsquashfs", "/usr/bin/rsync",
+    "/bin/tar", "/sbin/mkfs.ext2", "/sbin/mkfs.ext3", "/sbin/mkfs.ext4",
+    "/sbin/mke2fs", "/usr/bin/zstd", "/usr/bin/xz", "/usr/bin/pigz",
+    "/bin/gzip",
+]
+
+# directory, inside the cache, where source file digests are memoized
+_SOURCES_DIR = ".sources"
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    value = "%s" % (value,)
+    try:
+        return value.encode("utf-8")
+    except UnicodeEncodeError:
+        return value.encode("utf-8", "surrogateescape")
+
+
+def _update(hasher, *fields):
+    for field in fields:
+        hasher.update(_encode(field))
+        hasher.update(b"\0")
+
+
+def _mtime(st):
+    return getattr(st, "st_mtime_ns", repr(st.st_mtime))
+
+
+def _hash_metadata(hasher, metadata):
+    # keys starting with __ are molecule internals (the plugin object)
+    data = dict((k, v) for k, v in metadata.items()
+                if not k.startswith("__"))
+    _update(hasher, "metadata",
+            json.dumps(data, sort_keys=True, default=repr))
+
+
+def hash_scripts(hasher, metadata):
+    """
+    Hash the content of every file passed to the hook scripts, the
+    scripts themselves included.
+    """
+    for key in sorted(metadata):
+        if not key.endswith("_script"):
+            continue
+        args = metadata[key]
+        if not isinstance(args, list):
+            continue
+        for arg in args:
+            if os.path.isfile(arg):
+                _update(hasher, "script", key, arg)
+                artifact_utils.hash_file(arg, [hasher])
+
+
+def _hash_tree(hasher, path):
+    """
+    Hash the manifest of the directory tree at path: names, types,
+    permissions, ownership, sizes, modification times and symlink
+    targets. File contents are not read.
+    """
+    _update(hasher, "tree", path)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            entry = os.path.join(root, name)
+            try:
+                st = os.lstat(entry)
+            except OSError:
+                continue
+            _update(hasher, os.path.relpath(entry, path), st.st_mode,
+                    st.st_uid, st.st_gid, st.st_size, _mtime(st))
+            if stat.S_ISLNK(st.st_mode):
+                _update(hasher, os.readlink(entry))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                _update(hasher, st.st_rdev)
+
+
+def _source_digest(cache_dir, path):
+    """
+    Return the sha256 of the file at path. Digests are memoized inside
+    cache_dir and reused as long as the file is not modified.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    signature = "%s %s %s %s" % (st.st_dev, st.st_ino, st.st_size,
+                                 _mtime(st))
+
+    memo_dir = os.path.join(cache_dir, _SOURCES_DIR)
+    memo_file = os.path.join(
+        memo_dir, hashlib.sha256(_encode(path)).hexdigest())
+    try:
+        with open(memo_file, "r") as f:
+            memo_signature, digest = f.read().strip().rsplit(" ", 1)
+        if memo_signature == signature:
+            return digest
+    except (IOError, OSError, ValueError):
+        pass
+
+    hasher = hashlib.sha256()
+    artifact_utils.hash_file(path, [hasher])
+    digest = hasher.hexdigest()
+
+    try:
+        if not os.path.isdir(memo_dir):
+            os.makedirs(memo_dir, 0o755)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=memo_dir)
+        with os.fdopen(tmp_fd, "w") as f:
+            f.write("%s %s\n" % (signature, digest))
+        os.rename(tmp_path, memo_file)
+    except (IOError, OSError):
+        # memoization is just an optimization
+        pass
+    return digest
+
+
+def _hash_tools(hasher):
+    for tool in TOOLS:
+        try:
+            st = os.stat(tool)
+        except OSError:
+            continue
+        _update(hasher, "tool", tool, st.st_size, _mtime(st))
+
+    # molecule plugins code
+    plugins_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(plugins_dir, "*.py"))):
+        _update(hasher, "plugin", os.path.basename(path))
+        artifact_utils.hash_file(path, [hasher])
+
+
+def cache_key(metadata, cache_dir):
+    """
+    Compute the build cache key of a spec. The key covers the parsed spec
+    metadata, the content of the hook scripts, the manifest of the input
+    directory trees, the digest of the input files, the molecule
+    environment variables and the identity of the build tools.
+
+    @param metadata: parsed spec metadata
+    @type metadata: dict
+    @param cache_dir: build cache directory
+    @type cache_dir: string
+    @return: the cache key
+    @rtype: string
+    """
+    hasher = hashlib.sha256()
+    _update(hasher, "version", CACHE_KEY_VERSION)
+    _hash_metadata(hasher, metadata)
+    hash_scripts(hasher, metadata)
+
+    for key in INPUT_TREES:
+        path = metadata.get(key)
+        if path and os.path.isdir(path):
+            _hash_tree(hasher, path)
+    for key in INPUT_FILES:
+        path = metadata.get(key)
+        if path and os.path.isfile(path):
+            _update(hasher, "file", key, _source_digest(cache_dir, path))
+
+    for name in sorted(os.environ):
+        if name.startswith(INPUT_ENV_PREFIX):
+            _update(hasher, "env", name, os.environ[name])
+
+    _hash_tools(hasher)
+    return hasher.hexdigest()
+
+
+def lookup(cache_dir, key):
+    """
+    Return the path of the cache entry for key, or None if there is none.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return entry_dir
+    return None
+
+
+def restore(entry_dir, paths):
+    """
+    Restore the files of a cache entry to their destination paths. Files
+    are reflinked when possible, and copied otherwise, never hardlinked:
+    the cache entry must not change when the artifact is rewritten.
+
+    @param entry_dir: cache entry path, as returned by lookup()
+    @type entry_dir: string
+    @param paths: destination paths, matched by file name
+    @type paths: list
+    @return: list of restored destination paths
+    @rtype: list
+    """
+    restored = []
+    for path in paths:
+        cached = os.path.join(entry_dir, os.path.basename(path))
+        if not os.path.isfile(cached):
+            continue
+        dest_dir = os.path.dirname(path)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir, 0o755)
+        if os.path.lexists(path):
+            os.remove(path)
+        artifact_utils.clone_file(cached, path)
+        restored.append(path)
+    return restored
+
+
+def store(cache_dir, key, paths):
+    """
+    Store the given files into a new cache entry for key. The entry
+    becomes visible atomically, once all the files are in place.
+
+    @param cache_dir: build cache directory
+    @type cache_dir: string
+    @param key: the cache key
+    @type key: string
+    @param paths: artifact paths, missing ones are skipped
+    @type paths: list
+    @return: the cache entry path
+    @rtype: string
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = tempfile.mkdtemp(prefix=".%s." % (key,), dir=cache_dir)
+    try:
+        for path in paths:
+            if os.path.isfile(path):
+                artifact_utils.clone_file(
+                    path, os.path.join(tmp_dir, os.path.basename(path)))
+        os.chmod(tmp_dir, 0o755)
+        os.rename(tmp_dir, entry_dir)
+    except OSError as err:
+        shutil.rmtree(tmp_dir, True)
+        # another build stored the same entry in the meantime
+        if err.errno in (errno.EEXIST, errno.ENOTEMPTY):
+            return entry_dir
+        raise
+    except IOError:
+        shutil.rmtree(tmp_dir, True)
+        raise
+    return entry_dir
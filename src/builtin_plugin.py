@@ -16,9 +16,12 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import json
 import os
 import shutil
 import tempfile
+import threading
+import time
 
 from molecule.compat import get_stringtype
 from molecule.i18n import _
@@ -27,18 +30,125 @@ from molecule.specs.skel import GenericExecutionStep, GenericSpec
 
 import molecule.utils
 
+from . import artifact_utils
+from . import build_cache
+from . import chroot_cgroup
+from . import chroot_cleanup
+from . import chunk_store
+from . import mirror_manifest
+from . import mirror_shards
+from . import rsync_progress
+from . import trash
+from . import tree_copy
+from . import zsync
+
 
 class BuiltinHandlerMixin(object):
     """
     This class contains code in common between built-in handler classes.
     """
 
+    _overlay_umounter = ["/bin/umount"]
+
     def _export_generic_info(self):
         os.environ['RELEASE_STRING'] = self.metadata.get('release_string', '')
         os.environ['RELEASE_VERSION'] = self.metadata.get('release_version', '')
         os.environ['RELEASE_DESC'] = self.metadata.get('release_desc', '')
         os.environ['PRECHROOT'] = ' '.join(self.metadata.get('prechroot', []))
 
+    @staticmethod
+    def _metadata_checksum_paths(metadata, path):
+        algorithms = metadata.get('checksum_algorithms',
+                                  artifact_utils.DEFAULT_CHECKSUM_ALGORITHMS)
+        return [artifact_utils.checksum_path(path, x) for x in algorithms]
+
+    @staticmethod
+    def _metadata_zsync_enabled(metadata):
+        return metadata.get('generate_zsync') == "yes"
+
+    @classmethod
+    def _metadata_artifact_paths(cls, metadata, path):
+        """
+        Return path along with the paths of its checksum and zsync files.
+        """
+        paths = [path] + cls._metadata_checksum_paths(metadata, path)
+        if cls._metadata_zsync_enabled(metadata):
+            paths.append(zsync.zsync_path(path))
+        return paths
+
+    def _checksum_algorithms(self):
+        return self.metadata.get('checksum_algorithms',
+                                 artifact_utils.DEFAULT_CHECKSUM_ALGORITHMS)
+
+    def _checksum_hasher(self, *consumers):
+        """
+        Return a hasher computing all the checksums requested through the
+        checksum_algorithms parameter in a single pass. The given
+        consumers (zsync control file generator, chunk store writer) are
+        fed in the same pass, None ones are ignored.
+        """
+        return artifact_utils.MultiHasher(
+            self._checksum_algorithms(),
+            consumers=[x for x in consumers if x is not None])
+
+    def _zsync_maker(self):
+        """
+        Return a zsync control file generator if generate_zsync is
+        enabled, None otherwise.
+        """
+        if not self._metadata_zsync_enabled(self.metadata):
+            return None
+        return zsync.ZsyncMaker()
+
+    def _write_zsync(self, zsync_maker, path):
+        zsync_file = zsync.zsync_path(path)
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("BuiltinHandler"), darkred(self.spec_name),
+                _("writing zsync control file"), zsync_file,
+            )
+        )
+        zsync_maker.write(zsync_file, os.path.basename(path),
+                          mtime=os.path.getmtime(path))
+
+    def _chunk_store_writer(self, path):
+        """
+        Return a chunk store writer for the artifact at path if
+        chunk_store_directory is set, None otherwise.
+        """
+        store_dir = self.metadata.get('chunk_store_directory')
+        if not store_dir:
+            return None
+        return chunk_store.ChunkStoreWriter(store_dir,
+                                            os.path.basename(path))
+
+    def _finish_chunk_store(self, writer):
+        index_file = writer.finish()
+        self._output.output("[%s|%s] %s: %s (%s: %d/%d, %d %s)" % (
+                blue("BuiltinHandler"), darkred(self.spec_name),
+                _("artifact published to chunk store"), index_file,
+                _("new chunks"), writer.new_chunks, len(writer.chunks),
+                writer.new_bytes, _("bytes stored"),
+            )
+        )
+
+    def _export_checksum_paths(self, env, prefix, path, zsync_file=True):
+        """
+        Export to env the checksum file paths of the artifact at path.
+        <prefix>_CHECKSUM_PATH points to the first configured algorithm
+        checksum file, <prefix>_CHECKSUM_PATHS lists all of them.
+        <prefix>_ZSYNC_PATH points to the zsync control file and
+        <prefix>_CHUNK_INDEX_PATH to the chunk store index, if any.
+        """
+        paths = self._metadata_checksum_paths(self.metadata, path)
+        env[prefix + '_CHECKSUM_PATH'] = paths[0]
+        env[prefix + '_CHECKSUM_PATHS'] = ' '.join(paths)
+        if zsync_file and self._metadata_zsync_enabled(self.metadata):
+            env[prefix + '_ZSYNC_PATH'] = zsync.zsync_path(path)
+        store_dir = self.metadata.get('chunk_store_directory')
+        if store_dir:
+            env[prefix + '_CHUNK_INDEX_PATH'] = chunk_store.index_path(
+                store_dir, os.path.basename(path))
+
     def _run_error_script(self, source_chroot_dir, chroot_dir, cdroot_dir,
                           env=None):
 
@@ -63,6 +173,163 @@ class BuiltinHandlerMixin(object):
             )
             molecule.utils.exec_cmd(error_script, env=env)
 
+    def _copy_tree(self, source, dest, fallback=None, one_file_system=False):
+        """
+        Copy the directory tree at source to dest with the native parallel
+        copier, using tree_copy_workers threads. If fallback is given, it
+        is used instead, as fallback(source, dest), unless
+        tree_copy_workers is set.
+
+        @return: exit status
+        @rtype: int
+        """
+        workers = self.metadata.get('tree_copy_workers')
+        if fallback is not None and workers is None:
+            return fallback(source, dest)
+        if not tree_copy.available():
+            if fallback is not None:
+                return fallback(source, dest)
+            self._output.output("[%s|%s] %s" % (
+                    blue("BuiltinHandler"), darkred(self.spec_name),
+                    _("native tree copy not supported on this system"),
+                )
+            )
+            return 1
+
+        self._output.output("[%s|%s] %s: %s => %s" % (
+                blue("BuiltinHandler"), darkred(self.spec_name),
+                _("copying tree"), source, dest,
+            )
+        )
+        try:
+            stats = tree_copy.copy_tree(source, dest, workers=workers,
+                                        one_file_system=one_file_system)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuiltinHandler"), darkred(self.spec_name),
+                    _("tree copy failed"), err,
+                )
+            )
+            return 1
+        self._output.output("[%s|%s] %s: %d %s, %d %s, %d %s" % (
+                blue("BuiltinHandler"), darkred(self.spec_name),
+                _("tree copied"), stats['files'], _("files"),
+                stats['dirs'], _("directories"), stats['bytes'], _("bytes"),
+            )
+        )
+        return 0
+
+    def _umount_overlay_mirror(self):
+        """
+        Unmount the destination chroot overlay mounted by MirrorHandler,
+        if any, and drop its upper layer.
+        """
+        overlay = self.metadata.pop('mirror_overlay', None)
+        if overlay is None:
+            return 0
+        mount_point, overlay_dir = overlay
+        args = self._overlay_umounter + [mount_point]
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("BuiltinHandler"), darkred(self.spec_name),
+                _("spawning"), " ".join(args),
+            )
+        )
+        rc = molecule.utils.exec_cmd(args)
+        if rc != 0:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuiltinHandler"), darkred(self.spec_name),
+                    _("unable to unmount overlay"), mount_point,
+                )
+            )
+            return rc
+        shutil.rmtree(overlay_dir, True)
+        return 0
+
+    def _exec_cgroup_chroot_cmd(self, args, chroot, parent):
+        cgroup = chroot_cgroup.HookCgroup(parent, "molecule-hook")
+        try:
+            cgroup.create()
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuiltinHandler"), darkred(self.spec_name),
+                    _("unable to create the hook cgroup"), err,
+                )
+            )
+            return 1
+
+        rc = None
+        try:
+            rc = chroot_cgroup.exec_chroot_cmd(
+                args, chroot, cgroup,
+                pre_chroot=self.metadata.get('prechroot', []),
+                pid_namespace=self.metadata.get(
+                    'chroot_pid_namespace') == "yes")
+        finally:
+            try:
+                # kill all the pids of the hook, no matter what happened
+                if rc != 0 and not cgroup.kill():
+                    self._output.output("[%s|%s] %s: %s" % (
+                            blue("BuiltinHandler"),
+                            darkred(self.spec_name),
+                            _("unable to kill the hook processes"),
+                            cgroup.path,
+                        )
+                    )
+                stats = cgroup.stats()
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("BuiltinHandler"), darkred(self.spec_name),
+                        _("hook cgroup error"), err,
+                    )
+                )
+                stats = dict((k, None) for k in chroot_cgroup.STATS_KEYS)
+            stats['command'] = " ".join(args)
+            stats['exit_status'] = rc
+            self.metadata.setdefault('chroot_cgroup_stats', []).append(
+                stats)
+            self._output.output(
+                "[%s|%s] %s: cpu_usec=%s memory_peak=%s io_rbytes=%s "
+                "io_wbytes=%s: %s" % (
+                    blue("BuiltinHandler"), darkred(self.spec_name),
+                    _("hook resources"), stats['cpu_usec'],
+                    stats['memory_peak'], stats['io_rbytes'],
+                    stats['io_wbytes'], stats['command'],
+                )
+            )
+            if not cgroup.remove():
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("BuiltinHandler"), darkred(self.spec_name),
+                        _("processes left running in"), cgroup.path,
+                    )
+                )
+        return rc
+
+    def _exec_chroot_cmd(self, args, chroot):
+        """
+        Execute a command inside chroot. If chroot_cgroup is set, the
+        command runs in a cgroup of its own, below it, and optionally in a
+        new PID namespace: its resource usage is recorded into the
+        chroot_cgroup_stats metadata and, if it fails, all its processes
+        are killed at once. Otherwise all the processes running inside
+        chroot are killed if it fails.
+        """
+        parent = self.metadata.get('chroot_cgroup')
+        if parent:
+            return self._exec_cgroup_chroot_cmd(args, chroot, parent)
+
+        try:
+            rc = molecule.utils.exec_chroot_cmd(
+                args, chroot,
+                pre_chroot=self.metadata.get('prechroot', [])
+            )
+        except Exception:
+            # kill all the pids inside chroot, no matter what just happened
+            molecule.utils.kill_chroot_pids(chroot, sleep=True)
+            raise
+        if rc != 0:
+            molecule.utils.kill_chroot_pids(chroot, sleep=True)
+        return rc
+
     def _exec_inner_script(self, exec_script, dest_chroot):
 
         source_exec = exec_script[0]
@@ -83,21 +350,12 @@ class BuiltinHandlerMixin(object):
             dest_exec = "/%s" % (dest_exec,)
 
         try:
-            rc = molecule.utils.exec_chroot_cmd(
-                [dest_exec] + exec_script[1:],
-                dest_chroot,
-                pre_chroot=self.metadata.get('prechroot', [])
-            )
-
-        except Exception:
-            # kill all the pids inside chroot, no matter what just happened
-            molecule.utils.kill_chroot_pids(dest_chroot, sleep=True)
-            raise
+            rc = self._exec_chroot_cmd([dest_exec] + exec_script[1:],
+                                       dest_chroot)
         finally:
             os.remove(tmp_exec)
 
         if rc != 0:
-            molecule.utils.kill_chroot_pids(dest_chroot, sleep=True)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("BuiltinHandler"), darkred(self.spec_name),
                     _("inner chroot hook failed"), rc,
@@ -107,16 +365,64 @@ class BuiltinHandlerMixin(object):
 
 
 class MirrorHandler(GenericExecutionStep, BuiltinHandlerMixin):
+    """
+    Mirror source_chroot into the destination chroot.
+
+    If incremental_mirror is enabled, a manifest of the source tree is
+    kept next to the mirror and only the paths changed in the source tree
+    since the previous run are synced. The mirror is not scanned: the
+    changes made to it by hooks are kept, and the hooks run again on top
+    of them, so they must be idempotent. A full sync is run if the hook
+    scripts changed. The manifest path and the list of synced paths (None
+    if the whole tree was synced) are stored into metadata as
+    mirror_manifest and mirror_changed_paths.
+
+    rsync progress is reported every _progress_interval seconds, and the
+    totals of the run are recorded in the mirror_sync_stats metadata (see
+    rsync_progress.STATS_KEYS).
+
+    With mirror_rsync_workers greater than one, full syncs are split among
+    that many concurrent rsync processes, see _sharded_sync().
+
+    mirror_backend selects how the mirror is created: "rsync" (default)
+    copies source_chroot, "reflink" clones it file by file sharing the
+    data extents (btrfs, XFS), "btrfs-snapshot" snapshots the
+    source_chroot subvolume. With copy-on-write backends the mirror is
+    recreated at every run, takes almost no space, and later steps only
+    unshare the extents they modify. "native" recreates the mirror with the
+    built-in parallel tree copier. "overlayfs" copies nothing: the
+    destination chroot is an overlay mount with source_chroot as lower
+    layer and a per-build upper layer receiving all the changes, which is
+    unmounted and dropped once the ISO image is built.
+    """
 
     _mirror_syncer = "/usr/bin/rsync"
     _mirror_syncer_builtin_args = [
         "-a", "--delete", "--delete-excluded",
         "--delete-during", "--numeric-ids",
         "--recursive", "-d", "-A", "-H", "--xattrs"]
+    # builtin arguments only valid when syncing the whole tree
+    _mirror_syncer_full_args = (
+        "--delete", "--delete-excluded", "--delete-during", "--recursive")
+    # listed paths are transferred even if their size and mtime match, and
+    # removed from the mirror if missing from the source tree
+    _mirror_syncer_incremental_args = [
+        "--ignore-times", "--delete-missing-args", "--force", "--from0"]
+    _mirror_cloner = "/bin/cp"
+    _mirror_cloner_builtin_args = [
+        "-a", "--reflink=always", "--no-target-directory"]
+    _btrfs = "/sbin/btrfs"
+    _overlay_mounter = ["/bin/mount", "-t", "overlay", "overlay"]
+    # inode number of btrfs subvolume roots
+    _BTRFS_SUBVOLUME_INO = 256
+    # seconds between two sync progress reports
+    _progress_interval = 5.0
 
     def __init__(self, *args, **kwargs):
         super(MirrorHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
+        self._sync_meters = []
+        self._sync_lock = threading.Lock()
 
     def setup(self):
         # creating destination chroot dir
@@ -168,6 +474,7 @@ class MirrorHandler(GenericExecutionStep, BuiltinHandlerMixin):
     def kill(self, success=True):
         if not success:
             self._run_error_script(self.source_dir, self.dest_dir, None)
+            self._umount_overlay_mirror()
         self._output.output("[%s|%s] %s" % (
                 blue("MirrorHandler"), darkred(self.spec_name),
                 _("executing kill"),
@@ -175,6 +482,398 @@ class MirrorHandler(GenericExecutionStep, BuiltinHandlerMixin):
         )
         return 0
 
+    def _spawn(self, args, report_progress=True):
+        if args[0] == self._mirror_syncer:
+            args = args[:1] + rsync_progress.PROGRESS_ARGS + args[1:]
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("MirrorHandler"), darkred(self.spec_name),
+                _("spawning"), " ".join(args),
+            )
+        )
+        if args[0] != self._mirror_syncer:
+            return molecule.utils.exec_cmd(args)
+
+        meter = rsync_progress.ProgressMeter()
+        with self._sync_lock:
+            self._sync_meters.append(meter)
+        if report_progress:
+            on_progress = self._report_progress
+        else:
+            on_progress = lambda x: None
+        return rsync_progress.run(
+            args, meter, on_progress, self._report_output,
+            interval=self._progress_interval)
+
+    def _report_output(self, line):
+        self._output.output("[%s|%s] %s" % (
+                blue("MirrorHandler"), darkred(self.spec_name), line,
+            )
+        )
+
+    def _output_progress(self, label, stats, percent, eta):
+        if eta is None:
+            eta = "unknown"
+        else:
+            eta = "%ds" % (eta,)
+        self._output.output(
+            "[%s|%s] %s: bytes=%d bytes/s=%d files=%d files/s=%.1f "
+            "checked=%d percent=%d eta=%s" % (
+                blue("MirrorHandler"), darkred(self.spec_name),
+                label, stats['bytes'], stats['bytes_per_sec'],
+                stats['files'], stats['files_per_sec'], stats['checked'],
+                percent, eta,
+            )
+        )
+
+    def _report_progress(self, meter):
+        self._output_progress(_("sync progress"), meter.stats(),
+                              meter.percent, meter.eta)
+
+    @staticmethod
+    def _sum_sync_stats(meters, start):
+        """
+        Sum up the statistics of the given rsync meters, throughput is
+        computed over the time elapsed since start.
+        """
+        stats = dict((k, 0) for k in rsync_progress.STATS_KEYS)
+        for meter in meters:
+            for key, value in meter.stats().items():
+                stats[key] += value
+        elapsed = max(time.time() - start, 0.0)
+        stats['elapsed'] = round(elapsed, 3)
+        if elapsed > 0:
+            stats['bytes_per_sec'] = int(stats['bytes'] / elapsed)
+            stats['files_per_sec'] = round(stats['files'] / elapsed, 1)
+        else:
+            stats['bytes_per_sec'], stats['files_per_sec'] = 0, 0.0
+        return stats
+
+    def _report_shards_progress(self, meters, start):
+        """
+        Report the progress of concurrent rsync processes as a whole: they
+        are done when the slowest one is.
+        """
+        etas = [x.eta for x in meters]
+        if None in etas or not etas:
+            eta = None
+        else:
+            eta = max(etas)
+        percent = min([x.percent for x in meters] or [0])
+        self._output_progress(_("sharded sync progress"),
+                              self._sum_sync_stats(meters, start),
+                              percent, eta)
+
+    def _record_sync_stats(self, start):
+        """
+        Sum up the statistics of the rsync processes spawned since start,
+        concurrent ones included, into the mirror_sync_stats metadata.
+        """
+        if not self._sync_meters:
+            return
+        stats = self._sum_sync_stats(self._sync_meters, start)
+        self.metadata['mirror_sync_stats'] = stats
+        self._output.output(
+            "[%s|%s] %s: bytes=%d bytes/s=%d files=%d files/s=%.1f "
+            "checked=%d elapsed=%.1fs" % (
+                blue("MirrorHandler"), darkred(self.spec_name),
+                _("sync completed"), stats['bytes'], stats['bytes_per_sec'],
+                stats['files'], stats['files_per_sec'], stats['checked'],
+                stats['elapsed'],
+            )
+        )
+
+    def _one_file_system(self):
+        extra_args = self.metadata.get('extra_rsync_parameters', [])
+        return "-x" in extra_args or "--one-file-system" in extra_args
+
+    def _sync_paths(self, paths, sync_args):
+        """
+        Sync the given relative paths only, through rsync --files-from,
+        with the given additional arguments.
+        """
+        fsencode = getattr(os, "fsencode", lambda x: x)
+        tmp_fd, files_from = tempfile.mkstemp(
+            dir=os.path.dirname(self.dest_dir), prefix=".files-from.")
+        try:
+            with os.fdopen(tmp_fd, "wb") as f:
+                for path in paths:
+                    f.write(fsencode(path) + b"\0")
+            args = [self._mirror_syncer]
+            args.extend(x for x in self._mirror_syncer_builtin_args
+                        if x not in self._mirror_syncer_full_args)
+            args.extend(self.metadata.get('extra_rsync_parameters', []))
+            args.extend(sync_args)
+            args.append("--files-from=" + files_from)
+            args.append(self.source_dir + "/")
+            args.append(self.dest_dir + "/")
+            return self._spawn(args)
+        finally:
+            os.remove(files_from)
+
+    def _sharded_sync(self, workers):
+        """
+        Sync the whole tree with several rsync processes. A first pass
+        syncs the top level entries without recursing, deleting the stale
+        ones. Then the top level directories, split into groups of similar
+        size (as recorded by the previous run), are synced concurrently.
+        Meanwhile the source tree is scanned, to record the sizes for the
+        next run and to find the hardlinks spread among different groups,
+        which are finally linked by a last pass over them only. The
+        progress of the concurrent rsync processes is reported as a whole.
+        """
+        extra_args = self.metadata.get('extra_rsync_parameters', [])
+        one_file_system = self._one_file_system()
+        sizes_file = mirror_shards.shards_path(self.dest_dir)
+        names = mirror_shards.top_level_dirs(
+            self.source_dir, one_file_system=one_file_system)
+        shards = mirror_shards.balance(
+            names, mirror_shards.load_sizes(sizes_file), workers)
+
+        args = [self._mirror_syncer]
+        args.extend(self._mirror_syncer_builtin_args)
+        args.extend(extra_args)
+        args.extend(["--no-recursive", "--dirs"])
+        args.append(self.source_dir + "/")
+        args.append(self.dest_dir + "/")
+        rc = self._spawn(args)
+        if rc != 0:
+            return rc
+
+        scanner = mirror_shards.TreeScanner(
+            self.source_dir, names, one_file_system=one_file_system)
+        scanner.start()
+
+        results = [None] * len(shards)
+        with self._sync_lock:
+            first_meter = len(self._sync_meters)
+
+        def _sync_shard(index, shard):
+            shard_args = [self._mirror_syncer]
+            shard_args.extend(self._mirror_syncer_builtin_args)
+            shard_args.extend(extra_args)
+            shard_args.extend(os.path.join(self.source_dir, x)
+                              for x in shard)
+            shard_args.append(self.dest_dir + "/")
+            try:
+                results[index] = self._spawn(shard_args,
+                                             report_progress=False)
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("MirrorHandler"), darkred(self.spec_name),
+                        _("mirroring error"), err,
+                    )
+                )
+                results[index] = 1
+
+        start = time.time()
+        threads = []
+        for index, shard in enumerate(shards):
+            thread = threading.Thread(target=_sync_shard,
+                                      args=(index, shard))
+            thread.start()
+            threads.append(thread)
+        next_report = start + self._progress_interval
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(max(next_report - time.time(), 0))
+                if time.time() >= next_report:
+                    next_report = time.time() + self._progress_interval
+                    with self._sync_lock:
+                        meters = self._sync_meters[first_meter:]
+                    self._report_shards_progress(meters, start)
+        scanner.join()
+
+        for rc in results:
+            if rc != 0:
+                return rc
+        if scanner.error is not None:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("unable to scan the source chroot"), scanner.error,
+                )
+            )
+            return 1
+
+        links = scanner.cross_shard_links(shards)
+        if links:
+            self._output.output("[%s|%s] %s: %d" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("linking files hardlinked across shards"), len(links),
+                )
+            )
+            rc = self._sync_paths(links, ["--from0"])
+            if rc != 0:
+                return rc
+
+        try:
+            mirror_shards.save_sizes(sizes_file, scanner.sizes)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("unable to record the shard sizes"), err,
+                )
+            )
+        return 0
+
+    def _full_sync(self, args):
+        workers = self.metadata.get('mirror_rsync_workers', 1)
+        if workers > 1:
+            return self._sharded_sync(workers)
+        return self._spawn(args)
+
+    def _incremental_sync(self, args):
+        """
+        Sync only the paths changed since the previous run, falling back
+        to a full sync if there is no usable manifest.
+        """
+        manifest_file = mirror_manifest.manifest_path(self.dest_dir)
+        hooks = mirror_manifest.hooks_digest(self.metadata)
+        manifest = mirror_manifest.load(manifest_file, args, hooks)
+        # if the sync fails, the next run must be a full one
+        mirror_manifest.remove(manifest_file)
+
+        source = mirror_manifest.scan_tree(
+            self.source_dir, one_file_system=self._one_file_system())
+        if manifest is None:
+            self._output.output("[%s|%s] %s" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("no mirror manifest, syncing the whole tree"),
+                )
+            )
+            rc = self._full_sync(args)
+            if rc != 0:
+                return rc
+            changed = None
+        else:
+            changed = [x for x in mirror_manifest.changed_paths(
+                    manifest, source) if x != mirror_manifest.ROOT]
+            self._output.output("[%s|%s] %s: %d" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("changed paths"), len(changed),
+                )
+            )
+
+        if changed:
+            rc = self._sync_paths(
+                changed, self._mirror_syncer_incremental_args)
+            if rc != 0:
+                return rc
+
+        self.metadata['mirror_changed_paths'] = changed
+        try:
+            mirror_manifest.save(manifest_file, args, hooks, source)
+        except (IOError, OSError) as err:
+            # the next run will just be a full one
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("unable to write the mirror manifest"), err,
+                )
+            )
+            return 0
+        self.metadata['mirror_manifest'] = manifest_file
+        return 0
+
+    def _is_btrfs_subvolume(self, path):
+        try:
+            if os.lstat(path).st_ino != self._BTRFS_SUBVOLUME_INO:
+                return False
+        except OSError:
+            return False
+        if not os.access(self._btrfs, os.X_OK):
+            return False
+        sts, output = molecule.utils.exec_cmd_get_status_output(
+            [self._btrfs, "subvolume", "show", path])
+        return sts == 0
+
+    def _discard_mirror(self):
+        """
+        Remove the mirror left by a previous run, if any.
+        """
+        if self._is_btrfs_subvolume(self.dest_dir):
+            return self._spawn(
+                [self._btrfs, "subvolume", "delete", self.dest_dir])
+        if os.path.lexists(self.dest_dir):
+            shutil.rmtree(self.dest_dir)
+        return 0
+
+    def _clone_mirror(self, backend, args):
+        """
+        Recreate the mirror from scratch, as a copy-on-write clone of
+        source_chroot or with the native tree copier. The whole tree is
+        then synced, to apply extra_rsync_parameters (excluded paths,
+        mostly): only metadata is compared, no data is transferred.
+        """
+        # the previous mirror is gone, and so is its manifest
+        mirror_manifest.remove(mirror_manifest.manifest_path(self.dest_dir))
+        if backend == "btrfs-snapshot" and \
+                not self._is_btrfs_subvolume(self.source_dir):
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("MirrorHandler"), darkred(self.spec_name),
+                    _("not a btrfs subvolume"), self.source_dir,
+                )
+            )
+            return 1
+
+        rc = self._discard_mirror()
+        if rc != 0:
+            return rc
+
+        if backend == "native":
+            rc = self._copy_tree(self.source_dir, self.dest_dir,
+                                 one_file_system=self._one_file_system())
+        elif backend == "btrfs-snapshot":
+            rc = self._spawn([self._btrfs, "subvolume", "snapshot",
+                              self.source_dir, self.dest_dir])
+        else:
+            clone_args = [self._mirror_cloner]
+            clone_args.extend(self._mirror_cloner_builtin_args)
+            clone_args.append(self.source_dir)
+            clone_args.append(self.dest_dir)
+            rc = self._spawn(clone_args)
+        if rc != 0:
+            return rc
+
+        if self.metadata.get('extra_rsync_parameters'):
+            rc = self._spawn(args)
+        return rc
+
+    def _overlay_mirror(self):
+        """
+        Mount the destination chroot as an overlay of source_chroot with
+        a fresh upper layer.
+        """
+        # the mirror is not touched, and will be stale afterwards
+        mirror_manifest.remove(mirror_manifest.manifest_path(self.dest_dir))
+        overlay_dir = tempfile.mkdtemp(
+            prefix=".%s.overlay." % (os.path.basename(self.dest_dir),),
+            dir=os.path.dirname(self.dest_dir))
+        upper_dir = os.path.join(overlay_dir, "upper")
+        work_dir = os.path.join(overlay_dir, "work")
+        os.mkdir(upper_dir)
+        os.mkdir(work_dir)
+
+        layers = (os.path.abspath(self.source_dir), upper_dir, work_dir)
+        for path in layers:
+            # mount option separators
+            if "," in path or ":" in path:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("MirrorHandler"), darkred(self.spec_name),
+                        _("unsupported overlay layer path"), path,
+                    )
+                )
+                shutil.rmtree(overlay_dir, True)
+                return 1
+
+        args = self._overlay_mounter + [
+            "-o", "lowerdir=%s,upperdir=%s,workdir=%s" % layers,
+            self.dest_dir]
+        rc = self._spawn(args)
+        if rc != 0:
+            shutil.rmtree(overlay_dir, True)
+            return rc
+        self.metadata['mirror_overlay'] = (self.dest_dir, overlay_dir)
+        return 0
+
     def run(self):
 
         self._output.output("[%s|%s] %s" % (
@@ -182,18 +881,48 @@ class MirrorHandler(GenericExecutionStep, BuiltinHandlerMixin):
                 _("mirroring running"),
             )
         )
+        self._sync_meters = []
+        start = time.time()
         # running sync
         args = [self._mirror_syncer]
         args.extend(self._mirror_syncer_builtin_args)
         args.extend(self.metadata.get('extra_rsync_parameters', []))
         args.append(self.source_dir + "/")
         args.append(self.dest_dir + "/")
-        self._output.output("[%s|%s] %s: %s" % (
-                blue("MirrorHandler"), darkred(self.spec_name),
-                _("spawning"), " ".join(args),
-            )
-        )
-        rc = molecule.utils.exec_cmd(args)
+        backend = self.metadata.get('mirror_backend', "rsync")
+        if backend == "overlayfs":
+            rc = self._overlay_mirror()
+        elif backend != "rsync":
+            try:
+                rc = self._clone_mirror(backend, args)
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("MirrorHandler"), darkred(self.spec_name),
+                        _("unable to replace the previous mirror"), err,
+                    )
+                )
+                rc = 1
+        elif self.metadata.get('incremental_mirror') == "yes":
+            try:
+                rc = self._incremental_sync(args)
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("MirrorHandler"), darkred(self.spec_name),
+                        _("mirror manifest error"), err,
+                    )
+                )
+                rc = 1
+        else:
+            try:
+                rc = self._full_sync(args)
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("MirrorHandler"), darkred(self.spec_name),
+                        _("mirroring error"), err,
+                    )
+                )
+                rc = 1
+        self._record_sync_stats(start)
         if rc != 0:
             self._output.output("[%s|%s] %s: %s" % (
                     blue("MirrorHandler"), darkred(self.spec_name),
@@ -252,6 +981,60 @@ class ChrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
         return 0
 
+    def _cleanup_report(self, empty_paths, remove_paths, report_file):
+        """
+        Report the space paths_to_empty and paths_to_remove reclaim, and
+        the largest directories left, see chroot_cleanup.report(). The
+        report is written as JSON to report_file, if any.
+        """
+        try:
+            report = chroot_cleanup.report(
+                self.dest_dir, empty_paths, remove_paths,
+                top=self.metadata.get('cleanup_report_top_dirs', 20))
+        except (IOError, OSError, ValueError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ChrootHandler"), darkred(self.spec_name),
+                    _("cleanup report failed"), err,
+                )
+            )
+            return 1
+
+        for stats in report['patterns']:
+            self._output.output("[%s|%s] %s: %s %s: %d %s, %d %s" % (
+                    blue("ChrootHandler"), darkred(self.spec_name),
+                    _("reclaimable"), stats['type'], stats['pattern'],
+                    stats['files'], _("files"), stats['bytes'], _("bytes"),
+                )
+            )
+        for stats in report['top_dirs']:
+            self._output.output("[%s|%s] %s: %s: %d %s, %d %s" % (
+                    blue("ChrootHandler"), darkred(self.spec_name),
+                    _("largest dir"), stats['path'], stats['files'],
+                    _("files"), stats['bytes'], _("bytes"),
+                )
+            )
+        if not report_file:
+            return 0
+
+        tmp_path = report_file + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, report_file)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ChrootHandler"), darkred(self.spec_name),
+                    _("unable to write the cleanup report"), err,
+                )
+            )
+            return 1
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("ChrootHandler"), darkred(self.spec_name),
+                _("cleanup report"), report_file,
+            )
+        )
+        return 0
+
     def post_run(self):
         self._output.output("[%s|%s] %s" % (
                 blue("ChrootHandler"), darkred(self.spec_name),
@@ -259,44 +1042,58 @@ class ChrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
             )
         )
 
-        # now remove paths to empty
+        # now empty paths to empty and remove paths to remove, all the
+        # patterns are matched in a single chroot walk
         empty_paths = self.metadata.get('paths_to_empty', [])
-        for mypath in empty_paths:
-            mypath = self.dest_dir+mypath
-            self._output.output("[%s|%s] %s: %s" % (
+        remove_paths = self.metadata.get('paths_to_remove', [])
+        dry_run = self.metadata.get('cleanup_dry_run') == "yes"
+        report_file = self.metadata.get('cleanup_report')
+        if report_file or dry_run:
+            rc = self._cleanup_report(empty_paths, remove_paths, report_file)
+            if rc != 0:
+                return rc
+        if dry_run:
+            self._output.output("[%s|%s] %s" % (
                     blue("ChrootHandler"), darkred(self.spec_name),
-                    _("emptying dir"), mypath,
+                    _("cleanup dry run, nothing removed"),
                 )
             )
-            if os.path.isdir(mypath):
-                molecule.utils.empty_dir(mypath)
-
-        # now remove paths to remove (...)
-        remove_paths = self.metadata.get('paths_to_remove', [])
-
-        # setup sandbox
-        sb_dirs = [self.dest_dir]
-        sb_env = {
-            'SANDBOX_WRITE': ':'.join(sb_dirs),
-        }
-        myenv = os.environ.copy()
-        myenv.update(sb_env)
-
-        for mypath in remove_paths:
-            mypath = self.dest_dir+mypath
-            self._output.output("[%s|%s] %s: %s" % (
+        elif empty_paths or remove_paths:
+            self._output.output("[%s|%s] %s: %d" % (
                     blue("ChrootHandler"), darkred(self.spec_name),
-                    _("removing dir"), mypath,
+                    _("cleaning up chroot, patterns"),
+                    len(empty_paths) + len(remove_paths),
                 )
             )
-            rc = molecule.utils.remove_path_sandbox(mypath, sb_env)
-            if rc != 0:
-                self._output.output("[%s|%s] %s: %s: %s" % (
+            def _mount_point_found(path):
+                self._output.output("[%s|%s] %s: %s" % (
                         blue("ChrootHandler"), darkred(self.spec_name),
-                        _("removal failed for"), mypath, rc,
+                        _("mount point left in place"), path,
                     )
                 )
-                return rc
+
+            try:
+                emptied, removed = chroot_cleanup.cleanup(
+                    self.dest_dir, empty_paths, remove_paths,
+                    on_mount_point=_mount_point_found)
+            except (IOError, OSError, ValueError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("ChrootHandler"), darkred(self.spec_name),
+                        _("chroot cleanup failed"), err,
+                    )
+                )
+                return 1
+            for label, results in ((_("emptied"), emptied),
+                                   (_("removed"), removed)):
+                for pattern, stats in results:
+                    self._output.output(
+                        "[%s|%s] %s: %s: %d %s, %d %s, %s %d %s" % (
+                            blue("ChrootHandler"), darkred(self.spec_name),
+                            label, pattern, stats['files'], _("files"),
+                            stats['bytes'], _("bytes"), _("plus"),
+                            stats['trashed'], _("dirs moved to trash"),
+                        )
+                    )
 
         # write release file
         release_file = self.metadata.get('release_file')
@@ -354,6 +1151,7 @@ class ChrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
     def kill(self, success=True):
         if not success:
             self._run_error_script(self.source_dir, self.dest_dir, None)
+            self._umount_overlay_mirror()
         self._output.output("[%s|%s] %s" % (
                 blue("ChrootHandler"),
                 darkred(self.spec_name), _("executing kill"),
@@ -436,6 +1234,7 @@ class CdrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if not success:
             self._run_error_script(None, self.source_chroot,
                                    self.dest_root)
+            self._umount_overlay_mirror()
         self._output.output("[%s|%s] %s" % (
                 blue("CdrootHandler"), darkred(self.spec_name),
                 _("executing kill"),
@@ -519,8 +1318,6 @@ class CdrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
 class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
-    MD5_EXT = ".md5"
-
     _cdrtools_mkisofs = "/usr/bin/mkisofs"
     _iso_builder = _cdrtools_mkisofs
     # support both cdrkit and cdrtools
@@ -537,6 +1334,23 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         super(IsoHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
 
+    @staticmethod
+    def _dest_iso_path(metadata):
+        dest_iso_filename = metadata.get('destination_iso_image_name')
+        if not dest_iso_filename:
+            dest_iso_filename = "%s_%s_%s.iso" % (
+                metadata.get('release_string', '').replace(' ', '_'),
+                metadata.get('release_version', '').replace(' ', '_'),
+                metadata.get('release_desc', '').replace(' ', '_'),
+            )
+        return os.path.join(metadata['destination_iso_directory'],
+                            dest_iso_filename)
+
+    @classmethod
+    def artifact_paths(cls, metadata):
+        return cls._metadata_artifact_paths(metadata,
+                                            cls._dest_iso_path(metadata))
+
     def setup(self):
         # setup paths
         self.source_path = os.path.join(
@@ -546,17 +1360,10 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         dest_iso_dir = self.metadata['destination_iso_directory']
         if not os.path.isdir(dest_iso_dir):
             os.makedirs(dest_iso_dir, 0o755)
-        dest_iso_filename = self.metadata.get('destination_iso_image_name')
         release_string = self.metadata.get('release_string', '')
         release_version = self.metadata.get('release_version', '')
         release_desc = self.metadata.get('release_desc', '')
-        if not dest_iso_filename:
-            dest_iso_filename = "%s_%s_%s.iso" % (
-                release_string.replace(' ', '_'),
-                release_version.replace(' ', '_'),
-                release_desc.replace(' ', '_'),
-            )
-        self.dest_iso = os.path.join(dest_iso_dir, dest_iso_filename)
+        self.dest_iso = self._dest_iso_path(self.metadata)
         self.iso_title = \
             os.getenv('MOLECULE_ISO_TITLE', "%s %s %s" % (
                 release_string, release_version, release_desc,
@@ -583,7 +1390,7 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
             env['CHROOT_DIR'] = self.chroot_dir
             env['CDROOT_DIR'] = self.source_path
             env['ISO_PATH'] = self.dest_iso
-            env['ISO_CHECKSUM_PATH'] = self.dest_iso + IsoHandler.MD5_EXT
+            self._export_checksum_paths(env, 'ISO', self.dest_iso)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("IsoHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -612,7 +1419,7 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if exec_script:
             env = os.environ.copy()
             env['ISO_PATH'] = self.dest_iso
-            env['ISO_CHECKSUM_PATH'] = self.dest_iso + IsoHandler.MD5_EXT
+            self._export_checksum_paths(env, 'ISO', self.dest_iso)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("IsoHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -633,6 +1440,8 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if not success:
             self._run_error_script(self.source_chroot, self.chroot_dir,
                                    self.source_path)
+        # pre_iso_script could still use the destination chroot
+        self._umount_overlay_mirror()
         self._output.output("[%s|%s] %s" % (
                 blue("IsoHandler"), darkred(self.spec_name),
                 _("executing kill"),
@@ -653,13 +1462,26 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         args.extend(self.metadata.get('extra_mkisofs_parameters', []))
         if self.iso_title.strip():
             args.extend(["-V", self.iso_title[:32]])
-        args.extend(['-o', self.dest_iso, self.source_path])
-        self._output.output("[%s|%s] %s: %s" % (
+        # the ISO image is written to stdout and hashed while stored
+        args.append(self.source_path)
+        self._output.output("[%s|%s] %s: %s > %s" % (
                 blue("IsoHandler"), darkred(self.spec_name),
-                _("spawning"), " ".join(args),
+                _("spawning"), " ".join(args), self.dest_iso,
             )
         )
-        rc = molecule.utils.exec_cmd(args)
+        zsync_maker = self._zsync_maker()
+        chunk_writer = self._chunk_store_writer(self.dest_iso)
+        hasher = self._checksum_hasher(zsync_maker, chunk_writer)
+        try:
+            rc = artifact_utils.command_to_file(args, self.dest_iso,
+                                                hashers=[hasher])
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("IsoHandler"), darkred(self.spec_name),
+                    _("unable to write ISO image"), err,
+                )
+            )
+            rc = 1
         if rc != 0:
             self._output.output("[%s|%s] %s: %s" % (
                     blue("IsoHandler"), darkred(self.spec_name),
@@ -676,18 +1498,196 @@ class IsoHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if os.path.isfile(self.dest_iso) and os.access(self.dest_iso, os.R_OK):
             self._output.output("[%s|%s] %s: %s" % (
                     blue("IsoHandler"), darkred(self.spec_name),
-                    _("generating md5 for"), self.dest_iso,
+                    _("writing checksums for"), self.dest_iso,
                 )
             )
-            digest = molecule.utils.md5sum(self.dest_iso)
-            md5file = self.dest_iso + IsoHandler.MD5_EXT
-            with open(md5file, "w") as f:
-                f.write("%s  %s\n" % (digest, os.path.basename(self.dest_iso),))
-                f.flush()
+            artifact_utils.write_checksum_files(self.dest_iso,
+                                                hasher.hexdigests())
+            if zsync_maker is not None:
+                self._write_zsync(zsync_maker, self.dest_iso)
+            if chunk_writer is not None:
+                self._finish_chunk_store(chunk_writer)
 
         return 0
 
 
+class BuildCacheLookupHandler(GenericExecutionStep, BuiltinHandlerMixin):
+    """
+    First step of cacheable pipelines. If build_cache_directory is set,
+    compute the build cache key and, on hit, restore the cached artifact
+    to its destination. All the other steps are then skipped, hooks
+    included: post hooks like post_iso_script would see a chroot that was
+    never unpacked. Hook scripts are part of the cache key instead, so
+    changing any of them is a miss.
+    """
+
+    # the step producing the artifact, set by cacheable_steps()
+    artifact_step = None
+
+    def __init__(self, *args, **kwargs):
+        super(BuildCacheLookupHandler, self).__init__(*args, **kwargs)
+        self.cache_dir = None
+
+    def setup(self):
+        self.cache_dir = self.metadata.get('build_cache_directory')
+        return 0
+
+    def pre_run(self):
+        """ Nothing to do """
+        return 0
+
+    def run(self):
+        if not self.cache_dir:
+            return 0
+
+        key = build_cache.cache_key(self.metadata, self.cache_dir)
+        self.metadata['build_cache_key'] = key
+        entry_dir = build_cache.lookup(self.cache_dir, key)
+        if entry_dir is None:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuildCacheHandler"), darkred(self.spec_name),
+                    _("build cache miss"), key,
+                )
+            )
+            return 0
+
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("BuildCacheHandler"), darkred(self.spec_name),
+                _("build cache hit, skipping all the steps and hooks"), key,
+            )
+        )
+        paths = self.artifact_step.artifact_paths(self.metadata)
+        try:
+            restored = build_cache.restore(entry_dir, paths)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuildCacheHandler"), darkred(self.spec_name),
+                    _("unable to restore cached artifact"), err,
+                )
+            )
+            return 1
+
+        for path in restored:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuildCacheHandler"), darkred(self.spec_name),
+                    _("restored"), path,
+                )
+            )
+        self.metadata['build_cache_hit'] = True
+        return 0
+
+    def post_run(self):
+        """ Nothing to do """
+        return 0
+
+    def kill(self, success=True):
+        return 0
+
+
+class BuildCacheStoreHandler(GenericExecutionStep, BuiltinHandlerMixin):
+    """
+    Last step of cacheable pipelines, store the freshly built artifact
+    into the build cache. Failures are not fatal.
+    """
+
+    # the step producing the artifact, set by cacheable_steps()
+    artifact_step = None
+
+    def setup(self):
+        return 0
+
+    def pre_run(self):
+        """ Nothing to do """
+        return 0
+
+    def run(self):
+        key = self.metadata.get('build_cache_key')
+        if key is None or self.metadata.get('build_cache_hit'):
+            return 0
+
+        cache_dir = self.metadata['build_cache_directory']
+        paths = self.artifact_step.artifact_paths(self.metadata)
+        try:
+            build_cache.store(cache_dir, key, paths)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("BuildCacheHandler"), darkred(self.spec_name),
+                    _("unable to store artifact into build cache"), err,
+                )
+            )
+            return 0
+
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("BuildCacheHandler"), darkred(self.spec_name),
+                _("artifact stored into build cache"), key,
+            )
+        )
+        return 0
+
+    def post_run(self):
+        """ Nothing to do """
+        return 0
+
+    def kill(self, success=True):
+        return 0
+
+
+class _BuildCacheSkipMixin(object):
+    """
+    Turn every execution step method into a no-op on build cache hit.
+    """
+
+    def _build_cache_hit(self):
+        return self.metadata.get('build_cache_hit', False)
+
+    def setup(self):
+        if self._build_cache_hit():
+            return 0
+        return super(_BuildCacheSkipMixin, self).setup()
+
+    def pre_run(self):
+        if self._build_cache_hit():
+            return 0
+        return super(_BuildCacheSkipMixin, self).pre_run()
+
+    def run(self):
+        if self._build_cache_hit():
+            return 0
+        return super(_BuildCacheSkipMixin, self).run()
+
+    def post_run(self):
+        if self._build_cache_hit():
+            return 0
+        return super(_BuildCacheSkipMixin, self).post_run()
+
+    def kill(self, success=True):
+        if self._build_cache_hit():
+            return 0
+        return super(_BuildCacheSkipMixin, self).kill(success=success)
+
+
+def cacheable_steps(steps):
+    """
+    Wrap the execution steps of a spec with the build cache lookup and
+    store steps. The last step must produce the artifact and implement
+    the artifact_paths(metadata) class method, returning the paths of all
+    the files it generates.
+
+    @param steps: list of GenericExecutionStep based classes
+    @type steps: list
+    @return: the new list of execution steps
+    @rtype: list
+    """
+    attrs = {'artifact_step': steps[-1]}
+    wrapped = [type("BuildCacheLookupHandler",
+                    (BuildCacheLookupHandler,), attrs)]
+    for step in steps:
+        wrapped.append(type(step.__name__, (_BuildCacheSkipMixin, step), {}))
+    wrapped.append(type("BuildCacheStoreHandler",
+                        (BuildCacheStoreHandler,), attrs))
+    return wrapped
+
+
 class LivecdSpec(GenericSpec):
 
     PLUGIN_API_VERSION = 1
@@ -714,6 +1714,14 @@ class LivecdSpec(GenericSpec):
                 'verifier': self._verify_command_arguments,
                 'parser': self._command_splitter,
             },
+            'chroot_cgroup': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'chroot_pid_namespace': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'release_string': {
                 'verifier': lambda x: len(x) != 0,  # validation callback
                 'parser': lambda x: x.strip(),  # value extractor
@@ -742,6 +1750,24 @@ class LivecdSpec(GenericSpec):
                 'verifier': lambda x: True,
                 'parser': self._command_splitter,
             },
+            'mirror_backend': {
+                'verifier': lambda x: x in (
+                    "rsync", "reflink", "btrfs-snapshot", "overlayfs",
+                    "native"),
+                'parser': lambda x: x.strip(),
+            },
+            'tree_copy_workers': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
+            'mirror_rsync_workers': {
+                'verifier': lambda x: x is not None and x > 0,
+                'parser': self._cast_integer,
+            },
+            'incremental_mirror': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'merge_destination_chroot': {
                 'verifier': os.path.isdir,
                 'parser': lambda x: x.strip(),
@@ -802,12 +1828,44 @@ class LivecdSpec(GenericSpec):
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'build_cache_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'generate_zsync': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
+            'chunk_store_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'checksum_algorithms': {
+                'verifier': artifact_utils.checksum_algorithms_supported,
+                'parser': self._comma_separate,
+            },
             'paths_to_empty': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'cleanup_report': {
+                'verifier': lambda x: os.path.isdir(
+                    os.path.dirname(os.path.abspath(x))),
+                'parser': lambda x: x.strip(),
+            },
+            'cleanup_report_top_dirs': {
+                'verifier': lambda x: x is not None and x > 0,
+                'parser': self._cast_integer,
+            },
+            'cleanup_dry_run': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
 
         }
 
     def execution_steps(self):
-        return [MirrorHandler, ChrootHandler, CdrootHandler, IsoHandler]
+        # resume the deletion of the trash left by interrupted builds
+        trash.resume()
+        return cacheable_steps(
+            [MirrorHandler, ChrootHandler, CdrootHandler, IsoHandler])
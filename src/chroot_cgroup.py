@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+_MOUNTS = "/proc/self/mounts"
+# controllers enabled for the hook cgroups, when possible
+_CONTROLLERS = ("cpu", "memory", "io")
+# runs the command in a new PID namespace, chrooted: all the processes
+# of the namespace are killed as soon as the command exits
+_UNSHARE = ["/usr/bin/unshare", "--pid", "--fork", "--kill-child"]
+
+STATS_KEYS = ("cpu_usec", "cpu_user_usec", "cpu_system_usec",
+              "memory_peak", "io_rbytes", "io_wbytes")
+
+
+def mount_point():
+    """
+    Return the mount point of the cgroup v2 hierarchy, None if there is
+    none.
+    """
+    try:
+        with open(_MOUNTS, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == "cgroup2":
+                    return fields[1]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (IOError, OSError) as err:
+        if err.errno in (errno.ENOENT, errno.ENODEV, errno.EOPNOTSUPP):
+            return None
+        raise
+
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+class HookCgroup(object):
+    """
+    A cgroup (v2) containing a chroot hook and all its children, so that
+    they can be accounted and killed as a whole. It is created below the
+    parent cgroup, itself created if missing.
+    """
+
+    def __init__(self, parent, name):
+        """
+        @param parent: parent cgroup path, relative to the cgroup v2 mount
+            point
+        @type parent: string
+        @param name: cgroup name prefix
+        @type name: string
+        @raises OSError: if there is no cgroup v2 hierarchy
+        """
+        root = mount_point()
+        if root is None:
+            raise OSError(errno.ENOENT, "cgroup v2 hierarchy not mounted")
+        self._parent = os.path.join(root, parent.strip(os.sep))
+        self._name = name
+        self.path = None
+
+    def create(self):
+        """
+        Create the cgroup, enabling the CPU, memory and I/O controllers
+        for it when the parent cgroup allows.
+        """
+        if not os.path.isdir(self._parent):
+            os.makedirs(self._parent)
+        available = (_read(os.path.join(
+            self._parent, "cgroup.controllers")) or "").split()
+        for controller in _CONTROLLERS:
+            if controller not in available:
+                continue
+            try:
+                _write(os.path.join(self._parent, "cgroup.subtree_control"),
+                       "+" + controller)
+            except (IOError, OSError):
+                # the parent cgroup has processes of its own
+                pass
+        self.path = tempfile.mkdtemp(prefix=self._name + ".",
+                                     dir=self._parent)
+
+    def attach(self):
+        """
+        Move the calling process into the cgroup. Meant to be called by
+        the child process, before exec.
+        """
+        _write(os.path.join(self.path, "cgroup.procs"), str(os.getpid()))
+
+    def populated(self):
+        events = _read(os.path.join(self.path, "cgroup.events")) or ""
+        for line in events.splitlines():
+            key, _sep, value = line.partition(" ")
+            if key == "populated":
+                return value.strip() == "1"
+        return bool((_read(os.path.join(self.path, "cgroup.procs")) or
+                     "").split())
+
+    def kill(self, timeout=10.0):
+        """
+        Kill all the processes in the cgroup, with a single write to
+        cgroup.kill (Linux >= 5.14), or by freezing the cgroup and killing
+        them one by one. Return whether the cgroup got empty within
+        timeout seconds.
+        """
+        kill_file = os.path.join(self.path, "cgroup.kill")
+        if os.path.exists(kill_file):
+            _write(kill_file, "1")
+        else:
+            freeze_file = os.path.join(self.path, "cgroup.freeze")
+            frozen = os.path.exists(freeze_file)
+            if frozen:
+                _write(freeze_file, "1")
+            try:
+                procs = _read(os.path.join(self.path, "cgroup.procs")) or ""
+                for pid in procs.split():
+                    try:
+                        os.kill(int(pid), signal.SIGKILL)
+                    except OSError as err:
+                        if err.errno != errno.ESRCH:
+                            raise
+            finally:
+                if frozen:
+                    _write(freeze_file, "0")
+
+        deadline = time.time() + timeout
+        while self.populated():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        """
+        Return the resources used by the cgroup processes so far. Values
+        whose controller is not enabled are None, as well as the peak
+        memory usage on kernels older than 5.19.
+
+        @return: dict composed by CPU time (total, user, system) in
+            microseconds, peak memory usage and bytes read and written
+        @rtype: dict
+        """
+        stats = dict((k, None) for k in STATS_KEYS)
+        cpu = _read(os.path.join(self.path, "cpu.stat")) or ""
+        for line in cpu.splitlines():
+            key, _sep, value = line.partition(" ")
+            if key == "usage_usec":
+                stats["cpu_usec"] = int(value)
+            elif key == "user_usec":
+                stats["cpu_user_usec"] = int(value)
+            elif key == "system_usec":
+                stats["cpu_system_usec"] = int(value)
+
+        # memory.peak needs Linux >= 5.19, memory.current is not a peak
+        # at all (the processes are gone by now)
+        value = _read(os.path.join(self.path, "memory.peak"))
+        if value is not None:
+            stats["memory_peak"] = int(value)
+
+        io = _read(os.path.join(self.path, "io.stat"))
+        if io is not None:
+            stats["io_rbytes"] = stats["io_wbytes"] = 0
+            for line in io.splitlines():
+                for field in line.split()[1:]:
+                    key, _sep, value = field.partition("=")
+                    if key == "rbytes":
+                        stats["io_rbytes"] += int(value)
+                    elif key == "wbytes":
+                        stats["io_wbytes"] += int(value)
+        return stats
+
+    def remove(self):
+        """
+        Remove the cgroup, return whether it was possible: it is not while
+        processes are left in it.
+        """
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            return False
+        return True
+
+
+def exec_chroot_cmd(args, chroot, cgroup, pre_chroot=None, env=None,
+                    pid_namespace=False):
+    """
+    Execute a command inside chroot, like molecule.utils.exec_chroot_cmd,
+    in the given cgroup, and optionally in a new PID namespace.
+
+    @param args: command arguments
+    @type args: list
+    @param chroot: chroot directory
+    @type chroot: string
+    @param cgroup: created cgroup
+    @type cgroup: HookCgroup
+    @keyword pre_chroot: command prefix, like linux32
+    @type pre_chroot: list
+    @keyword env: environment
+    @type env: dict
+    @keyword pid_namespace: run in a new PID namespace, requires
+        util-linux unshare
+    @type pid_namespace: bool
+    @return: command exit status
+    @rtype: int
+    """
+    args = list(pre_chroot or []) + list(args)
+    if pid_namespace:
+        args = _UNSHARE + ["--root=" + chroot, "--wd=/"] + args
+
+        def _preexec():
+            cgroup.attach()
+    else:
+        def _preexec():
+            cgroup.attach()
+            os.chroot(chroot)
+            os.chdir("/")
+
+    proc = subprocess.Popen(args, env=env, preexec_fn=_preexec)
+    return proc.wait()
@@ -0,0 +1,672 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import collections
+import errno
+import fnmatch
+import glob
+import os
+import re
+import stat
+import threading
+
+from . import trash
+from . import tree_copy
+
+# trashed: directories moved to the trash, their content is not counted:
+# sizing it would delay the cleanup as much as removing it
+STATS_KEYS = ("files", "dirs", "bytes", "trashed")
+
+
+def _entries(path):
+    """
+    Yield (path, lstat result) for every entry of the directory at path.
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                yield entry.path, entry.stat(follow_symlinks=False)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        return
+
+    for name in os.listdir(path):
+        entry_path = os.path.join(path, name)
+        try:
+            yield entry_path, os.lstat(entry_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def _is_below(path, directory):
+    return path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _is_inside(real_root, real_path):
+    return real_path == real_root or _is_below(real_path, real_root)
+
+
+class _Node(object):
+
+    __slots__ = ("index", "literals", "globs", "any_globs")
+
+    def __init__(self):
+        # lowest index of the patterns ending here, if any
+        self.index = None
+        # name => _Node
+        self.literals = {}
+        # first character => list of (compiled segment, _Node), for the
+        # segments starting with a literal character
+        self.globs = {}
+        # list of (compiled segment, _Node), for the other segments
+        self.any_globs = []
+
+
+class PatternSet(object):
+    """
+    A set of shell glob path patterns, like /usr/portage/distfiles/*,
+    compiled into a prefix tree of path components, so that the paths
+    matching any of them are found by visiting every directory once,
+    no matter how many patterns share it. Wildcards match dot files only
+    if the pattern component starts with a dot, as in the shell.
+    """
+
+    def __init__(self, patterns):
+        self._root = _Node()
+        self._segments = {}
+        for index, pattern in enumerate(patterns):
+            self._add(index, pattern)
+
+    def _compile(self, segment):
+        regex = self._segments.get(segment)
+        if regex is None:
+            regex = re.compile(fnmatch.translate(segment))
+            self._segments[segment] = regex
+        return regex
+
+    def _add(self, index, pattern):
+        node = self._root
+        path = os.path.normpath(pattern.lstrip(os.sep))
+        for segment in path.split(os.sep):
+            if segment in ("", "."):
+                continue
+            if not glob.has_magic(segment):
+                node = node.literals.setdefault(segment, _Node())
+                continue
+            if segment[0] in "*?[":
+                globs = node.any_globs
+            else:
+                globs = node.globs.setdefault(segment[0], [])
+            regex = self._compile(segment)
+            for other, child in globs:
+                if other is regex:
+                    node = child
+                    break
+            else:
+                child = _Node()
+                globs.append((regex, child))
+                node = child
+        if node is self._root:
+            raise ValueError("pattern matching the whole tree: %s" % (
+                pattern,))
+        if node.index is None or index < node.index:
+            node.index = index
+
+    @staticmethod
+    def _next_nodes(nodes, name):
+        matched = []
+        for node in nodes:
+            child = node.literals.get(name)
+            if child is not None:
+                matched.append(child)
+            if name[0] == ".":
+                candidates = node.globs.get(".", ())
+            else:
+                candidates = node.globs.get(name[0], []) + node.any_globs
+            for regex, child in candidates:
+                if regex.match(name):
+                    matched.append(child)
+        return matched
+
+    def match(self, root):
+        """
+        Return the existing paths below root matching any pattern, with
+        the index of the first matching pattern. The content of matching
+        directories is not looked at. Symlinks are followed, but for the
+        last path component.
+
+        @param root: directory patterns are relative to
+        @type root: string
+        @return: dict composed by absolute path -> pattern index
+        @rtype: dict
+        """
+        matches = {}
+        stack = [(root, [self._root])]
+        while stack:
+            directory, nodes = stack.pop()
+            if any(x.globs or x.any_globs for x in nodes):
+                try:
+                    names = os.listdir(directory)
+                except OSError as err:
+                    if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                        continue
+                    raise
+            else:
+                names = set()
+                for node in nodes:
+                    names.update(node.literals)
+
+            for name in names:
+                children = self._next_nodes(nodes, name)
+                if not children:
+                    continue
+                path = os.path.join(directory, name)
+                indexes = [x.index for x in children if x.index is not None]
+                if indexes:
+                    if os.path.lexists(path):
+                        matches[path] = min(indexes)
+                    continue
+                if os.path.isdir(path):
+                    stack.append((path, children))
+        return matches
+
+
+class _WalkPool(object):
+    """
+    Visit directory trees with a pool of threads. visit is called with
+    every queued item and returns the items to queue next.
+    """
+
+    def __init__(self, visit, workers):
+        self._visit = visit
+        self._workers = workers
+        self._queue = collections.deque()
+        # items queued or being visited
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._error = None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._pending and \
+                        self._error is None:
+                    self._cond.wait()
+                if not self._queue or self._error is not None:
+                    return
+                item = self._queue.pop()
+
+            error = None
+            children = ()
+            try:
+                children = self._visit(item)
+            except Exception as err:
+                # raised by run(), whatever it is
+                error = err
+            finally:
+                # never leave the pending count unbalanced, or the other
+                # workers wait forever
+                with self._cond:
+                    self._pending -= 1
+                    if error is not None and self._error is None:
+                        self._error = error
+                    for child in children:
+                        self._pending += 1
+                        self._queue.append(child)
+                    self._cond.notify_all()
+
+    def run(self, items):
+        self._queue.extend(items)
+        self._pending = len(self._queue)
+        threads = []
+        for index in range(self._workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class _TreeRemover(object):
+    """
+    Remove directory trees with a pool of threads: directory content is
+    unlinked concurrently, empty directories are removed at the end,
+    deepest first. Removed files and bytes are accounted per tree owner.
+    File systems mounted on the trees, or inside them, are not touched:
+    they are collected into mount_points and their parent directories are
+    left in place.
+    """
+
+    def __init__(self, workers, mount_ids=()):
+        self._workers = workers
+        # (st_dev, st_ino) of the mount points, to find the bind mounts
+        # of the same file system too
+        self._mount_ids = frozenset(mount_ids)
+        self._stats = {}
+        self._dirs = []
+        self._lock = threading.Lock()
+        self.mount_points = []
+
+    def _is_mount_point(self, st, parent_dev):
+        return st.st_dev != parent_dev or \
+            (st.st_dev, st.st_ino) in self._mount_ids
+
+    def _account(self, owner, key, value):
+        with self._lock:
+            self._stats[owner][key] += value
+
+    def _unlink(self, owner, path, st):
+        os.unlink(path)
+        self._account(owner, "files", 1)
+        if stat.S_ISREG(st.st_mode):
+            self._account(owner, "bytes", st.st_size)
+
+    def _visit(self, item):
+        owner, path, dev = item
+        children = []
+        for entry_path, st in _entries(path):
+            if not stat.S_ISDIR(st.st_mode):
+                self._unlink(owner, entry_path, st)
+                continue
+            if self._is_mount_point(st, dev):
+                with self._lock:
+                    self.mount_points.append(entry_path)
+                continue
+            with self._lock:
+                self._dirs.append((owner, entry_path))
+            children.append((owner, entry_path, dev))
+        return children
+
+    def remove(self, trees):
+        """
+        Remove the given (owner, path) trees, not overlapping. Return the
+        stats by owner.
+        """
+        items = []
+        for owner, path in trees:
+            self._stats.setdefault(
+                owner, dict((k, 0) for k in STATS_KEYS))
+            try:
+                st = os.lstat(path)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+            if stat.S_ISDIR(st.st_mode):
+                if self._is_mount_point(
+                        st, os.stat(os.path.dirname(path)).st_dev):
+                    self.mount_points.append(path)
+                    continue
+                self._dirs.append((owner, path))
+                items.append((owner, path, st.st_dev))
+            else:
+                self._unlink(owner, path, st)
+
+        _WalkPool(self._visit, self._workers).run(items)
+
+        # the directories containing a mount point are not empty
+        keep = set()
+        for path in self.mount_points:
+            parent = os.path.dirname(path)
+            while parent not in keep and parent != os.path.dirname(parent):
+                keep.add(parent)
+                parent = os.path.dirname(parent)
+
+        self._dirs.sort(key=lambda x: x[1].count(os.sep), reverse=True)
+        for owner, path in self._dirs:
+            if path in keep:
+                continue
+            os.rmdir(path)
+            self._stats[owner]["dirs"] += 1
+        return self._stats
+
+
+class _TreeSizer(object):
+    """
+    Size directory trees with a pool of threads, like du -x. The trees to
+    clean up are accounted to their pattern, the rest of the chroot by
+    directory.
+    """
+
+    def __init__(self, workers, trees):
+        self._workers = workers
+        # path => owner
+        self._trees = trees
+        self._stats = {}
+        # directory => [bytes, files] of its own entries, the trees to
+        # clean up excluded
+        self.remaining = {}
+        self._lock = threading.Lock()
+
+    def _account(self, owner, path, st):
+        with self._lock:
+            if owner is None:
+                own = self.remaining[os.path.dirname(path)]
+                if stat.S_ISREG(st.st_mode):
+                    own[0] += st.st_size
+                own[1] += 1
+                return
+            stats = self._stats[owner]
+            if stat.S_ISDIR(st.st_mode):
+                stats["dirs"] += 1
+            else:
+                stats["files"] += 1
+                if stat.S_ISREG(st.st_mode):
+                    stats["bytes"] += st.st_size
+
+    def _visit(self, item):
+        owner, path, dev = item
+        children = []
+        for entry_path, st in _entries(path):
+            if owner is None and entry_path in self._trees:
+                # sized as a tree of its own
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                self._account(owner, entry_path, st)
+                continue
+            if owner is None:
+                with self._lock:
+                    self.remaining[entry_path] = [0, 0]
+            else:
+                self._account(owner, entry_path, st)
+            if st.st_dev == dev:
+                children.append((owner, entry_path, dev))
+        return children
+
+    def size(self, root):
+        """
+        Size the trees and the rest of root. Return the stats by owner.
+        """
+        root_st = os.lstat(root)
+        self.remaining[root] = [0, 0]
+        items = [(None, root, root_st.st_dev)]
+        for path, owner in self._trees.items():
+            self._stats.setdefault(owner, dict((k, 0) for k in STATS_KEYS))
+            try:
+                st = os.lstat(path)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+            self._account(owner, path, st)
+            if stat.S_ISDIR(st.st_mode):
+                items.append((owner, path, st.st_dev))
+
+        _WalkPool(self._visit, self._workers).run(items)
+        return self._stats
+
+
+def _check_matches(root, matches):
+    """
+    Make sure that the matches do not escape the chroot at root through
+    symlinks or "..", resolving every parent directory once. The last
+    path component is not resolved: a symlink is removed, not its target.
+    """
+    real_root = os.path.realpath(root)
+    parents = {}
+    for path in matches:
+        parent = os.path.dirname(path)
+        real_parent = parents.get(parent)
+        if real_parent is None:
+            real_parent = os.path.realpath(parent)
+            parents[parent] = real_parent
+        if not _is_inside(real_root, real_parent):
+            raise OSError(errno.EPERM, "path outside of the chroot", path)
+
+
+def _mount_points(root):
+    """
+    Return the real paths of the mount points below the chroot at root.
+    """
+    real_root = os.path.realpath(root)
+    return [x for x in trash.mount_points() if _is_below(x, real_root)]
+
+
+def _mount_ids(mount_points):
+    ids = set()
+    for path in mount_points:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        ids.add((st.st_dev, st.st_ino))
+    return ids
+
+
+def _contains_mount_point(path, mount_points):
+    real_path = os.path.join(os.path.realpath(os.path.dirname(path)),
+                             os.path.basename(path))
+    for mount_point in mount_points:
+        if mount_point == real_path or _is_below(mount_point, real_path):
+            return True
+    return False
+
+
+def _escape(path):
+    """
+    Escape the shell glob wildcards of path, so that a PatternSet matches
+    it literally.
+    """
+    return re.sub(r"([*?[])", r"[\1]", path)
+
+
+def _match_trees(root, empty_paths, remove_patterns):
+    """
+    Return the list of patterns, remove_patterns first, and the sorted
+    list of (pattern index, path) trees to remove, not overlapping.
+    """
+    # a directory both to empty and to remove is removed
+    patterns = list(remove_patterns) + list(empty_paths)
+    matches = PatternSet(list(remove_patterns) +
+                         [_escape(x) for x in empty_paths]).match(root)
+    _check_matches(root, matches)
+
+    owners = {}
+    for path, index in matches.items():
+        if index < len(remove_patterns):
+            owners[path] = index
+            continue
+        # emptying a directory is removing its content, like
+        # molecule.utils.empty_dir() does, following symlinks
+        if not os.path.isdir(path):
+            continue
+        if not _is_inside(os.path.realpath(root), os.path.realpath(path)):
+            raise OSError(errno.EPERM, "path outside of the chroot", path)
+        for name in os.listdir(path):
+            owners.setdefault(os.path.join(path, name), index)
+
+    trees = []
+    # parents sort before their content
+    for path in sorted(owners, key=lambda x: x.split(os.sep)):
+        if trees and _is_below(path, trees[-1][1]):
+            continue
+        trees.append((owners[path], path))
+    return patterns, trees
+
+
+def cleanup(root, empty_paths, remove_patterns, workers=None,
+            defer=True, on_mount_point=None):
+    """
+    Empty the directories at empty_paths, matched literally, and remove
+    the paths matching remove_patterns, shell glob patterns, from the
+    chroot at root. Both are relative to root. They are all compiled into
+    a PatternSet, matched in a single walk, and the resulting trees are
+    removed at once with a pool of threads. Paths below another matching
+    path are removed with it and accounted to the pattern matching the
+    latter (the first one, remove_patterns first, if several do). File systems mounted
+    inside root are left in place, along with their parent directories.
+
+    If defer is True, matching directories are moved to the trash of
+    their file system instead, and deleted in background by a reaper
+    process (see the trash module). This is not possible for file
+    systems mounted inside root, whose trash would be packed. Trashed
+    directories are just counted: their content is not walked, so it is
+    not part of files, dirs and bytes (see report() for sizes).
+
+    @param root: chroot directory
+    @type root: string
+    @param empty_paths: list of directory paths
+    @type empty_paths: list
+    @param remove_patterns: list of path patterns
+    @type remove_patterns: list
+    @keyword workers: number of threads, tree_copy.default_workers() if
+        None
+    @type workers: int
+    @keyword defer: move directories to the trash
+    @type defer: bool
+    @keyword on_mount_point: function called with every mount point left
+        in place
+    @type on_mount_point: callable
+    @return: two lists, for empty_paths and remove_patterns, of
+        (pattern, stats) tuples, in patterns order, where stats is a dict
+        composed by removed files, dirs and bytes, and trashed
+        directories
+    @rtype: tuple
+    @raises OSError: if any match is outside root (EPERM) or if the
+        removal fails
+    @raises ValueError: if a pattern matches root itself
+    """
+    if not workers:
+        workers = tree_copy.default_workers()
+
+    patterns, trees = _match_trees(root, empty_paths, remove_patterns)
+    stats = [dict((k, 0) for k in STATS_KEYS) for x in patterns]
+    mount_points = _mount_points(root)
+    trash_dirs = set()
+    if defer:
+        remaining = []
+        for owner, path in trees:
+            directory = None
+            if os.path.isdir(path) and not os.path.islink(path) and \
+                    not _contains_mount_point(path, mount_points):
+                directory = trash.move(path, outside=root)
+            if directory is None:
+                remaining.append((owner, path))
+                continue
+            trash_dirs.add(directory)
+            stats[owner]["trashed"] += 1
+        trees = remaining
+
+    remover = _TreeRemover(workers, _mount_ids(mount_points))
+    try:
+        removed = remover.remove(trees)
+    finally:
+        trash.reap_later(trash_dirs)
+    for owner, owner_stats in removed.items():
+        for key, value in owner_stats.items():
+            stats[owner][key] += value
+    if on_mount_point is not None:
+        for path in sorted(remover.mount_points):
+            on_mount_point(path)
+
+    results = list(zip(patterns, stats))
+    return results[len(remove_patterns):], results[:len(remove_patterns)]
+
+
+def report(root, empty_paths, remove_patterns, top=20, workers=None):
+    """
+    Report the space the cleanup patterns would reclaim from the chroot
+    at root, removing nothing: what cleanup() would remove, by pattern,
+    and the largest directories left, like du -x. Sizes are apparent
+    sizes, hardlinked files are counted once per link.
+
+    @param root: chroot directory
+    @type root: string
+    @param empty_paths: list of directory paths
+    @type empty_paths: list
+    @param remove_patterns: list of path patterns
+    @type remove_patterns: list
+    @keyword top: number of largest directories to report
+    @type top: int
+    @keyword workers: number of threads, tree_copy.default_workers() if
+        None
+    @type workers: int
+    @return: JSON serializable dict composed by "patterns" (list of dicts
+        composed by pattern, type ("empty" or "remove"), files, dirs and
+        bytes), "remaining" (dict composed by files, dirs and bytes left)
+        and "top_dirs" (list of dicts composed by path, relative to root
+        but absolute, files and bytes, recursively, largest first)
+    @rtype: dict
+    @raises OSError: if any match is outside root (EPERM) or if the
+        tree cannot be read
+    @raises ValueError: if a pattern matches root itself
+    """
+    if not workers:
+        workers = tree_copy.default_workers()
+
+    patterns, trees = _match_trees(root, empty_paths, remove_patterns)
+    # paths as found walking the chroot, trees may be below symlinks
+    real_root = os.path.realpath(root)
+    real_trees = {}
+    for owner, path in trees:
+        real_path = os.path.join(
+            os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        real_trees[real_path] = owner
+
+    sizer = _TreeSizer(workers, real_trees)
+    stats = sizer.size(real_root)
+    empty = dict((k, 0) for k in STATS_KEYS)
+
+    pattern_stats = []
+    for index, pattern in enumerate(patterns):
+        owner_stats = stats.get(index, empty)
+        if index < len(remove_patterns):
+            pattern_type = "remove"
+        else:
+            pattern_type = "empty"
+        pattern_stats.append({
+            'pattern': pattern,
+            'type': pattern_type,
+            'files': owner_stats["files"],
+            'dirs': owner_stats["dirs"],
+            'bytes': owner_stats["bytes"],
+        })
+    # in configuration order
+    pattern_stats = pattern_stats[len(remove_patterns):] + \
+        pattern_stats[:len(remove_patterns)]
+
+    # sum up own sizes into the parents, deepest first
+    totals = dict((k, list(v)) for k, v in sizer.remaining.items())
+    for path in sorted(totals, key=lambda x: x.count(os.sep),
+                       reverse=True):
+        if path == real_root:
+            continue
+        parent = totals[os.path.dirname(path)]
+        parent[0] += totals[path][0]
+        parent[1] += totals[path][1]
+
+    root_bytes, root_files = totals.pop(real_root)
+    largest = sorted(totals.items(), key=lambda x: (-x[1][0], x[0]))[:top]
+    return {
+        'patterns': pattern_stats,
+        'remaining': {
+            'files': root_files,
+            'dirs': len(totals),
+            'bytes': root_bytes,
+        },
+        'top_dirs': [{
+            'path': os.sep + os.path.relpath(path, real_root),
+            'files': files,
+            'bytes': size,
+        } for path, (size, files) in largest],
+    }
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import argparse
+import errno
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+
+INDEX_VERSION = 1
+INDEX_EXT = ".index"
+
+CHUNK_MIN_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 1024 * 1024
+# after CHUNK_MIN_SIZE bytes, a boundary is found every 2^CHUNK_MASK_BITS
+# bytes on average
+CHUNK_MASK_BITS = 18
+
+# Every byte value is mapped to a pseudo random fingerprint bit, half of
+# them to 1. A boundary follows every CHUNK_MASK_BITS bytes whose bits
+# match _BOUNDARY. _BOUNDARY has no border (no prefix equal to a suffix),
+# so two matches never overlap.
+_ORDER = sorted(range(256), key=lambda x: hashlib.sha256(
+    b"molecule-cdc" + struct.pack("B", x)).digest())
+_FINGERPRINT = bytes(bytearray(
+    ord("1") if _ORDER.index(x) < 128 else ord("0") for x in range(256)))
+_BOUNDARY = b"1" * (CHUNK_MASK_BITS // 2) + \
+    b"0" * (CHUNK_MASK_BITS - CHUNK_MASK_BITS // 2)
+
+
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+def chunk_path(store_dir, digest):
+    return os.path.join(store_dir, "chunks", digest[:2], digest)
+
+
+def index_path(store_dir, name):
+    return os.path.join(store_dir, "indexes", name + INDEX_EXT)
+
+
+def _atomic_write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o755)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        with os.fdopen(tmp_fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ChunkStoreWriter(object):
+    """
+    Split a stream of data into content-defined chunks and store them into
+    the chunk store. It can be fed like a hashlib object, so artifacts are
+    chunked in the same pass computing their checksums.
+
+    Chunk boundaries depend on the content only (see _BOUNDARY), so data
+    shared by two artifacts produces the same chunks even if shifted.
+    Boundaries are searched for past CHUNK_MIN_SIZE bytes only, with
+    bytes.translate() and find(), which run at hundreds of MB/s: a rolling
+    hash computed byte by byte in Python would not. Every chunk is stored
+    once, as chunks/<xy>/<sha256>, and every artifact gets an index
+    listing its chunks, as indexes/<artifact name>.index.
+    """
+
+    def __init__(self, store_dir, name):
+        self.store_dir = store_dir
+        self.name = name
+        self.length = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self._sha256 = hashlib.sha256()
+        self.chunks = []
+        # data not cut into chunks yet, and its fingerprint bits
+        self._buffer = bytearray()
+        self._fingerprints = bytearray()
+        # buffer offset where a boundary match can still begin
+        self._scanned = 0
+
+    def _emit(self, start, end):
+        chunk = bytes(self._buffer[start:end])
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = chunk_path(self.store_dir, digest)
+        if not os.path.exists(path):
+            _atomic_write(path, chunk)
+            self.new_chunks += 1
+            self.new_bytes += len(chunk)
+        self.chunks.append([digest, len(chunk)])
+
+    def _next_boundary(self, start):
+        """
+        Return the end of the chunk starting at start, or None if more
+        data is needed to find it.
+        """
+        limit = min(len(self._buffer), start + CHUNK_MAX_SIZE)
+        lower = max(start + CHUNK_MIN_SIZE - len(_BOUNDARY), self._scanned)
+        pos = self._fingerprints.find(_BOUNDARY, lower, limit)
+        if pos != -1:
+            self._scanned = pos + len(_BOUNDARY)
+            return self._scanned
+        if limit == start + CHUNK_MAX_SIZE:
+            self._scanned = limit
+            return limit
+        # a match may begin in the last bytes, and end in the next ones
+        self._scanned = max(lower, limit - len(_BOUNDARY) + 1)
+        return None
+
+    def update(self, data):
+        self._sha256.update(data)
+        self.length += len(data)
+        self._buffer += data
+        self._fingerprints += _to_bytes(data).translate(_FINGERPRINT)
+
+        start = 0
+        while True:
+            end = self._next_boundary(start)
+            if end is None:
+                break
+            self._emit(start, end)
+            start = end
+        del self._buffer[:start]
+        del self._fingerprints[:start]
+        self._scanned -= start
+
+    def finish(self):
+        """
+        Store the last chunk and write the artifact index. No more data
+        can be fed afterwards.
+
+        @return: the index path
+        @rtype: string
+        """
+        if self._buffer:
+            self._emit(0, len(self._buffer))
+            self._buffer = bytearray()
+            self._fingerprints = bytearray()
+
+        index = {
+            'version': INDEX_VERSION,
+            'name': self.name,
+            'length': self.length,
+            'sha256': self._sha256.hexdigest(),
+            'chunks': self.chunks,
+        }
+        path = index_path(self.store_dir, self.name)
+        _atomic_write(path, json.dumps(index).encode("utf-8"))
+        return path
+
+
+def reassemble(store_dir, index_file, dest):
+    """
+    Rebuild an artifact out of its index and the chunk store, verifying
+    every chunk and the whole artifact digest. dest is replaced only if
+    verification succeeds.
+
+    @param store_dir: chunk store directory
+    @type store_dir: string
+    @param index_file: artifact index path
+    @type index_file: string
+    @param dest: destination path
+    @type dest: string
+    @raises IOError: if a chunk is missing or corrupted, or if the
+        reassembled artifact doesn't match the index
+    """
+    with open(index_file, "r") as f:
+        index = json.load(f)
+
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".")
+    try:
+        sha256 = hashlib.sha256()
+        zeroes = {}
+        with os.fdopen(tmp_fd, "wb") as f:
+            for digest, length in index['chunks']:
+                with open(chunk_path(store_dir, digest), "rb") as chunk_f:
+                    chunk = chunk_f.read()
+                if len(chunk) != length or \
+                        hashlib.sha256(chunk).hexdigest() != digest:
+                    raise IOError(errno.EIO, "corrupted chunk %s" % (digest,))
+                sha256.update(chunk)
+                zero = zeroes.get(length)
+                if zero is None:
+                    zero = zeroes.setdefault(length, b"\0" * length)
+                if chunk == zero:
+                    # keep holes sparse
+                    f.seek(length, os.SEEK_CUR)
+                else:
+                    f.write(chunk)
+            f.truncate()
+
+        if os.path.getsize(tmp_path) != index['length'] or \
+                sha256.hexdigest() != index['sha256']:
+            raise IOError(errno.EIO, "%s verification failed" % (
+                index['name'],))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, dest)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def collect_garbage(store_dir):
+    """
+    Remove the chunks not referenced by any index, to be run after old
+    indexes are removed.
+
+    @return: tuple composed by (removed chunks, freed bytes)
+    @rtype: tuple
+    """
+    referenced = set()
+    indexes_dir = os.path.join(store_dir, "indexes")
+    if os.path.isdir(indexes_dir):
+        for name in os.listdir(indexes_dir):
+            if not name.endswith(INDEX_EXT):
+                continue
+            with open(os.path.join(indexes_dir, name), "r") as f:
+                for digest, _length in json.load(f)['chunks']:
+                    referenced.add(digest)
+
+    removed = 0
+    freed = 0
+    chunks_dir = os.path.join(store_dir, "chunks")
+    for root, _dirs, files in os.walk(chunks_dir):
+        for name in files:
+            if name in referenced:
+                continue
+            path = os.path.join(root, name)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+    return removed, freed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Molecule artifacts chunk store")
+    subparsers = parser.add_subparsers(dest="command")
+    reassemble_parser = subparsers.add_parser(
+        "reassemble", help="rebuild and verify an artifact")
+    reassemble_parser.add_argument("store", help="chunk store directory")
+    reassemble_parser.add_argument("index", help="artifact index file")
+    reassemble_parser.add_argument("dest", help="destination path")
+    gc_parser = subparsers.add_parser(
+        "gc", help="remove the chunks not referenced by any index")
+    gc_parser.add_argument("store", help="chunk store directory")
+    args = parser.parse_args(argv)
+
+    if args.command == "reassemble":
+        try:
+            reassemble(args.store, args.index, args.dest)
+        except (IOError, OSError, ValueError, KeyError) as err:
+            sys.stderr.write("reassembly failed: %s\n" % (err,))
+            return 1
+        sys.stdout.write("%s: OK\n" % (args.dest,))
+        return 0
+
+    if args.command == "gc":
+        removed, freed = collect_garbage(args.store)
+        sys.stdout.write("removed %d chunks, %d bytes freed\n" % (
+            removed, freed))
+        return 0
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -16,61 +16,90 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-import array
+import multiprocessing
 import os
 import shutil
 import tempfile
-import gc
-import errno
 
+from molecule.compat import get_stringtype
 from molecule.i18n import _
 from molecule.output import blue, darkred
 from molecule.specs.skel import GenericExecutionStep, GenericSpec
 
 import molecule.utils
 
-from .builtin_plugin import BuiltinHandlerMixin
+from .builtin_plugin import BuiltinHandlerMixin, cacheable_steps
+from .builtin_plugin import CdrootHandler as BuiltinCdrootHandler
+from . import artifact_utils
+from . import image_utils
+from . import loop_device
+from . import trash
 from .remaster_plugin import IsoUnpackHandler as RemasterIsoUnpackHandler, \
     ChrootHandler as RemasterChrootHandler
 
+SUPPORTED_IMAGE_ALLOCATION_METHODS = ["sparse", "fallocate", "zero", "random"]
+SUPPORTED_IMAGE_COMPACTION_METHODS = ["none", "trim", "shrink"]
+SUPPORTED_IMAGE_POPULATION_METHODS = ["mount", "direct"]
+SUPPORTED_IMAGE_OUTPUT_COMPRESSION_METHODS = ["none", "zstd", "xz", "gzip"]
+IMAGE_MB_AUTO_RE = image_utils.IMAGE_MB_AUTO_RE
+
+
+def _direct_population(metadata):
+    """
+    Return whether the image filesystem is built straight from the
+    unpacked chroot, without loop devices and mounts.
+    """
+    return metadata.get('image_population', "mount") == "direct"
+
 
 class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
     LOSETUP_EXEC = "/sbin/losetup"
+    FSTRIM_EXEC = "/sbin/fstrim"
+    E2FSCK_EXEC = "/sbin/e2fsck"
+    RESIZE2FS_EXEC = "/sbin/resize2fs"
+    DUMPE2FS_EXEC = "/sbin/dumpe2fs"
     MB_IN_BYTES = 1024000
+    DEFAULT_COMPACTION_HEADROOM = 10
     DEFAULT_IMAGE_FORMATTER = ["/sbin/mkfs.ext3"]
     DEFAULT_IMAGE_MOUNTER = ["/bin/mount", "-o", "loop,rw"]
     DEFAULT_IMAGE_UMOUNTER = ["/bin/umount"]
 
+    # image_mb: auto sizing parameters
+    AUTO_DEFAULT_HEADROOM = 10
+    AUTO_FS_OVERHEAD_MB = 64
+    AUTO_INODE_SIZE = 256
+    AUTO_RESERVED_PERCENT = 5
+    AUTO_MIN_BYTES_PER_INODE = 1024
+    AUTO_MAX_BYTES_PER_INODE = 67108864
+    EXT_FORMATTERS = ("mkfs.ext2", "mkfs.ext3", "mkfs.ext4", "mke2fs")
+
     def __init__(self, *args, **kwargs):
         super(ImageHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
 
         # init variables
         self.loop_device = None
+        self._loop = None
         self._tmp_loop_device_fd = None
         self.tmp_loop_device_file = None
         self.image_mb = 0
-        self.randomize = False
+        self.image_formatter_args = []
+        self.allocation = "sparse"
         self.image_mounted = False
         self.tmp_image_mount = None
+        self.direct_population = False
 
     def setup(self):
 
         self.image_mb = self.metadata['image_mb']
+        # image_randomize is kept for backward compatibility, an explicit
+        # image_allocation always wins
         if self.metadata.get('image_randomize') == "yes":
-            self.randomize = True
+            self.allocation = "random"
+        self.allocation = self.metadata.get('image_allocation',
+                                            self.allocation)
 
-        sts, loop_device = molecule.utils.exec_cmd_get_status_output(
-            [ImageHandler.LOSETUP_EXEC, "-f"])
-        if sts != 0:
-            # ouch
-            self._output.output("[%s|%s] %s: %s" % (
-                    blue("ImageHandler"), darkred(self.spec_name),
-                    _("setup hook failed"), _("cannot setup loop device"),
-                )
-            )
-            return sts
         try:
             self._tmp_loop_device_fd, self.tmp_loop_device_file = \
                 tempfile.mkstemp(prefix="molecule", dir=self._config['tmp_dir'])
@@ -82,20 +111,27 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
             )
             return 1
 
-        # bind loop device
-        args = [ImageHandler.LOSETUP_EXEC, loop_device,
-                self.tmp_loop_device_file]
-        rc = molecule.utils.exec_cmd(args)
-        if rc != 0:
-            self._output.output("[%s|%s] %s: %s" % (
-                    blue("ImageHandler"), darkred(self.spec_name),
-                    _("setup hook failed"), _("cannot bind loop device"),
-                )
+        self.direct_population = _direct_population(self.metadata)
+        if self.direct_population:
+            image_formatter = self.metadata.get(
+                'image_formatter',
+                ImageHandler.DEFAULT_IMAGE_FORMATTER
             )
-            return 1
-        self.loop_device = loop_device
-
-        self.tmp_image_mount = molecule.utils.mkdtemp()
+            formatter_name = os.path.basename(image_formatter[0])
+            if formatter_name not in ImageHandler.EXT_FORMATTERS:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("ImageHandler"), darkred(self.spec_name),
+                        _("setup hook failed"),
+                        _("direct image population requires an ext* "
+                          "formatter"),
+                    )
+                )
+                return 1
+        else:
+            rc = self._attach_loop_device()
+            if rc != 0:
+                return rc
+            self.tmp_image_mount = molecule.utils.mkdtemp()
 
         # setup metadata for next phases
         self.metadata['ImageHandler_loop_device_file'] = \
@@ -103,6 +139,8 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         self.metadata['ImageHandler_tmp_image_mount'] = self.tmp_image_mount
         self.metadata['ImageHandler_loop_device'] = self.loop_device
         self.metadata['ImageHandler_kill_loop_device'] = self._kill_loop_device
+        self.metadata['ImageHandler_compact_image'] = self._compact_image
+        self.metadata['ImageHandler_populate_image'] = self._populate_image
 
         return 0
 
@@ -118,7 +156,8 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if exec_script:
             env = os.environ.copy()
             env['TMP_IMAGE_PATH'] = self.tmp_loop_device_file
-            env['LOOP_DEVICE'] = self.loop_device
+            if self.loop_device is not None:
+                env['LOOP_DEVICE'] = self.loop_device
             self._output.output("[%s|%s] %s: %s" % (
                     blue("ImageHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -135,50 +174,77 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
         return 0
 
-    def _fill_image_file(self):
+    def _attach_loop_device(self):
         """
-        Fill image file (using _tmp_loop_device_fd) with either zeroes or
-        random data of image_mb size.
-
-        @raises IOError: if space is not enough
-        @raises OSError: well, sorry
+        Claim a free loop device and bind the temporary image file to it.
+        loop-control is used when available, so that claiming and binding
+        happen in one step, losetup otherwise.
         """
-        if self.randomize:
-            self._output.output("[%s|%s] %s => %s" % (
+        if loop_device.supported():
+            direct_io = self.metadata.get('image_loop_direct_io') == "yes"
+            try:
+                self._loop = loop_device.attach(self.tmp_loop_device_file,
+                                                direct_io=direct_io)
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s: %s" % (
+                        blue("ImageHandler"), darkred(self.spec_name),
+                        _("setup hook failed"), _("cannot bind loop device"),
+                        err,
+                    )
+                )
+                return 1
+            self.loop_device = self._loop.path
+            if direct_io and not self._loop.direct_io:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("ImageHandler"), darkred(self.spec_name),
+                        _("direct I/O not supported"), self.loop_device,
+                    )
+                )
+            return 0
+
+        sts, loop_dev = molecule.utils.exec_cmd_get_status_output(
+            [ImageHandler.LOSETUP_EXEC, "-f"])
+        if sts != 0:
+            # ouch
+            self._output.output("[%s|%s] %s: %s" % (
                     blue("ImageHandler"), darkred(self.spec_name),
-                    _("generating random base image file"),
-                    self.tmp_loop_device_file,
+                    _("setup hook failed"), _("cannot setup loop device"),
                 )
             )
-        else:
-            self._output.output("[%s|%s] %s => %s" % (
+            return sts
+
+        # bind loop device
+        args = [ImageHandler.LOSETUP_EXEC, loop_dev,
+                self.tmp_loop_device_file]
+        rc = molecule.utils.exec_cmd(args)
+        if rc != 0:
+            self._output.output("[%s|%s] %s: %s" % (
                     blue("ImageHandler"), darkred(self.spec_name),
-                    _("generating zeroed base image file"),
-                    self.tmp_loop_device_file,
+                    _("setup hook failed"), _("cannot bind loop device"),
                 )
             )
+            return 1
+        self.loop_device = loop_dev
+        return 0
 
-        image_mb = self.image_mb
-        loop_f = os.fdopen(self._tmp_loop_device_fd, "wb")
-        self._tmp_loop_device_fd = None
-        arr = None
-        mb_bytes = ImageHandler.MB_IN_BYTES
-        while image_mb > 0:
-            image_mb -= 1
-            if self.randomize:
-                arr = array.array('c', os.urandom(mb_bytes))
-            else:
-                arr = array.array('c', chr(0)*mb_bytes)
-            arr.tofile(loop_f)
-
-        del arr
-        gc.collect()
-        # file self._tmp_loop_device_fd is closed here.
-        # no more writes needed
-        loop_f.flush()
-        loop_f.close()
+    def _refresh_loop_device(self):
+        """
+        Tell the loop device that the image file size changed.
+        """
+        if self.loop_device is None:
+            return 0
+        if self._loop is not None:
+            try:
+                self._loop.set_capacity()
+            except (IOError, OSError) as err:
+                self._output.output("[%s|%s] %s: %s" % (
+                        blue("ImageHandler"), darkred(self.spec_name),
+                        _("image file resize failed"), err,
+                    )
+                )
+                return 1
+            return 0
 
-        # last but not least, tell the loop device that the file size changed
         args = [ImageHandler.LOSETUP_EXEC, "-c", self.loop_device]
         self._output.output("[%s|%s] %s: %s" % (
                 blue("ImageHandler"), darkred(self.spec_name),
@@ -194,18 +260,221 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
             )
         return rc
 
-    def run(self):
-        self._output.output("[%s|%s] %s" % (
+    def _detach_loop_device(self):
+        if self._loop is not None:
+            try:
+                self._loop.detach()
+            except (IOError, OSError):
+                return 1
+            self._loop = None
+            return 0
+        return molecule.utils.exec_cmd([ImageHandler.LOSETUP_EXEC, "-d",
+                                        self.loop_device])
+
+    def _squashfs_usage(self):
+        """
+        Mount the source ISO image and its squashfs file and estimate the
+        space required by the squashfs content.
+
+        @return: tuple composed by (exit status, used bytes, used inodes)
+        @rtype: tuple
+        """
+        iso_mount = molecule.utils.mkdtemp()
+        squash_mount = molecule.utils.mkdtemp()
+        iso_mounted = False
+        squash_mounted = False
+
+        try:
+            mounter = self.metadata.get(
+                'iso_mounter', RemasterIsoUnpackHandler._iso_mounter)
+            mount_args = mounter + [self.metadata['source_iso'], iso_mount]
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("spawning"), " ".join(mount_args),
+                )
+            )
+            rc = molecule.utils.exec_cmd(mount_args)
+            if rc != 0:
+                return rc, 0, 0
+            iso_mounted = True
+
+            output_file = BuiltinCdrootHandler.chroot_compressor_output_file
+            if "chroot_compressor_output_file" in self.metadata:
+                output_file = self.metadata.get(
+                    'chroot_compressor_output_file')
+            mounter = self.metadata.get(
+                'squash_mounter', RemasterIsoUnpackHandler._squash_mounter)
+            mount_args = mounter + [os.path.join(iso_mount, output_file),
+                                    squash_mount]
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("spawning"), " ".join(mount_args),
+                )
+            )
+            rc = molecule.utils.exec_cmd(mount_args)
+            if rc != 0:
+                return rc, 0, 0
+            squash_mounted = True
+
+            used_bytes, used_inodes = image_utils.tree_usage(squash_mount)
+            return 0, used_bytes, used_inodes
+
+        finally:
+            if squash_mounted:
+                umounter = self.metadata.get(
+                    'squash_umounter',
+                    RemasterIsoUnpackHandler._squash_umounter)
+                molecule.utils.exec_cmd(umounter + [squash_mount])
+            if iso_mounted:
+                umounter = self.metadata.get(
+                    'iso_umounter', RemasterIsoUnpackHandler._iso_umounter)
+                molecule.utils.exec_cmd(umounter + [iso_mount])
+            for tmp_dir in (squash_mount, iso_mount):
+                try:
+                    os.rmdir(tmp_dir)
+                except OSError:
+                    pass
+
+    def _auto_size_image(self, tree=None):
+        """
+        Compute image_mb (and the inode ratio passed to ext formatters)
+        from the uncompressed content of the source squashfs, or of the
+        given directory tree, when image_mb is set to auto[+<headroom>%].
+        """
+        headroom = ImageHandler.AUTO_DEFAULT_HEADROOM
+        match = IMAGE_MB_AUTO_RE.match(self.image_mb)
+        if match.group(1):
+            headroom = int(match.group(1))
+
+        if tree is not None:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("computing image size from"), tree,
+                )
+            )
+            rc = 0
+            used_bytes, used_inodes = image_utils.tree_usage(tree)
+        else:
+            self._output.output("[%s|%s] %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("computing image size from squashfs content"),
+                )
+            )
+            rc, used_bytes, used_inodes = self._squashfs_usage()
+        if rc != 0:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("unable to compute image size"), rc,
+                )
+            )
+            return rc
+
+        mb_bytes = ImageHandler.MB_IN_BYTES
+        inodes = used_inodes * (100 + headroom) // 100
+        data_bytes = used_bytes + inodes * ImageHandler.AUTO_INODE_SIZE
+        data_bytes = data_bytes * (100 + headroom) // 100
+        image_bytes = data_bytes * 100 // \
+            (100 - ImageHandler.AUTO_RESERVED_PERCENT)
+        image_bytes += ImageHandler.AUTO_FS_OVERHEAD_MB * mb_bytes
+        self.image_mb = (image_bytes + mb_bytes - 1) // mb_bytes
+
+        image_formatter = self.metadata.get(
+            'image_formatter',
+            ImageHandler.DEFAULT_IMAGE_FORMATTER
+        )
+        formatter_name = os.path.basename(image_formatter[0])
+        if formatter_name in ImageHandler.EXT_FORMATTERS and \
+                "-i" not in image_formatter and \
+                "-N" not in image_formatter:
+            bytes_per_inode = self.image_mb * mb_bytes // max(inodes, 1)
+            bytes_per_inode = bytes_per_inode // 1024 * 1024
+            bytes_per_inode = max(bytes_per_inode,
+                                  ImageHandler.AUTO_MIN_BYTES_PER_INODE)
+            bytes_per_inode = min(bytes_per_inode,
+                                  ImageHandler.AUTO_MAX_BYTES_PER_INODE)
+            self.image_formatter_args = ["-i", str(bytes_per_inode)]
+
+        self.metadata['ImageHandler_image_mb'] = self.image_mb
+        self._output.output("[%s|%s] %s: %s MB (%s: %s, %s: %s)" % (
                 blue("ImageHandler"), darkred(self.spec_name),
-                _("run hook called"),
+                _("computed image size"), self.image_mb,
+                _("content bytes"), used_bytes,
+                _("content inodes"), used_inodes,
+            )
+        )
+        return 0
+
+    def _fill_image_file(self):
+        """
+        Allocate image file (using _tmp_loop_device_fd) of image_mb size,
+        according to the configured allocation method:
+          - sparse: just set the file size, blocks are allocated on write
+          - fallocate: reserve the blocks without writing them
+          - zero: fill the file with zeroes
+          - random: fill the file with random data
+
+        @raises IOError: if space is not enough
+        @raises OSError: well, sorry
+        """
+        allocation = self.allocation
+        if allocation == "fallocate" and not hasattr(os, "posix_fallocate"):
+            self._output.output("[%s|%s] %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("fallocate not supported, falling back to zero fill"),
+                )
+            )
+            allocation = "zero"
+
+        self._output.output("[%s|%s] %s (%s) => %s" % (
+                blue("ImageHandler"), darkred(self.spec_name),
+                _("generating base image file"), allocation,
+                self.tmp_loop_device_file,
             )
         )
 
-        # fill image file
+        image_size = self.image_mb * ImageHandler.MB_IN_BYTES
+        if self._tmp_loop_device_fd is not None:
+            loop_f = os.fdopen(self._tmp_loop_device_fd, "wb")
+            self._tmp_loop_device_fd = None
+        else:
+            loop_f = open(self.tmp_loop_device_file, "wb")
+        try:
+            if allocation == "sparse":
+                loop_f.truncate(image_size)
+            elif allocation == "fallocate":
+                os.posix_fallocate(loop_f.fileno(), 0, image_size)
+            elif allocation == "random" and \
+                    image_utils.random_fill_supported():
+                throughput = image_utils.random_fill(loop_f.fileno(),
+                                                     image_size)
+                self._output.output("[%s|%s] %s: %.1f MB/s" % (
+                        blue("ImageHandler"), darkred(self.spec_name),
+                        _("random fill throughput"),
+                        throughput / ImageHandler.MB_IN_BYTES,
+                    )
+                )
+            else:
+                mb_bytes = ImageHandler.MB_IN_BYTES
+                zero_chunk = b"\0" * mb_bytes
+                image_mb = self.image_mb
+                while image_mb > 0:
+                    image_mb -= 1
+                    if allocation == "random":
+                        loop_f.write(os.urandom(mb_bytes))
+                    else:
+                        loop_f.write(zero_chunk)
+        finally:
+            # file self._tmp_loop_device_fd is closed here.
+            # no more writes needed
+            loop_f.flush()
+            loop_f.close()
+
+        # last but not least, tell the loop device that the file size changed
+        return self._refresh_loop_device()
+
+    def _allocate_image(self):
         try:
-            rc = self._fill_image_file()
-            if rc != 0:
-                return rc
+            return self._fill_image_file()
         except (IOError, OSError) as err:
             self._output.output("[%s|%s] %s: %s" % (
                     blue("ImageHandler"), darkred(self.spec_name),
@@ -214,12 +483,12 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
             )
             return 1
 
-        # format image file
+    def _format_image(self, args):
         image_formatter = self.metadata.get(
             'image_formatter',
             ImageHandler.DEFAULT_IMAGE_FORMATTER
         )
-        formatter_args = image_formatter + [self.loop_device]
+        formatter_args = image_formatter + self.image_formatter_args + args
         self._output.output("[%s|%s] %s: %s" % (
                 blue("ImageHandler"), darkred(self.spec_name),
                 _("spawning"), " ".join(formatter_args),
@@ -232,6 +501,53 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
                     _("image formatter hook failed"), rc,
                 )
             )
+        return rc
+
+    def _populate_image(self):
+        """
+        Build the image filesystem straight from the unpacked chroot in a
+        single formatter pass (mkfs.ext* -d), when image_population is set
+        to direct. No loop device nor mount is involved.
+        """
+        if not self.direct_population:
+            return 0
+
+        tree = self.metadata['chroot_unpack_path']
+        if isinstance(self.image_mb, get_stringtype()):
+            rc = self._auto_size_image(tree=tree)
+            if rc != 0:
+                return rc
+
+        rc = self._allocate_image()
+        if rc != 0:
+            return rc
+
+        return self._format_image(["-d", tree, self.tmp_loop_device_file])
+
+    def run(self):
+        self._output.output("[%s|%s] %s" % (
+                blue("ImageHandler"), darkred(self.spec_name),
+                _("run hook called"),
+            )
+        )
+
+        if self.direct_population:
+            # the image is built by FinalImageHandler, once the chroot
+            # is ready, see _populate_image()
+            return 0
+
+        # compute image size, if requested
+        if isinstance(self.image_mb, get_stringtype()):
+            rc = self._auto_size_image()
+            if rc != 0:
+                return rc
+
+        rc = self._allocate_image()
+        if rc != 0:
+            return rc
+
+        rc = self._format_image([self.loop_device])
+        if rc != 0:
             return rc
 
         # mount image file
@@ -261,26 +577,203 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         """ Nothing to do """
         return 0
 
-    def _kill_loop_device(self, preserve_loop_device_file=False):
+    def _umount_image(self):
+        if not self.image_mounted:
+            return 0
+
+        umounter = self.metadata.get(
+            'image_umounter',
+            ImageHandler.DEFAULT_IMAGE_UMOUNTER
+        )
+        args = umounter + [self.tmp_image_mount]
+        rc = molecule.utils.exec_cmd(args)
+        if rc != 0:
+            self._output.output(
+                "[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("unable to umount loop device"), self.loop_device,
+                )
+            )
+        else:
+            self.image_mounted = False
+        return rc
+
+    def _fs_device(self):
+        """
+        Return the path to the image filesystem: the loop device, or the
+        image file itself if no loop device is used.
+        """
+        if self.loop_device is not None:
+            return self.loop_device
+        return self.tmp_loop_device_file
+
+    def _ext_fs_info(self):
+        """
+        Return the block size and the block count of the ext* filesystem
+        of the image, or (None, None) if they cannot be read.
+        """
+        sts, output = molecule.utils.exec_cmd_get_status_output(
+            [ImageHandler.DUMPE2FS_EXEC, "-h", self._fs_device()])
+        if sts != 0:
+            return None, None
+
+        block_size = None
+        block_count = None
+        for line in output.splitlines():
+            key, _sep, value = line.partition(":")
+            if key.strip() == "Block size":
+                block_size = int(value.strip())
+            elif key.strip() == "Block count":
+                block_count = int(value.strip())
+        return block_size, block_count
+
+    def _check_image(self, discard=False):
+        """
+        Check the (unmounted) ext* filesystem of the image. With discard,
+        its free blocks are discarded too, which punches holes into the
+        image file when no loop device is used.
+        """
+        args = [ImageHandler.E2FSCK_EXEC, "-f", "-y"]
+        if discard:
+            args += ["-E", "discard"]
+        args.append(self._fs_device())
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("ImageHandler"), darkred(self.spec_name),
+                _("spawning"), " ".join(args),
+            )
+        )
+        rc = molecule.utils.exec_cmd(args)
+        # 1: errors corrected, which is fine for us
+        if rc not in (0, 1):
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("image filesystem check failed"), rc,
+                )
+            )
+            return rc
+        return 0
+
+    def _shrink_image(self, headroom, discard=False):
+        """
+        Shrink the (unmounted) ext* filesystem of the image to its minimum
+        size plus headroom percent and truncate the image file accordingly.
+        """
+        rc = self._check_image(discard=discard)
+        if rc != 0:
+            return rc
+
+        block_size, block_count = self._ext_fs_info()
+        sts, output = molecule.utils.exec_cmd_get_status_output(
+            [ImageHandler.RESIZE2FS_EXEC, "-P", self._fs_device()])
+        min_blocks = None
+        if sts == 0:
+            for line in output.splitlines():
+                key, _sep, value = line.partition(":")
+                if key.strip() == "Estimated minimum size of the filesystem":
+                    min_blocks = int(value.strip())
+        if None in (block_size, block_count, min_blocks):
+            self._output.output("[%s|%s] %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("unable to compute minimum filesystem size"),
+                )
+            )
+            return 1
+
+        target_blocks = min_blocks * (100 + headroom) // 100
+        if target_blocks >= block_count:
+            self._output.output("[%s|%s] %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("image filesystem cannot be shrunk further"),
+                )
+            )
+            return 0
+
+        args = [ImageHandler.RESIZE2FS_EXEC, self._fs_device(),
+                str(target_blocks)]
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("ImageHandler"), darkred(self.spec_name),
+                _("spawning"), " ".join(args),
+            )
+        )
+        rc = molecule.utils.exec_cmd(args)
+        if rc != 0:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("image filesystem shrink failed"), rc,
+                )
+            )
+            return rc
+
+        with open(self.tmp_loop_device_file, "r+b") as loop_f:
+            loop_f.truncate(target_blocks * block_size)
+        return self._refresh_loop_device()
+
+    def _compact_image(self):
+        """
+        Compact the image file before the loop device is detached, according
+        to image_compaction:
+          - none: do nothing
+          - trim: discard the free filesystem blocks, turning them into holes
+          - shrink: trim, then shrink the filesystem to its minimum size
+            plus image_compaction_headroom percent and truncate the file
+        Compaction leaves the image unmounted. With direct population there
+        is no mounted filesystem to fstrim: free blocks are discarded by
+        e2fsck, on the image file.
+        """
+        compaction = self.metadata.get('image_compaction', "none")
+        if compaction == "none":
+            return 0
 
-        kill_rc = 0
         if self.image_mounted:
-            umounter = self.metadata.get(
-                'image_umounter',
-                ImageHandler.DEFAULT_IMAGE_UMOUNTER
+            args = [ImageHandler.FSTRIM_EXEC, self.tmp_image_mount]
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("spawning"), " ".join(args),
+                )
             )
-            args = umounter + [self.tmp_image_mount]
             rc = molecule.utils.exec_cmd(args)
             if rc != 0:
-                self._output.output(
-                    "[%s|%s] %s: %s" % (
+                # not fatal, the image is just bigger
+                self._output.output("[%s|%s] %s: %s" % (
                         blue("ImageHandler"), darkred(self.spec_name),
-                        _("unable to umount loop device"), self.loop_device,
+                        _("image trim failed"), rc,
                     )
                 )
-                kill_rc = rc
-            else:
-                self.image_mounted = False
+
+        rc = self._umount_image()
+        if rc != 0:
+            return rc
+
+        if compaction != "shrink":
+            if self.direct_population:
+                return self._check_image(discard=True)
+            return 0
+
+        image_formatter = self.metadata.get(
+            'image_formatter',
+            ImageHandler.DEFAULT_IMAGE_FORMATTER
+        )
+        formatter_name = os.path.basename(image_formatter[0])
+        if formatter_name not in ImageHandler.EXT_FORMATTERS:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("ImageHandler"), darkred(self.spec_name),
+                    _("image shrink not supported by formatter"),
+                    formatter_name,
+                )
+            )
+            return 0
+
+        headroom = self.metadata.get(
+            'image_compaction_headroom',
+            ImageHandler.DEFAULT_COMPACTION_HEADROOM)
+        return self._shrink_image(headroom, discard=self.direct_population)
+
+    def _kill_loop_device(self, preserve_loop_device_file=False):
+
+        kill_rc = 0
+        rc = self._umount_image()
+        if rc != 0:
+            kill_rc = rc
 
         if self.tmp_image_mount is not None:
             try:
@@ -290,8 +783,7 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
         # kill loop device
         if self.loop_device is not None:
-            rc = molecule.utils.exec_cmd([ImageHandler.LOSETUP_EXEC, "-d",
-                                          self.loop_device])
+            rc = self._detach_loop_device()
             if rc != 0:
                 self._output.output("[%s|%s] %s: %s" % (
                         blue("ImageHandler"), darkred(self.spec_name),
@@ -334,7 +826,8 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
         if not success:
             env = os.environ.copy()
-            env["LOOP_DEVICE"] = self.loop_device
+            if self.loop_device is not None:
+                env["LOOP_DEVICE"] = self.loop_device
             self._run_error_script(None, None, None, env=env)
             self._kill_loop_device()
 
@@ -343,14 +836,23 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
 class ImageIsoUnpackHandler(RemasterIsoUnpackHandler):
 
+    # the ISO image is not rebuilt, only squashfs content is needed
+    _copy_cdroot = False
+
     def setup(self):
 
         unpack_prefix = molecule.utils.mkdtemp(suffix="chroot")
 
         self.metadata['chroot_tmp_dir'] = unpack_prefix
-        self.metadata['chroot_unpack_path'] = \
-            self.metadata['ImageHandler_tmp_image_mount']
-        self.dest_root = os.path.join(unpack_prefix, "cdroot")
+        if _direct_population(self.metadata):
+            # unpack into a plain directory, the image is built from it
+            # at the end
+            self.metadata['chroot_unpack_path'] = os.path.join(
+                unpack_prefix, "root")
+        else:
+            self.metadata['chroot_unpack_path'] = \
+                self.metadata['ImageHandler_tmp_image_mount']
+        self.dest_root = None
 
         # setup upcoming new chroot path
         self.chroot_dir = self.metadata['chroot_unpack_path']
@@ -361,6 +863,10 @@ class ImageIsoUnpackHandler(RemasterIsoUnpackHandler):
 
     def run(self):
 
+        if _direct_population(self.metadata):
+            # destination dir doesn't exist yet
+            return RemasterIsoUnpackHandler.run(self)
+
         self._output.output("[%s|%s] %s: %s => %s" % (
                 blue("ImageIsoUnpackHandler"), darkred(self.spec_name),
                 _("iso unpacker running"), self.tmp_squash_mount,
@@ -370,14 +876,15 @@ class ImageIsoUnpackHandler(RemasterIsoUnpackHandler):
 
         def dorm():
             if self.metadata['chroot_tmp_dir'] is not None:
-                shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+                trash.remove_later(self.metadata['chroot_tmp_dir'])
 
         # copy data into chroot, in our case, destination dir already
         # exists, so copy_dir() is a bit tricky
         try:
-            rc = molecule.utils.copy_dir_existing_dest(
+            rc = self._copy_tree(
                 self.tmp_squash_mount,
-                self.metadata['chroot_unpack_path']
+                self.metadata['chroot_unpack_path'],
+                fallback=molecule.utils.copy_dir_existing_dest
             )
         except Exception:
             dorm()
@@ -394,11 +901,15 @@ class ImageIsoUnpackHandler(RemasterIsoUnpackHandler):
             self.metadata['ImageHandler_kill_loop_device']()
         RemasterIsoUnpackHandler.kill(self, success=success)
 
+        # the unpacked chroot is still needed to build the image
+        if success and _direct_population(self.metadata):
+            return 0
+
         # we don't need the whole dir
         tmp_dir = self.metadata['chroot_tmp_dir']
         if os.path.isdir(tmp_dir):
             try:
-                shutil.rmtree(tmp_dir, True)
+                trash.remove_later(tmp_dir)
             except (shutil.Error, OSError,):
                 self._output.output(
                     "[%s|%s] %s: %s" % (
@@ -433,37 +944,70 @@ class ImageChrootHandler(RemasterChrootHandler):
             self._run_error_script(self.source_dir, self.dest_dir, None,
                                    env=env)
             self.metadata['ImageHandler_kill_loop_device']()
+            if _direct_population(self.metadata):
+                trash.remove_later(self.metadata['chroot_tmp_dir'])
         return 0
 
 
 class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
-    MD5_EXT = ".md5"
     IMAGE_EXT = ".img"
 
+    _ZSTD_EXEC = "/usr/bin/zstd"
+    _XZ_EXEC = "/usr/bin/xz"
+    _PIGZ_EXEC = "/usr/bin/pigz"
+    _GZIP_EXEC = "/bin/gzip"
+    _COMPRESSION_EXTS = {
+        "zstd": ".zst",
+        "xz": ".xz",
+        "gzip": ".gz",
+    }
+
     def __init__(self, *args, **kwargs):
         super(FinalImageHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
         self._loop_device_killed = False
         self._loop_device_file_removed = False
+        self.compression = "none"
+        self.raw_dest_path = None
+
+    @staticmethod
+    def _dest_image_paths(metadata):
+        """
+        Return the destination image path and, with compression, the name
+        of the image once decompressed (None otherwise).
+        """
+        image_name = metadata.get(
+            'image_name',
+            os.path.basename(metadata['source_iso']) +
+            FinalImageHandler.IMAGE_EXT)
+        dest_path = os.path.join(
+            metadata['destination_image_directory'], image_name)
+
+        compression = metadata.get('image_output_compression', "none")
+        if compression == "none":
+            return dest_path, None
+        return (dest_path + FinalImageHandler._COMPRESSION_EXTS[compression],
+                dest_path)
+
+    @classmethod
+    def artifact_paths(cls, metadata):
+        dest_path, raw_dest_path = cls._dest_image_paths(metadata)
+        if raw_dest_path is None:
+            return cls._metadata_artifact_paths(metadata, dest_path)
+        # zsync is useless on compressed images
+        return [dest_path] + \
+            cls._metadata_checksum_paths(metadata, dest_path) + \
+            cls._metadata_checksum_paths(metadata, raw_dest_path)
 
     def setup(self):
         # ImageHandler sets this
         self.tmp_loop_device_file = \
             self.metadata['ImageHandler_loop_device_file']
-        # umount all, but don't remove our loop device file
-        kill_rc = self.metadata['ImageHandler_kill_loop_device'](
-            preserve_loop_device_file=True
-        )
-        if kill_rc:
-            self._loop_device_killed = True
-
-        image_name = self.metadata.get(
-            'image_name',
-            os.path.basename(self.metadata['source_iso']) +
-            FinalImageHandler.IMAGE_EXT)
-        self.dest_path = os.path.join(
-            self.metadata['destination_image_directory'], image_name)
+        self.compression = self.metadata.get('image_output_compression',
+                                             "none")
+        self.dest_path, self.raw_dest_path = self._dest_image_paths(
+            self.metadata)
 
         dest_path_dir = os.path.dirname(self.dest_path)
         if (not os.path.lexists(dest_path_dir)) and \
@@ -476,23 +1020,121 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         """ Nothing to do """
         return 0
 
+    def _compressor(self):
+        threads = self.metadata.get('image_output_compression_threads', 0)
+        if threads == 0:
+            threads = multiprocessing.cpu_count()
+        if self.compression == "zstd":
+            return [FinalImageHandler._ZSTD_EXEC, "-q", "-c",
+                    "-T%d" % (threads,)]
+        if self.compression == "xz":
+            return [FinalImageHandler._XZ_EXEC, "-c", "-T%d" % (threads,)]
+        if os.access(FinalImageHandler._PIGZ_EXEC, os.X_OK):
+            return [FinalImageHandler._PIGZ_EXEC, "-c", "-p", str(threads)]
+        return [FinalImageHandler._GZIP_EXEC, "-c"]
+
+    def _compress_image(self):
+        """
+        Compress the image file into its destination. Both the raw and the
+        compressed image checksums are computed in the same pass. The raw
+        image checksum files are named after the decompressed image, which
+        is not stored, so they can be checked once it is decompressed.
+        """
+        if self._metadata_zsync_enabled(self.metadata):
+            self._output.output("[%s|%s] %s" % (
+                    blue("FinalImageHandler"), darkred(self.spec_name),
+                    _("zsync control file not generated for compressed "
+                      "images"),
+                )
+            )
+        compressor = self._compressor()
+        self._output.output("[%s|%s] %s: %s => %s" % (
+                blue("FinalImageHandler"), darkred(self.spec_name),
+                _("compressing image file"), " ".join(compressor),
+                self.dest_path,
+            )
+        )
+        chunk_writer = self._chunk_store_writer(self.dest_path)
+        raw_hasher = self._checksum_hasher()
+        hasher = self._checksum_hasher(chunk_writer)
+        try:
+            rc = artifact_utils.compress_file(
+                self.tmp_loop_device_file, self.dest_path, compressor,
+                raw_hashers=[raw_hasher], hashers=[hasher])
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("FinalImageHandler"), darkred(self.spec_name),
+                    _("image compression failed"), err,
+                )
+            )
+            rc = 1
+        if rc != 0:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("FinalImageHandler"), darkred(self.spec_name),
+                    _("image compression failed"), rc,
+                )
+            )
+            if os.path.isfile(self.dest_path):
+                os.remove(self.dest_path)
+            return rc
+
+        os.remove(self.tmp_loop_device_file)
+        self._loop_device_file_removed = True
+
+        self._output.output("[%s|%s] %s: %s" % (
+                blue("FinalImageHandler"), darkred(self.spec_name),
+                _("built image"), self.dest_path,
+            )
+        )
+        artifact_utils.write_checksum_files(self.dest_path,
+                                            hasher.hexdigests())
+        artifact_utils.write_checksum_files(self.raw_dest_path,
+                                            raw_hasher.hexdigests())
+        if chunk_writer is not None:
+            self._finish_chunk_store(chunk_writer)
+        return 0
+
+    def _finalize_image(self):
+        """
+        Build the image filesystem, if image_population is direct, compact
+        it if requested, then umount it and detach the loop device, keeping
+        the image file.
+        """
+        rc = self.metadata['ImageHandler_populate_image']()
+        if rc != 0:
+            return rc
+        rc = self.metadata['ImageHandler_compact_image']()
+        if rc != 0:
+            return rc
+        # umount all, but don't remove our loop device file
+        kill_rc = self.metadata['ImageHandler_kill_loop_device'](
+            preserve_loop_device_file=True
+        )
+        if kill_rc:
+            self._loop_device_killed = True
+        return 0
+
     def run(self):
+        rc = self._finalize_image()
+        if rc != 0:
+            return rc
+
+        if self.compression != "none":
+            return self._compress_image()
+
         self._output.output("[%s|%s] %s: %s %s" % (
                 blue("FinalImageHandler"), darkred(self.spec_name),
                 _("run hook called"), _("moving image file to destination"),
                 self.dest_path,
             )
         )
-        try:
-            os.rename(self.tmp_loop_device_file, self.dest_path)
-        except OSError as err:
-            if err.errno != errno.EXDEV:
-                raise
-            # cannot move atomically, fallback to shutil.move
-            try:
-                shutil.move(self.tmp_loop_device_file, self.dest_path)
-            except shutil.Error:
-                raise
+        # if the file cannot be moved atomically, it is copied preserving
+        # holes and its checksums are computed in the same pass
+        zsync_maker = self._zsync_maker()
+        chunk_writer = self._chunk_store_writer(self.dest_path)
+        hasher = self._checksum_hasher(zsync_maker, chunk_writer)
+        hashed = artifact_utils.move_file(self.tmp_loop_device_file,
+                                          self.dest_path, hashers=[hasher])
         self._loop_device_file_removed = True
 
         self._output.output("[%s|%s] %s: %s" % (
@@ -503,15 +1145,18 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if os.path.isfile(self.dest_path) and os.access(self.dest_path, os.R_OK):
             self._output.output("[%s|%s] %s: %s" % (
                     blue("FinalImageHandler"), darkred(self.spec_name),
-                    _("generating md5 for"), self.dest_path,
+                    _("writing checksums for"), self.dest_path,
                 )
             )
-            digest = molecule.utils.md5sum(self.dest_path)
-            md5file = self.dest_path + FinalImageHandler.MD5_EXT
-            with open(md5file, "w") as f:
-                f.write("%s  %s\n" % (digest,
-                                      os.path.basename(self.dest_path),))
-                f.flush()
+            if not hashed:
+                # renamed in place, holes are still not read from disk
+                artifact_utils.hash_file(self.dest_path, [hasher])
+            artifact_utils.write_checksum_files(self.dest_path,
+                                                hasher.hexdigests())
+            if zsync_maker is not None:
+                self._write_zsync(zsync_maker, self.dest_path)
+            if chunk_writer is not None:
+                self._finish_chunk_store(chunk_writer)
 
     def post_run(self):
         # run post tar script
@@ -519,8 +1164,14 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if exec_script:
             env = os.environ.copy()
             env['IMAGE_PATH'] = self.dest_path
-            env['IMAGE_CHECKSUM_PATH'] = self.dest_path + \
-                FinalImageHandler.MD5_EXT
+            self._export_checksum_paths(env, 'IMAGE', self.dest_path,
+                                        zsync_file=self.raw_dest_path is None)
+            if self.raw_dest_path is not None:
+                # the raw image is neither zsynced nor chunked
+                paths = self._metadata_checksum_paths(self.metadata,
+                                                      self.raw_dest_path)
+                env['IMAGE_RAW_CHECKSUM_PATH'] = paths[0]
+                env['IMAGE_RAW_CHECKSUM_PATHS'] = ' '.join(paths)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("FinalImageHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -542,7 +1193,9 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
             if not (self._loop_device_file_removed and
                     self._loop_device_killed):
                 self.metadata['ImageHandler_kill_loop_device']()
-        """ Nothing to do """
+        if _direct_population(self.metadata):
+            # unpacked chroot is not needed anymore
+            trash.remove_later(self.metadata['chroot_tmp_dir'])
         return 0
 
 
@@ -554,6 +1207,28 @@ class IsoToImageSpec(GenericSpec):
     def execution_strategy():
         return "iso_to_image"
 
+    @staticmethod
+    def supported_image_allocation(allocation):
+        return allocation in SUPPORTED_IMAGE_ALLOCATION_METHODS
+
+    @staticmethod
+    def supported_image_compaction(compaction):
+        return compaction in SUPPORTED_IMAGE_COMPACTION_METHODS
+
+    @staticmethod
+    def supported_image_population(population):
+        return population in SUPPORTED_IMAGE_POPULATION_METHODS
+
+    @staticmethod
+    def supported_image_output_compression(compression):
+        return compression in SUPPORTED_IMAGE_OUTPUT_COMPRESSION_METHODS
+
+    def _parse_image_mb(self, image_mb):
+        image_mb = image_mb.strip()
+        if IMAGE_MB_AUTO_RE.match(image_mb):
+            return image_mb
+        return self._cast_integer(image_mb)
+
     def vital_parameters(self):
         return [
             "source_iso",
@@ -571,6 +1246,14 @@ class IsoToImageSpec(GenericSpec):
                 'verifier': self._verify_command_arguments,
                 'parser': self._command_splitter,
             },
+            'chroot_cgroup': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'chroot_pid_namespace': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'release_string': {
                 'verifier': lambda x: len(x) != 0,  # validation callback
                 'parser': lambda x: x.strip(),  # value extractor
@@ -609,12 +1292,40 @@ class IsoToImageSpec(GenericSpec):
             },
             'image_mb': {
                 'verifier': lambda x: x is not None,
-                'parser': self._cast_integer,
+                'parser': self._parse_image_mb,
             },
             'image_randomize': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': lambda x: x.strip(),
             },
+            'image_allocation': {
+                'verifier': self.supported_image_allocation,
+                'parser': lambda x: x.strip(),
+            },
+            'image_compaction': {
+                'verifier': self.supported_image_compaction,
+                'parser': lambda x: x.strip(),
+            },
+            'image_population': {
+                'verifier': self.supported_image_population,
+                'parser': lambda x: x.strip(),
+            },
+            'image_output_compression': {
+                'verifier': self.supported_image_output_compression,
+                'parser': lambda x: x.strip(),
+            },
+            'image_output_compression_threads': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
+            'image_loop_direct_io': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'image_compaction_headroom': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
             'error_script': {
                 'verifier': self._verify_executable_arguments,
                 'parser': self._command_splitter,
@@ -691,12 +1402,48 @@ class IsoToImageSpec(GenericSpec):
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'build_cache_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'generate_zsync': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
+            'chunk_store_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'tree_copy_workers': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
+            'checksum_algorithms': {
+                'verifier': artifact_utils.checksum_algorithms_supported,
+                'parser': self._comma_separate,
+            },
             'paths_to_empty': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'cleanup_report': {
+                'verifier': lambda x: os.path.isdir(
+                    os.path.dirname(os.path.abspath(x))),
+                'parser': lambda x: x.strip(),
+            },
+            'cleanup_report_top_dirs': {
+                'verifier': lambda x: x is not None and x > 0,
+                'parser': self._cast_integer,
+            },
+            'cleanup_dry_run': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
         }
 
     def execution_steps(self):
-        return [ImageHandler, ImageIsoUnpackHandler, ImageChrootHandler,
-                FinalImageHandler]
+        # resume the deletion of the trash left by interrupted builds
+        trash.resume()
+        return cacheable_steps(
+            [ImageHandler, ImageIsoUnpackHandler, ImageChrootHandler,
+             FinalImageHandler])
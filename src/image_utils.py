@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import multiprocessing
+import os
+import re
+import struct
+import threading
+import time
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, \
+        modes
+except ImportError:
+    Cipher = None
+
+# random data is generated and written in blocks of this size, block
+# offsets are always aligned to it.
+RANDOM_FILL_BLOCK_SIZE = 4 * 1024 * 1024
+RANDOM_FILL_MAX_WORKERS = 8
+
+# image_mb: auto[+<headroom>%]
+IMAGE_MB_AUTO_RE = re.compile(r"^auto(?:\+(\d+)%)?$")
+
+
+def random_fill_supported():
+    """
+    Return whether random_fill() can be used on this system.
+    """
+    return hasattr(os, "pwrite")
+
+
+def _keystream_factory(block_size):
+    """
+    Return a function generating the random data of a given block.
+
+    If python-cryptography is available, data is the AES-256-CTR keystream
+    of a random key, where every block uses its own disjoint counter range.
+    Otherwise, the kernel DRBG (getrandom()) is used. Both release the GIL
+    while generating data.
+    """
+    if Cipher is None:
+        return lambda index, size: os.urandom(size)
+
+    key = os.urandom(32)
+    zeroes = memoryview(b"\0" * block_size)
+    counters_per_block = block_size // (algorithms.AES.block_size // 8)
+
+    def _keystream(index, size):
+        nonce = struct.pack(">QQ", 0, index * counters_per_block)
+        encryptor = Cipher(algorithms.AES(key), modes.CTR(nonce),
+                           backend=default_backend()).encryptor()
+        return encryptor.update(zeroes[:size])
+
+    return _keystream
+
+
+def random_fill(fd, size, block_size=RANDOM_FILL_BLOCK_SIZE, workers=None):
+    """
+    Fill the first size bytes of the file referenced by fd with random
+    data. Work is spread over a pool of threads, each one generating
+    and writing disjoint blocks using os.pwrite().
+
+    @param fd: file descriptor open for writing
+    @type fd: int
+    @param size: amount of bytes to write
+    @type size: int
+    @keyword block_size: size of every block, must be a multiple of 16
+    @type block_size: int
+    @keyword workers: number of threads, defaults to the number of CPUs
+    @type workers: int
+    @return: the achieved throughput, in bytes per second
+    @rtype: float
+    @raises IOError: if space is not enough
+    @raises OSError: well, sorry
+    """
+    if workers is None:
+        workers = min(multiprocessing.cpu_count(), RANDOM_FILL_MAX_WORKERS)
+    keystream = _keystream_factory(block_size)
+    blocks = (size + block_size - 1) // block_size
+
+    lock = threading.Lock()
+    state = {'next': 0, 'error': None}
+
+    def _worker():
+        while True:
+            with lock:
+                if state['error'] is not None or state['next'] >= blocks:
+                    return
+                index = state['next']
+                state['next'] += 1
+
+            offset = index * block_size
+            length = min(block_size, size - offset)
+            try:
+                data = memoryview(keystream(index, length))
+                while data:
+                    written = os.pwrite(fd, data, offset)
+                    data = data[written:]
+                    offset += written
+            except (IOError, OSError) as err:
+                with lock:
+                    if state['error'] is None:
+                        state['error'] = err
+                return
+
+    start = time.time()
+    threads = [threading.Thread(target=_worker)
+               for _x in range(max(1, min(workers, blocks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    if state['error'] is not None:
+        raise state['error']
+    if elapsed <= 0:
+        return float(size)
+    return size / elapsed
+
+
+def tree_usage(path, block_size=4096):
+    """
+    Estimate the space required to store the directory tree at path on a
+    block based filesystem. Hardlinked files are counted once.
+
+    @param path: directory path
+    @type path: string
+    @keyword block_size: filesystem block size used to round file sizes
+    @type block_size: int
+    @return: tuple composed by (used bytes, used inodes)
+    @rtype: tuple
+    """
+    used_bytes = 0
+    used_inodes = 0
+    seen = set()
+
+    for root, dirs, files in os.walk(path):
+        used_inodes += 1
+        used_bytes += block_size
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+            used_inodes += 1
+            used_bytes += (st.st_size + block_size - 1) // block_size * \
+                block_size
+        # symlinks to directories are not walked, count them here
+        for name in dirs:
+            if os.path.islink(os.path.join(root, name)):
+                used_inodes += 1
+
+    return used_bytes, used_inodes
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import fcntl
+import os
+import struct
+import threading
+
+LOOP_CONTROL = "/dev/loop-control"
+LOOP_DEVICE_PATTERN = "/dev/loop%d"
+
+# linux/loop.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_CAPACITY = 0x4C07
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_DIRECT_IO = 16
+LO_NAME_SIZE = 64
+
+_O_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+# struct loop_info64 and struct loop_config
+_LOOP_INFO64 = "=QQQQQIIII%ds%ds32sQQ" % (LO_NAME_SIZE, LO_NAME_SIZE)
+_LOOP_CONFIG = "=II%ds64x" % (struct.calcsize(_LOOP_INFO64),)
+
+# how many times claiming a free device is retried when another process
+# binds it first
+CLAIM_RETRIES = 16
+# how many released devices are kept open for reuse by the next builds
+POOL_SIZE = 4
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def supported():
+    """
+    Return whether loop devices can be managed through loop-control.
+    """
+    return os.path.exists(LOOP_CONTROL) and \
+        os.access(LOOP_CONTROL, os.R_OK | os.W_OK)
+
+
+def _loop_info(backing_file, flags):
+    name = os.path.abspath(backing_file).encode("utf-8")[:LO_NAME_SIZE - 1]
+    return struct.pack(_LOOP_INFO64, 0, 0, 0, 0, 0, 0, 0, 0, flags,
+                       name, b"", b"", 0, 0)
+
+
+class LoopDevice(object):
+    """
+    A loop device bound to a backing file.
+    """
+
+    def __init__(self, number, fd):
+        self.number = number
+        self.path = LOOP_DEVICE_PATTERN % (number,)
+        self.direct_io = False
+        self._fd = fd
+
+    def _bind(self, backing_fd, backing_file, flags):
+        """
+        Bind the backing file to this device, in one step if the kernel
+        supports LOOP_CONFIGURE. Raise OSError with errno EBUSY if the
+        device is already bound.
+        """
+        info = _loop_info(backing_file, flags)
+        config = struct.pack(_LOOP_CONFIG, backing_fd, 0, info)
+        try:
+            fcntl.ioctl(self._fd, LOOP_CONFIGURE, config)
+            return
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+
+        # kernel older than 5.8
+        fcntl.ioctl(self._fd, LOOP_SET_FD, backing_fd)
+        try:
+            fcntl.ioctl(self._fd, LOOP_SET_STATUS64, info)
+        except (IOError, OSError):
+            fcntl.ioctl(self._fd, LOOP_CLR_FD, 0)
+            raise
+
+    def set_direct_io(self, enabled=True):
+        """
+        Enable or disable direct I/O on the backing file. Return False if
+        the backing filesystem doesn't support it.
+        """
+        try:
+            fcntl.ioctl(self._fd, LOOP_SET_DIRECT_IO, int(enabled))
+        except (IOError, OSError):
+            return False
+        self.direct_io = enabled
+        return True
+
+    def set_capacity(self):
+        """
+        Tell the loop device that the backing file size changed.
+        """
+        fcntl.ioctl(self._fd, LOOP_SET_CAPACITY, 0)
+
+    def detach(self):
+        """
+        Unbind the backing file. The device is kept for reuse by the next
+        attach() call if the pool is not full.
+        """
+        fcntl.ioctl(self._fd, LOOP_CLR_FD, 0)
+        with _pool_lock:
+            if len(_pool) < POOL_SIZE:
+                _pool.append((self.number, self._fd))
+                self._fd = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _claim_free_device():
+    with _pool_lock:
+        if _pool:
+            return _pool.pop()
+
+    ctl_fd = os.open(LOOP_CONTROL, os.O_RDWR | _O_CLOEXEC)
+    try:
+        number = fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE)
+    finally:
+        os.close(ctl_fd)
+    fd = os.open(LOOP_DEVICE_PATTERN % (number,), os.O_RDWR | _O_CLOEXEC)
+    return number, fd
+
+
+def attach(backing_file, read_only=False, direct_io=False):
+    """
+    Claim a free loop device and bind backing_file to it. Races with other
+    processes claiming the same device are handled by retrying on another
+    one.
+
+    @param backing_file: path to the backing file
+    @type backing_file: string
+    @keyword read_only: bind the file read-only
+    @type read_only: bool
+    @keyword direct_io: try to enable direct I/O on the backing file
+    @type direct_io: bool
+    @return: the bound loop device
+    @rtype: LoopDevice
+    @raises OSError: if no loop device can be bound
+    """
+    flags = 0
+    mode = os.O_RDWR
+    if read_only:
+        flags |= LO_FLAGS_READ_ONLY
+        mode = os.O_RDONLY
+
+    backing_fd = os.open(backing_file, mode | _O_CLOEXEC)
+    try:
+        for _retry in range(CLAIM_RETRIES):
+            number, fd = _claim_free_device()
+            device = LoopDevice(number, fd)
+            try:
+                device._bind(backing_fd, backing_file, flags)
+            except (IOError, OSError) as err:
+                os.close(fd)
+                if err.errno == errno.EBUSY:
+                    continue
+                raise
+            if direct_io:
+                device.set_direct_io(True)
+            return device
+    finally:
+        # the kernel holds its own reference to the file
+        os.close(backing_fd)
+
+    raise OSError(errno.EBUSY, "unable to claim a free loop device")
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+from . import build_cache
+
+MANIFEST_VERSION = 2
+MANIFEST_EXT = ".manifest"
+
+# the tree root, as listed in rsync --files-from
+ROOT = "."
+
+
+def manifest_path(dest_dir):
+    """
+    Return the path of the manifest of the mirror at dest_dir. It lives
+    next to the mirror, so it is neither synced nor packed.
+    """
+    parent, name = os.path.split(dest_dir.rstrip(os.sep))
+    return os.path.join(parent, "." + name + MANIFEST_EXT)
+
+
+def _signature(st):
+    """
+    Return the signature of a tree entry. ctime is part of it, so that
+    ownership, permission, ACL and xattr changes are caught without
+    reading them.
+    """
+    return [
+        st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_nlink,
+        st.st_size,
+        getattr(st, "st_mtime_ns", repr(st.st_mtime)),
+        getattr(st, "st_ctime_ns", repr(st.st_ctime)),
+        st.st_rdev,
+    ]
+
+
+def _entries(path):
+    """
+    Yield (name, lstat result) for every entry of the directory at path.
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                yield entry.name, entry.stat(follow_symlinks=False)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        return
+
+    for name in os.listdir(path):
+        try:
+            yield name, os.lstat(os.path.join(path, name))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def scan_tree(path, one_file_system=False):
+    """
+    Return the signature of every entry of the directory tree at path,
+    keyed by path relative to it. Symlinks are not followed. This is the
+    only tree walk of an incremental sync, it takes about 10 microseconds
+    per entry with a warm inode cache, and the saved manifest about 125
+    bytes per entry.
+
+    @param path: directory path
+    @type path: string
+    @keyword one_file_system: do not descend into directories on other
+        file systems, like rsync --one-file-system
+    @type one_file_system: bool
+    @return: dict composed by relative path -> signature
+    @rtype: dict
+    """
+    root_st = os.stat(path)
+    manifest = {ROOT: _signature(root_st)}
+    stack = [("", path)]
+    while stack:
+        rel_dir, abs_dir = stack.pop()
+        try:
+            entries = list(_entries(abs_dir))
+        except OSError as err:
+            # vanished during the scan
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue
+            raise
+        for name, st in entries:
+            rel = rel_dir + name
+            manifest[rel] = _signature(st)
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            if not one_file_system or st.st_dev == root_st.st_dev:
+                stack.append((rel + os.sep, os.path.join(abs_dir, name)))
+    return manifest
+
+
+def hooks_digest(metadata):
+    """
+    Return the digest of the hook scripts (their content and the content
+    of the files passed to them) of a spec. The destination tree is not
+    scanned: whatever hooks changed in it is trusted to be changed the
+    same way by the next run, as long as they are the same.
+
+    @param metadata: parsed spec metadata
+    @type metadata: dict
+    @return: hex digest
+    @rtype: string
+    """
+    hasher = hashlib.sha256()
+    build_cache.hash_scripts(hasher, metadata)
+    return hasher.hexdigest()
+
+
+def load(path, args, hooks):
+    """
+    Load the manifest at path. Return None if there is none, if it is
+    unreadable or if it was recorded by a sync run with different
+    arguments (excluded paths might differ) or different hooks.
+
+    @param path: manifest path
+    @type path: string
+    @param args: arguments of the sync command about to be run
+    @type args: list
+    @param hooks: hook scripts digest, as returned by hooks_digest()
+    @type hooks: string
+    @return: the manifest or None
+    @rtype: dict
+    """
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    if manifest.get('args') != list(args):
+        return None
+    if manifest.get('hooks') != hooks:
+        return None
+    return manifest
+
+
+def save(path, args, hooks, source):
+    """
+    Atomically write the manifest of a successful sync run.
+
+    @param path: manifest path
+    @type path: string
+    @param args: arguments of the sync command
+    @type args: list
+    @param hooks: hook scripts digest, as returned by hooks_digest()
+    @type hooks: string
+    @param source: source tree signatures, as returned by scan_tree()
+    @type source: dict
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'args': list(args),
+        'hooks': hooks,
+        'source': source,
+    }
+    directory = os.path.dirname(path)
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def remove(path):
+    """
+    Remove the manifest at path, if any, forcing the next sync run to be
+    a full one.
+    """
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def changed_paths(manifest, source):
+    """
+    Return the paths to sync, given the manifest of the previous sync run
+    and the current state of the source tree. A path is listed if it
+    changed in the source tree since the previous run. Paths to delete
+    are listed too (rsync --delete-missing-args removes them), except
+    those below another path to delete or below a path that is no longer
+    a directory.
+
+    @param manifest: manifest of the previous run, as returned by load()
+    @type manifest: dict
+    @param source: current source tree signatures
+    @type source: dict
+    @return: sorted list of relative paths
+    @rtype: list
+    """
+    old = manifest['source']
+    changed = set()
+    for rel, signature in source.items():
+        if old.get(rel) != signature:
+            changed.add(rel)
+    for rel in old:
+        if rel not in source:
+            changed.add(rel)
+
+    def _below_removed(rel):
+        parent = os.path.dirname(rel)
+        while parent:
+            if parent not in source:
+                return True
+            if not stat.S_ISDIR(source[parent][1]):
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    return sorted(rel for rel in changed
+                  if rel in source or not _below_removed(rel))
+
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import json
+import os
+import stat
+import tempfile
+import threading
+
+SHARDS_EXT = ".shards"
+
+# shard of the entries synced by the top level pass
+ROOT_SHARD = -1
+
+
+def shards_path(dest_dir):
+    """
+    Return the path of the file recording the subtree sizes of the mirror
+    at dest_dir, next to the mirror.
+    """
+    parent, name = os.path.split(dest_dir.rstrip(os.sep))
+    return os.path.join(parent, "." + name + SHARDS_EXT)
+
+
+def load_sizes(path):
+    """
+    Return the top level subtree sizes recorded by the previous run, an
+    empty dict if there are none.
+    """
+    try:
+        with open(path, "r") as f:
+            sizes = json.load(f).get('sizes', {})
+    except (IOError, OSError, ValueError, AttributeError):
+        return {}
+    if not isinstance(sizes, dict):
+        return {}
+    return sizes
+
+
+def save_sizes(path, sizes):
+    directory = os.path.dirname(path)
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        with os.fdopen(tmp_fd, "w") as f:
+            json.dump({'sizes': sizes}, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def top_level_dirs(source_dir, one_file_system=False):
+    """
+    Return the names of the top level directories of source_dir that can
+    be synced by their own rsync process. With one_file_system, mount
+    points are left to the top level pass, which doesn't descend into
+    them.
+    """
+    root_dev = os.stat(source_dir).st_dev
+    names = []
+    for name in sorted(os.listdir(source_dir)):
+        try:
+            st = os.lstat(os.path.join(source_dir, name))
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        if one_file_system and st.st_dev != root_dev:
+            continue
+        names.append(name)
+    return names
+
+
+def balance(names, sizes, workers):
+    """
+    Split the top level directories into at most workers groups of
+    similar total size, largest directories first. Directories without a
+    recorded size are assumed to be of average size.
+
+    @param names: top level directory names
+    @type names: list
+    @param sizes: recorded sizes, by name
+    @type sizes: dict
+    @param workers: maximum number of groups
+    @type workers: int
+    @return: list of non empty lists of names
+    @rtype: list
+    """
+    known = [sizes[x] for x in names if x in sizes]
+    if known:
+        average = max(sum(known) // len(known), 1)
+    else:
+        average = 1
+
+    shards = [[] for x in range(min(workers, len(names)))]
+    loads = [0] * len(shards)
+    for name in sorted(names, key=lambda x: sizes.get(x, average),
+                       reverse=True):
+        index = loads.index(min(loads))
+        shards[index].append(name)
+        loads[index] += sizes.get(name, average)
+    return [x for x in shards if x]
+
+
+class TreeScanner(threading.Thread):
+    """
+    Walk the source tree, meant to run while the shards are synced:
+    compute the size of every top level directory, to balance the next
+    run, and collect the hardlinked files, since rsync -H only links
+    files synced by the same process.
+    """
+
+    def __init__(self, source_dir, names, one_file_system=False):
+        super(TreeScanner, self).__init__()
+        self.daemon = True
+        self._source_dir = source_dir
+        self._names = names
+        self._one_file_system = one_file_system
+        self.sizes = {}
+        # (st_dev, st_ino) => list of relative paths
+        self.links = {}
+        self.error = None
+
+    def _add_link(self, rel, st):
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            self.links.setdefault((st.st_dev, st.st_ino), []).append(rel)
+
+    def _walk(self, name, root_dev):
+        size = 0
+        stack = [name]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                names = os.listdir(os.path.join(self._source_dir, rel_dir))
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for entry in names:
+                rel = os.path.join(rel_dir, entry)
+                try:
+                    st = os.lstat(os.path.join(self._source_dir, rel))
+                except OSError as err:
+                    if err.errno == errno.ENOENT:
+                        continue
+                    raise
+                size += st.st_size
+                self._add_link(rel, st)
+                if stat.S_ISDIR(st.st_mode):
+                    if not self._one_file_system or st.st_dev == root_dev:
+                        stack.append(rel)
+        return size
+
+    def run(self):
+        try:
+            root_dev = os.stat(self._source_dir).st_dev
+            for entry in os.listdir(self._source_dir):
+                st = os.lstat(os.path.join(self._source_dir, entry))
+                self._add_link(entry, st)
+            for name in self._names:
+                self.sizes[name] = self._walk(name, root_dev)
+        except (IOError, OSError) as err:
+            self.error = err
+
+    def cross_shard_links(self, shards):
+        """
+        Return the relative paths of the hardlinked files whose links
+        are spread among different shards (the top level pass included),
+        sorted.
+        """
+        shard_of = {}
+        for index, shard in enumerate(shards):
+            for name in shard:
+                shard_of[name] = index
+
+        paths = []
+        for rels in self.links.values():
+            if len(rels) < 2:
+                continue
+            owners = set(shard_of.get(x.split(os.sep, 1)[0], ROOT_SHARD)
+                         if os.sep in x else ROOT_SHARD for x in rels)
+            if len(owners) > 1:
+                paths.extend(rels)
+        return sorted(paths)
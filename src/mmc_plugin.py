@@ -16,9 +16,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 import os
-import shutil
 import tempfile
-import errno
 
 from molecule.i18n import _
 from molecule.output import blue, darkred
@@ -26,7 +24,8 @@ from molecule.specs.skel import GenericExecutionStep, GenericSpec
 
 import molecule.utils
 
-from .builtin_plugin import BuiltinHandlerMixin
+from .builtin_plugin import BuiltinHandlerMixin, cacheable_steps
+from . import artifact_utils
 
 
 class ChrootHandler(GenericExecutionStep, BuiltinHandlerMixin):
@@ -275,8 +274,6 @@ class ImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
 class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
-    MD5_EXT = ".md5"
-
     def __init__(self, *args, **kwargs):
         super(FinalImageHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
@@ -285,14 +282,22 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
         self._tmp_image_file = None
         self.source_dir = None
 
+    @staticmethod
+    def _dest_image_path(metadata):
+        return os.path.join(metadata['destination_image_directory'],
+                            metadata.get('image_name'))
+
+    @classmethod
+    def artifact_paths(cls, metadata):
+        return cls._metadata_artifact_paths(metadata,
+                                            cls._dest_image_path(metadata))
+
     def setup(self):
         self.source_dir = self.metadata['source_chroot']
         self._tmp_image_file = self.metadata['MmcImageHandler_image_file']
 
         self.image_name = self.metadata.get('image_name')
-        self.dest_path = os.path.join(
-            self.metadata['destination_image_directory'],
-            self.image_name)
+        self.dest_path = self._dest_image_path(self.metadata)
 
         dest_path_dir = os.path.dirname(self.dest_path)
         if (not os.path.lexists(dest_path_dir)) and \
@@ -312,16 +317,13 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
                 self.dest_path,
             )
         )
-        try:
-            os.rename(self._tmp_image_file, self.dest_path)
-        except OSError as err:
-            if err.errno != errno.EXDEV:
-                raise
-            # cannot move atomically, fallback to shutil.move
-            try:
-                shutil.move(self._tmp_image_file, self.dest_path)
-            except shutil.Error:
-                raise
+        # if the file cannot be moved atomically, it is copied preserving
+        # holes and its checksums are computed in the same pass
+        zsync_maker = self._zsync_maker()
+        chunk_writer = self._chunk_store_writer(self.dest_path)
+        hasher = self._checksum_hasher(zsync_maker, chunk_writer)
+        hashed = artifact_utils.move_file(self._tmp_image_file, self.dest_path,
+                                          hashers=[hasher])
 
         self._output.output("[%s|%s] %s: %s" % (
                 blue("FinalImageHandler"), darkred(self.spec_name),
@@ -332,15 +334,18 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
                 os.access(self.dest_path, os.R_OK):
             self._output.output("[%s|%s] %s: %s" % (
                     blue("FinalImageHandler"), darkred(self.spec_name),
-                    _("generating md5 for"), self.dest_path,
+                    _("writing checksums for"), self.dest_path,
                 )
             )
-            digest = molecule.utils.md5sum(self.dest_path)
-            md5file = self.dest_path + FinalImageHandler.MD5_EXT
-            with open(md5file, "w") as f:
-                f.write("%s  %s\n" % (digest,
-                                      os.path.basename(self.dest_path),))
-                f.flush()
+            if not hashed:
+                # renamed in place, holes are still not read from disk
+                artifact_utils.hash_file(self.dest_path, [hasher])
+            artifact_utils.write_checksum_files(self.dest_path,
+                                                hasher.hexdigests())
+            if zsync_maker is not None:
+                self._write_zsync(zsync_maker, self.dest_path)
+            if chunk_writer is not None:
+                self._finish_chunk_store(chunk_writer)
 
     def post_run(self):
         # run post tar script
@@ -352,8 +357,7 @@ class FinalImageHandler(GenericExecutionStep, BuiltinHandlerMixin):
             # self.metadata['destination_image_directory']
             env['CHROOT_DIR'] = self.source_dir
             env['IMAGE_PATH'] = self.dest_path
-            env['IMAGE_CHECKSUM_PATH'] = self.dest_path + \
-                FinalImageHandler.MD5_EXT
+            self._export_checksum_paths(env, 'IMAGE', self.dest_path)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("FinalImageHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -409,6 +413,14 @@ class ChrootToMmcImageSpec(GenericSpec):
                 'verifier': self._verify_command_arguments,
                 'parser': self._command_splitter,
             },
+            'chroot_cgroup': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'chroot_pid_namespace': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'outer_source_chroot_script': {
                 'verifier': self._verify_executable_arguments,
                 'parser': self._command_splitter,
@@ -485,6 +497,22 @@ class ChrootToMmcImageSpec(GenericSpec):
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'build_cache_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'generate_zsync': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
+            'chunk_store_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'checksum_algorithms': {
+                'verifier': artifact_utils.checksum_algorithms_supported,
+                'parser': self._comma_separate,
+            },
             'paths_to_empty': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
@@ -492,4 +520,5 @@ class ChrootToMmcImageSpec(GenericSpec):
         }
 
     def execution_steps(self):
-        return [ChrootHandler, ImageHandler, FinalImageHandler]
+        return cacheable_steps(
+            [ChrootHandler, ImageHandler, FinalImageHandler])
@@ -25,10 +25,12 @@ from molecule.specs.skel import GenericExecutionStep, GenericSpec
 
 import molecule.utils
 
+from . import artifact_utils
+from . import trash
 from .builtin_plugin import ChrootHandler as BuiltinChrootHandler
 from .builtin_plugin import CdrootHandler as BuiltinCdrootHandler
 from .builtin_plugin import IsoHandler as BuiltinIsoHandler
-from .builtin_plugin import BuiltinHandlerMixin
+from .builtin_plugin import BuiltinHandlerMixin, cacheable_steps
 
 
 class IsoUnpackHandler(GenericExecutionStep, BuiltinHandlerMixin):
@@ -39,6 +41,11 @@ class IsoUnpackHandler(GenericExecutionStep, BuiltinHandlerMixin):
     _squash_mounter = ["/bin/mount", "-o", "loop,ro", "-t", "squashfs"]
     _squash_umounter = ["/bin/umount"]
 
+    # if False, the ISO content is not copied into the cdroot directory,
+    # only the squashfs content is unpacked. Subclasses not rebuilding
+    # the ISO image can turn this off.
+    _copy_cdroot = True
+
     def __init__(self, *args, **kwargs):
         super(IsoUnpackHandler, self).__init__(*args, **kwargs)
         self._export_generic_info()
@@ -102,9 +109,11 @@ class IsoUnpackHandler(GenericExecutionStep, BuiltinHandlerMixin):
         # copy iso content over, including squashfs yeah, it will be
         # replaced later on
         # this is mandatory and used to make iso recreation easier
-        rc = molecule.utils.copy_dir(self.tmp_mount, self.dest_root)
-        if rc != 0:
-            return rc
+        if self._copy_cdroot:
+            rc = self._copy_tree(self.tmp_mount, self.dest_root,
+                                 fallback=molecule.utils.copy_dir)
+            if rc != 0:
+                return rc
 
         self.iso_mounted = True
 
@@ -146,12 +155,13 @@ class IsoUnpackHandler(GenericExecutionStep, BuiltinHandlerMixin):
 
         def dorm():
             if self.metadata['chroot_tmp_dir'] is not None:
-                shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+                trash.remove_later(self.metadata['chroot_tmp_dir'])
 
         # create chroot path
         try:
-            rc = molecule.utils.copy_dir(self.tmp_squash_mount,
-                                         self.metadata['chroot_unpack_path'])
+            rc = self._copy_tree(self.tmp_squash_mount,
+                                 self.metadata['chroot_unpack_path'],
+                                 fallback=molecule.utils.copy_dir)
         except Exception:
             dorm()
             raise
@@ -220,7 +230,7 @@ class IsoUnpackHandler(GenericExecutionStep, BuiltinHandlerMixin):
             tmp_dir = self.metadata['chroot_tmp_dir']
             if tmp_dir is not None:
                 try:
-                    shutil.rmtree(tmp_dir, True)
+                    trash.remove_later(tmp_dir)
                 except (shutil.Error, OSError,):
                     self._output.output("[%s|%s] %s: %s" % (
                         blue("IsoUnpackHandler"), darkred(self.spec_name),
@@ -247,7 +257,7 @@ class ChrootHandler(BuiltinChrootHandler):
         BuiltinChrootHandler.kill(self, success=success)
         if not success:
             try:
-                shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+                trash.remove_later(self.metadata['chroot_tmp_dir'])
             except (shutil.Error, OSError,):
                 pass
         return 0
@@ -263,19 +273,8 @@ class ChrootHandler(BuiltinChrootHandler):
                 update_cmd = self.metadata.get(
                     'repositories_update_cmd',
                     self._pkgs_updater)
-                try:
-                    rc = molecule.utils.exec_chroot_cmd(
-                        update_cmd,
-                        self.source_dir,
-                        pre_chroot=self.metadata.get('prechroot', [])
-                    )
-                except Exception:
-                    molecule.utils.kill_chroot_pids(self.source_dir,
-                                                    sleep=True)
-                    raise
+                rc = self._exec_chroot_cmd(update_cmd, self.source_dir)
                 if rc != 0:
-                    molecule.utils.kill_chroot_pids(self.source_dir,
-                                                    sleep=True)
                     return rc
 
         rc = BuiltinChrootHandler.run(self)
@@ -296,19 +295,8 @@ class ChrootHandler(BuiltinChrootHandler):
                 'custom_packages_add_cmd',
                 self._pkgs_adder)
             args = add_cmd + packages_to_add
-            try:
-                rc = molecule.utils.exec_chroot_cmd(
-                    args,
-                    self.source_dir,
-                    pre_chroot=self.metadata.get('prechroot', [])
-                )
-            except Exception:
-                molecule.utils.kill_chroot_pids(self.source_dir,
-                                                sleep=True)
-                raise
+            rc = self._exec_chroot_cmd(args, self.source_dir)
             if rc != 0:
-                molecule.utils.kill_chroot_pids(self.source_dir,
-                                                sleep=True)
                 return rc
 
         packages_to_remove = self.metadata.get('packages_to_remove', [])
@@ -317,19 +305,8 @@ class ChrootHandler(BuiltinChrootHandler):
                 'custom_packages_remove_cmd',
                 self._pkgs_remover)
             args = rm_cmd + packages_to_remove
-            try:
-                rc = molecule.utils.exec_chroot_cmd(
-                    args,
-                    self.source_dir,
-                    pre_chroot=self.metadata.get('prechroot', [])
-                )
-            except Exception:
-                molecule.utils.kill_chroot_pids(self.source_dir,
-                                                sleep=True)
-                raise
+            rc = self._exec_chroot_cmd(args, self.source_dir)
             if rc != 0:
-                molecule.utils.kill_chroot_pids(self.source_dir,
-                                                sleep=True)
                 return rc
 
         # run inner chroot script after pkgs handling
@@ -355,7 +332,7 @@ class CdrootHandler(BuiltinCdrootHandler):
         BuiltinCdrootHandler.kill(self, success=success)
         if not success:
             try:
-                shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+                trash.remove_later(self.metadata['chroot_tmp_dir'])
             except (shutil.Error, OSError,):
                 pass
         return 0
@@ -363,15 +340,19 @@ class CdrootHandler(BuiltinCdrootHandler):
 
 class IsoHandler(BuiltinIsoHandler):
 
+    @staticmethod
+    def _dest_iso_path(metadata):
+        dest_iso_filename = metadata.get(
+            'destination_iso_image_name',
+            "remaster_" + os.path.basename(metadata['source_iso'])
+        )
+        return os.path.join(metadata['destination_iso_directory'],
+                            dest_iso_filename)
+
     def setup(self):
         # cdroot dir
         self.source_path = self.metadata['cdroot_path']
-        dest_iso_filename = self.metadata.get(
-            'destination_iso_image_name',
-            "remaster_" + os.path.basename(self.metadata['source_iso'])
-        )
-        self.dest_iso = os.path.join(self.metadata['destination_iso_directory'],
-                                     dest_iso_filename)
+        self.dest_iso = self._dest_iso_path(self.metadata)
         self.iso_title = \
             os.getenv('MOLECULE_ISO_TITLE',
                       self.metadata.get('iso_title', 'Molecule remaster')
@@ -383,7 +364,7 @@ class IsoHandler(BuiltinIsoHandler):
     def kill(self, success=True):
         BuiltinIsoHandler.kill(self, success=success)
         try:
-            shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+            trash.remove_later(self.metadata['chroot_tmp_dir'])
         except (shutil.Error, OSError,):
             pass
         return 0
@@ -413,6 +394,14 @@ class RemasterSpec(GenericSpec):
                 'verifier': self._verify_command_arguments,
                 'parser': self._command_splitter,
             },
+            'chroot_cgroup': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'chroot_pid_namespace': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'release_string': {
                 'verifier': lambda x: len(x) != 0,  # validation callback
                 'parser': lambda x: x.strip(),  # value extractor
@@ -529,11 +518,47 @@ class RemasterSpec(GenericSpec):
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'build_cache_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'generate_zsync': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
+            'chunk_store_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'tree_copy_workers': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
+            'checksum_algorithms': {
+                'verifier': artifact_utils.checksum_algorithms_supported,
+                'parser': self._comma_separate,
+            },
             'paths_to_empty': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'cleanup_report': {
+                'verifier': lambda x: os.path.isdir(
+                    os.path.dirname(os.path.abspath(x))),
+                'parser': lambda x: x.strip(),
+            },
+            'cleanup_report_top_dirs': {
+                'verifier': lambda x: x is not None and x > 0,
+                'parser': self._cast_integer,
+            },
+            'cleanup_dry_run': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
         }
 
     def execution_steps(self):
-        return [IsoUnpackHandler, ChrootHandler, CdrootHandler, IsoHandler]
+        # resume the deletion of the trash left by interrupted builds
+        trash.resume()
+        return cacheable_steps(
+            [IsoUnpackHandler, ChrootHandler, CdrootHandler, IsoHandler])
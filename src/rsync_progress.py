@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import os
+import re
+import select
+import subprocess
+import time
+
+# whole transfer progress, one line per update, without unit suffixes in
+# the transferred bytes (rsync >= 3.1)
+PROGRESS_ARGS = ["--info=progress2", "--no-human-readable"]
+
+STATS_KEYS = ("bytes", "files", "checked", "elapsed", "bytes_per_sec",
+              "files_per_sec")
+
+# 1234567  12%  1.23MB/s  0:00:10 (xfr#5, to-chk=100/200)
+_PROGRESS_RE = re.compile(
+    r"^\s*([\d,.]+)\s+(\d+)%\s+\S+\s+(\d+):(\d\d):(\d\d)"
+    r"(?:\s+\(xfr#(\d+),\s+(ir|to)-chk=(\d+)/(\d+)\))?\s*$")
+
+
+class ProgressMeter(object):
+    """
+    Parse the rsync --info=progress2 stream and compute the transfer
+    throughput. rsync reports the ETA of the whole transfer only once the
+    file list is complete ("to-chk"): while it is being built
+    incrementally ("ir-chk") the ETA is unknown.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._start = clock()
+        self._buf = b""
+        self.bytes = 0
+        self.files = 0
+        self.checked = 0
+        self.total = None
+        self.percent = 0
+        self.eta = None
+
+    def _parse(self, line):
+        match = _PROGRESS_RE.match(line)
+        if match is None:
+            return False
+        (transferred, percent, hours, minutes, seconds,
+         files, chk, remaining, total) = match.groups()
+        self.bytes = int(transferred.replace(",", "").replace(".", ""))
+        self.percent = int(percent)
+        if files is None:
+            return True
+        self.files = int(files)
+        self.checked = int(total) - int(remaining)
+        if chk == "to":
+            self.total = int(total)
+            if int(remaining):
+                self.eta = int(hours) * 3600 + int(minutes) * 60 + \
+                    int(seconds)
+            else:
+                # the elapsed time, once done
+                self.eta = 0
+        else:
+            self.total = None
+            self.eta = None
+        return True
+
+    def feed(self, data):
+        """
+        Feed a chunk of the rsync output. Return the lines that are not
+        progress updates, decoded.
+
+        @param data: rsync stdout data
+        @type data: bytes
+        @return: list of other output lines
+        @rtype: list
+        """
+        self._buf += data
+        lines = re.split(b"[\r\n]", self._buf)
+        self._buf = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """
+        Parse the output left, return the lines that are not progress
+        updates, like feed().
+        """
+        lines, self._buf = [self._buf], b""
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        others = []
+        for line in lines:
+            line = line.decode("utf-8", "replace")
+            if not line.strip():
+                continue
+            if not self._parse(line):
+                others.append(line)
+        return others
+
+    def stats(self):
+        """
+        Return the transfer statistics so far.
+
+        @return: dict composed by transferred bytes and files, checked
+            files, elapsed seconds, bytes and files per second
+        @rtype: dict
+        """
+        elapsed = max(self._clock() - self._start, 0.0)
+        if elapsed > 0:
+            bytes_per_sec = int(self.bytes / elapsed)
+            files_per_sec = round(self.files / elapsed, 1)
+        else:
+            bytes_per_sec, files_per_sec = 0, 0.0
+        return {
+            'bytes': self.bytes,
+            'files': self.files,
+            'checked': self.checked,
+            'elapsed': round(elapsed, 3),
+            'bytes_per_sec': bytes_per_sec,
+            'files_per_sec': files_per_sec,
+        }
+
+
+def _poll(poller, timeout):
+    """
+    Wait up to timeout seconds for the polled file descriptors, return
+    whether any of them is ready.
+    """
+    try:
+        return bool(poller.poll(int(timeout * 1000)))
+    except (select.error, OSError) as err:
+        # Python 2 doesn't retry on signals
+        if err.args[0] == errno.EINTR:
+            return False
+        raise
+
+
+def run(args, meter, on_progress, on_output, interval=5.0):
+    """
+    Execute rsync with the given arguments (PROGRESS_ARGS included),
+    feeding its output to meter. on_progress is called every interval
+    seconds even if rsync is silent, stalled on a slow file or on I/O.
+
+    @param args: rsync command arguments
+    @type args: list
+    @param meter: progress meter
+    @type meter: ProgressMeter
+    @param on_progress: function called with meter, every interval seconds
+    @type on_progress: callable
+    @param on_output: function called with every other output line
+    @type on_output: callable
+    @keyword interval: seconds between two on_progress calls
+    @type interval: float
+    @return: rsync exit status
+    @rtype: int
+    @raises OSError: if rsync cannot be executed
+    """
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    next_report = time.time() + interval
+    try:
+        fd = proc.stdout.fileno()
+        poller = select.poll()
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+        while True:
+            if _poll(poller, max(next_report - time.time(), 0)):
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                for line in meter.feed(data):
+                    on_output(line)
+            now = time.time()
+            if now >= next_report:
+                next_report = now + interval
+                on_progress(meter)
+        for line in meter.close():
+            on_output(line)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+    return proc.wait()
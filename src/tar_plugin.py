@@ -23,7 +23,9 @@ from molecule.i18n import _
 from molecule.output import blue, darkred
 from molecule.specs.skel import GenericExecutionStep, GenericSpec
 
-from .builtin_plugin import BuiltinHandlerMixin
+from . import artifact_utils
+from . import trash
+from .builtin_plugin import BuiltinHandlerMixin, cacheable_steps
 from .remaster_plugin import IsoUnpackHandler, ChrootHandler
 import molecule.utils
 
@@ -37,7 +39,6 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
         "gz": "z",
         "bz2": "j",
     }
-    MD5_EXT = ".md5"
 
     def __init__(self, *args, **kwargs):
         super(TarHandler, self).__init__(*args, **kwargs)
@@ -47,15 +48,23 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
         comp_method = self.metadata.get('compression_method', "gz")
         return TarHandler._TAR_COMP_METHODS[comp_method]
 
-    def setup(self):
+    @staticmethod
+    def _dest_tar_path(metadata):
         # setup compression method, default is gz
-        tar_name = self.metadata.get(
+        tar_name = metadata.get(
             'tar_name',
-            os.path.basename(self.metadata['source_iso']) + ".tar." +
-            self.metadata.get('compression_method', "gz")
+            os.path.basename(metadata['source_iso']) + ".tar." +
+            metadata.get('compression_method', "gz")
         )
-        self.dest_path = os.path.join(
-            self.metadata['destination_tar_directory'], tar_name)
+        return os.path.join(metadata['destination_tar_directory'], tar_name)
+
+    @classmethod
+    def artifact_paths(cls, metadata):
+        return cls._metadata_artifact_paths(metadata,
+                                            cls._dest_tar_path(metadata))
+
+    def setup(self):
+        self.dest_path = self._dest_tar_path(self.metadata)
         self.chroot_path = self.metadata['chroot_unpack_path']
         return 0
 
@@ -72,8 +81,7 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
             env = os.environ.copy()
             env['CHROOT_DIR'] = self.chroot_path
             env['TAR_PATH'] = self.dest_path
-            env['TAR_CHECKSUM_PATH'] = self.dest_path + \
-                TarHandler.MD5_EXT
+            self._export_checksum_paths(env, 'TAR', self.dest_path)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("TarHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -103,14 +111,22 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
                 os.path.lexists(dest_path_dir):
             os.makedirs(dest_path_dir, 0o755)
 
-        current_dir = os.getcwd()
-        # change dir to chroot dir
-        os.chdir(self.chroot_path)
-
+        # the tarball is written to stdout and hashed while stored
         args = (TarHandler._TAR_EXEC, "cfp" + self._get_tar_comp_method(),
-                self.dest_path, ".", "--atime-preserve", "--numeric-owner")
-        rc = molecule.utils.exec_cmd(args)
-        os.chdir(current_dir)
+                "-", ".", "--atime-preserve", "--numeric-owner")
+        chunk_writer = self._chunk_store_writer(self.dest_path)
+        hasher = self._checksum_hasher(chunk_writer)
+        try:
+            rc = artifact_utils.command_to_file(args, self.dest_path,
+                                                hashers=[hasher],
+                                                cwd=self.chroot_path)
+        except (IOError, OSError) as err:
+            self._output.output("[%s|%s] %s: %s" % (
+                    blue("TarHandler"), darkred(self.spec_name),
+                    _("unable to write tarball"), err,
+                )
+            )
+            rc = 1
         if rc != 0:
             self._output.output("[%s|%s] %s: %s" % (
                     blue("TarHandler"), darkred(self.spec_name),
@@ -120,14 +136,13 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
             return rc
         self._output.output("[%s|%s] %s: %s" % (
                 blue("TarHandler"), darkred(self.spec_name),
-                _("generating md5 for"), self.dest_path,
+                _("writing checksums for"), self.dest_path,
             )
         )
-        digest = molecule.utils.md5sum(self.dest_path)
-        md5file = self.dest_path + TarHandler.MD5_EXT
-        with open(md5file, "w") as f:
-            f.write("%s  %s\n" % (digest, os.path.basename(self.dest_path),))
-            f.flush()
+        artifact_utils.write_checksum_files(self.dest_path,
+                                            hasher.hexdigests())
+        if chunk_writer is not None:
+            self._finish_chunk_store(chunk_writer)
 
         return 0
 
@@ -144,8 +159,7 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
             env = os.environ.copy()
             env['CHROOT_DIR'] = self.chroot_path
             env['TAR_PATH'] = self.dest_path
-            env['TAR_CHECKSUM_PATH'] = self.dest_path + \
-                TarHandler.MD5_EXT
+            self._export_checksum_paths(env, 'TAR', self.dest_path)
             self._output.output("[%s|%s] %s: %s" % (
                     blue("TarHandler"), darkred(self.spec_name),
                     _("spawning"), " ".join(exec_script),
@@ -166,7 +180,7 @@ class TarHandler(GenericExecutionStep, BuiltinHandlerMixin):
         if not success:
             self._run_error_script(None, self.chroot_path, None)
         try:
-            shutil.rmtree(self.metadata['chroot_tmp_dir'], True)
+            trash.remove_later(self.metadata['chroot_tmp_dir'])
         except (shutil.Error, OSError,):
             pass
         return 0
@@ -200,6 +214,14 @@ class IsoToTarSpec(GenericSpec):
                 'verifier': self._verify_command_arguments,
                 'parser': self._command_splitter,
             },
+            'chroot_cgroup': {
+                'verifier': lambda x: len(x) != 0,
+                'parser': lambda x: x.strip(),
+            },
+            'chroot_pid_namespace': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
             'release_string': {
                 'verifier': lambda x: len(x) != 0,  # validation callback
                 'parser': lambda x: x.strip(),  # value extractor
@@ -304,11 +326,42 @@ class IsoToTarSpec(GenericSpec):
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'build_cache_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'chunk_store_directory': {
+                'verifier': os.path.isdir,
+                'parser': lambda x: x.strip(),
+            },
+            'tree_copy_workers': {
+                'verifier': lambda x: x is not None and x >= 0,
+                'parser': self._cast_integer,
+            },
+            'checksum_algorithms': {
+                'verifier': artifact_utils.checksum_algorithms_supported,
+                'parser': self._comma_separate,
+            },
             'paths_to_empty': {
                 'verifier': lambda x: len(x) != 0,
                 'parser': self._comma_separate_path,
             },
+            'cleanup_report': {
+                'verifier': lambda x: os.path.isdir(
+                    os.path.dirname(os.path.abspath(x))),
+                'parser': lambda x: x.strip(),
+            },
+            'cleanup_report_top_dirs': {
+                'verifier': lambda x: x is not None and x > 0,
+                'parser': self._cast_integer,
+            },
+            'cleanup_dry_run': {
+                'verifier': lambda x: x in ("yes", "no"),
+                'parser': lambda x: x.strip(),
+            },
         }
 
     def execution_steps(self):
-        return [IsoUnpackHandler, ChrootHandler, TarHandler]
+        # resume the deletion of the trash left by interrupted builds
+        trash.resume()
+        return cacheable_steps([IsoUnpackHandler, ChrootHandler, TarHandler])
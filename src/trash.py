@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import errno
+import fcntl
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+# trash directory, at the root of every file system
+TRASH_NAME = ".molecule-trash"
+# taken by the reaper deleting a trash directory
+_LOCK_NAME = ".lock"
+_ENTRY_PREFIX = "entry."
+
+# the reaper runs in the idle I/O scheduling class, when available
+_IONICE = ["/usr/bin/ionice", "-c", "3"]
+_MOUNTS = "/proc/self/mounts"
+
+_resumed = False
+
+
+def mount_point(path):
+    """
+    Return the mount point of the file system containing path.
+    """
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def trash_dir(path):
+    """
+    Return the trash directory path could be moved into: the one of the
+    file system containing it.
+    """
+    return os.path.join(mount_point(os.path.dirname(path)), TRASH_NAME)
+
+
+def _is_safe(directory):
+    """
+    Return whether directory is a real directory (not a symlink), owned
+    by this user and accessible by it only, so that nobody else can make
+    the reaper delete anything.
+    """
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() and \
+        stat.S_IMODE(st.st_mode) == 0o700
+
+
+def move(path, outside=None):
+    """
+    Atomically move path into the trash directory of its file system.
+
+    @param path: path to delete
+    @type path: string
+    @keyword outside: directory the trash directory must not be in, the
+        one being packed for instance
+    @type outside: string
+    @return: the trash directory, None if path cannot be moved there,
+        or if the trash directory is not safe to use (see _is_safe())
+    @rtype: string
+    """
+    directory = trash_dir(path)
+    if outside is not None:
+        outside = os.path.realpath(outside)
+        if directory == outside or \
+                directory.startswith(outside.rstrip(os.sep) + os.sep):
+            return None
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            return None
+    if not _is_safe(directory):
+        return None
+    try:
+        entry = tempfile.mkdtemp(prefix=_ENTRY_PREFIX, dir=directory)
+    except (IOError, OSError):
+        return None
+    try:
+        os.rename(path, os.path.join(entry, os.path.basename(path)))
+    except OSError:
+        # mount points, bind mounts, read-only file systems
+        os.rmdir(entry)
+        return None
+    return directory
+
+
+def _module_root():
+    path = os.path.abspath(__file__)
+    for x in __name__.split("."):
+        path = os.path.dirname(path)
+    return path
+
+
+def _lower_priority():
+    os.setsid()
+    os.nice(19)
+
+
+def reap_later(directories):
+    """
+    Spawn a detached process deleting the content of the given trash
+    directories at low CPU and I/O priority. It outlives this process.
+
+    @param directories: trash directories
+    @type directories: iterable
+    """
+    directories = sorted(set(directories))
+    if not directories:
+        return
+    args = []
+    if os.access(_IONICE[0], os.X_OK):
+        args.extend(_IONICE)
+    args.extend([sys.executable, "-m", __name__])
+    args.extend(directories)
+
+    env = os.environ.copy()
+    python_path = [_module_root()]
+    if env.get("PYTHONPATH"):
+        python_path.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(python_path)
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen(args, stdin=devnull, stdout=devnull,
+                         stderr=devnull, env=env, close_fds=True,
+                         preexec_fn=_lower_priority)
+
+
+def remove_later(path, outside=None):
+    """
+    Move path into the trash and have it deleted in background, or delete
+    it right away if it cannot be moved. Errors are ignored, like
+    shutil.rmtree(path, True) does.
+    """
+    if not os.path.lexists(path):
+        return
+    directory = move(path, outside=outside)
+    if directory is None:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return
+    try:
+        reap_later([directory])
+    except (IOError, OSError):
+        # deleted at the next resume()
+        pass
+
+
+def _unescape(field):
+    return re.sub(r"\\([0-7]{3})", lambda x: chr(int(x.group(1), 8)),
+                  field)
+
+
+def mount_points():
+    """
+    Return the set of the mount points of this process, empty if they
+    cannot be read.
+    """
+    try:
+        with open(_MOUNTS, "r") as f:
+            return set(_unescape(x.split()[1]) for x in f
+                       if len(x.split()) > 1)
+    except (IOError, OSError):
+        return set()
+
+
+def leftover():
+    """
+    Return the trash directories, on the mounted file systems, containing
+    anything to delete.
+    """
+    directories = []
+    for path in sorted(mount_points()):
+        directory = os.path.join(path, TRASH_NAME)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        if not _is_safe(directory):
+            continue
+        if any(x.startswith(_ENTRY_PREFIX) for x in names):
+            directories.append(directory)
+    return directories
+
+
+def resume():
+    """
+    Resume the deletion of the trash left by interrupted runs, once per
+    process.
+    """
+    global _resumed
+    if _resumed:
+        return
+    _resumed = True
+    try:
+        reap_later(leftover())
+    except (IOError, OSError):
+        pass
+
+
+def reap(directory):
+    """
+    Delete the content of the trash directory, waiting for any other
+    process doing it. Entries that cannot be deleted are left there.
+
+    @param directory: trash directory
+    @type directory: string
+    @raises OSError: if directory is not safe to use (EPERM, see
+        _is_safe())
+    """
+    if not _is_safe(directory):
+        raise OSError(errno.EPERM, "unsafe trash directory", directory)
+    lock_fd = os.open(os.path.join(directory, _LOCK_NAME),
+                      os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        failed = set()
+        while True:
+            entries = [x for x in os.listdir(directory)
+                       if x.startswith(_ENTRY_PREFIX) and x not in failed]
+            if not entries:
+                break
+            for name in entries:
+                entry = os.path.join(directory, name)
+                shutil.rmtree(entry, True)
+                if os.path.lexists(entry):
+                    failed.add(name)
+    finally:
+        os.close(lock_fd)
+
+
+def main(argv):
+    for directory in argv:
+        try:
+            reap(directory)
+        except (IOError, OSError) as err:
+            sys.stderr.write("%s: %s\n" % (directory, err))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import collections
+import errno
+import multiprocessing
+import os
+import shutil
+import stat
+import threading
+
+from . import artifact_utils
+
+# xattr errors meaning that the attribute cannot be copied, not that the
+# copy failed: the same ones shutil.copystat() ignores
+_XATTR_IGNORED_ERRORS = (errno.EPERM, errno.ENOTSUP, errno.ENODATA,
+                         errno.EINVAL, errno.EOPNOTSUPP)
+
+STATS_KEYS = ("dirs", "files", "symlinks", "specials", "hardlinks",
+              "bytes")
+
+
+def available():
+    """
+    Return whether the native tree copier can be used on this system.
+    """
+    return hasattr(os, "scandir") and \
+        os.utime in getattr(os, "supports_follow_symlinks", ())
+
+
+def default_workers():
+    """
+    Return the default number of copier threads. Copying trees is latency
+    bound, so there are more threads than CPUs.
+    """
+    return max(4, min(32, multiprocessing.cpu_count() * 2))
+
+
+def _copy_xattrs(source, dest):
+    """
+    Copy the xattrs (ACLs and capabilities included) of source to dest,
+    both paths or both file descriptors. Symlinks are not followed.
+    """
+    if not hasattr(os, "listxattr"):
+        return
+    if isinstance(source, int):
+        kwargs = {}
+    else:
+        kwargs = {'follow_symlinks': False}
+    try:
+        names = os.listxattr(source, **kwargs)
+    except OSError as err:
+        if err.errno in _XATTR_IGNORED_ERRORS:
+            return
+        raise
+    for name in names:
+        try:
+            value = os.getxattr(source, name, **kwargs)
+            os.setxattr(dest, name, value, **kwargs)
+        except OSError as err:
+            if err.errno not in _XATTR_IGNORED_ERRORS:
+                raise
+
+
+class _TreeCopier(object):
+    """
+    Copy a directory tree with a pool of threads. Every thread owns a
+    queue of directories to copy: it takes work from its own end, depth
+    first, and steals from the other end of the other queues when its own
+    is empty, so big subtrees get split among idle threads.
+    """
+
+    def __init__(self, source, dest, workers, one_file_system):
+        self._source = source
+        self._dest = dest
+        self._one_file_system = one_file_system
+        self._root_dev = os.stat(source).st_dev
+        self._is_root = os.geteuid() == 0
+
+        self._queues = [collections.deque() for x in range(workers)]
+        # directories queued or being copied
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._error = None
+
+        # (st_dev, st_ino) => (first destination path, copied event)
+        self._links = {}
+        self._links_lock = threading.Lock()
+        # directory metadata is set once their content is in place
+        self._dirs = []
+        self._dirs_lock = threading.Lock()
+        self._stats = [dict((k, 0) for k in STATS_KEYS)
+                       for x in range(workers)]
+
+    def _push(self, index, item):
+        with self._cond:
+            self._pending += 1
+            self._queues[index].append(item)
+            self._cond.notify()
+
+    def _next(self, index):
+        queues = self._queues
+        while True:
+            try:
+                return queues[index].pop()
+            except IndexError:
+                pass
+            for offset in range(1, len(queues)):
+                try:
+                    return queues[(index + offset) % len(queues)].popleft()
+                except IndexError:
+                    pass
+            with self._cond:
+                if self._pending == 0 or self._error is not None:
+                    return None
+                self._cond.wait(0.1)
+
+    def _done(self, error=None):
+        with self._cond:
+            self._pending -= 1
+            if error is not None and self._error is None:
+                self._error = error
+            if self._pending == 0 or self._error is not None:
+                self._cond.notify_all()
+
+    def _chown(self, dest, st):
+        try:
+            if isinstance(dest, int):
+                os.fchown(dest, st.st_uid, st.st_gid)
+            else:
+                os.lchown(dest, st.st_uid, st.st_gid)
+        except OSError as err:
+            # like rsync, ownership is only preserved by root
+            if self._is_root or err.errno != errno.EPERM:
+                raise
+
+    @staticmethod
+    def _utime(dest, st):
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+
+    @staticmethod
+    def _prepare(dest, is_dir):
+        """
+        Make room for dest, unless it is an existing directory and a
+        directory is about to be copied there. Return whether dest is an
+        existing directory.
+        """
+        try:
+            st = os.lstat(dest)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        if stat.S_ISDIR(st.st_mode):
+            if is_dir:
+                return True
+            shutil.rmtree(dest)
+        else:
+            os.unlink(dest)
+        return False
+
+    def _make_dir(self, source, dest, st, fresh):
+        """
+        Create the directory dest, return whether it was created.
+        """
+        created = fresh or not self._prepare(dest, True)
+        if created:
+            os.mkdir(dest, 0o700)
+        self._chown(dest, st)
+        with self._dirs_lock:
+            self._dirs.append((source, dest, st))
+        return created
+
+    def _copy_regular(self, source, dest, st):
+        src_fd = os.open(source, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            try:
+                if st.st_size:
+                    sparse = st.st_blocks * 512 < st.st_size
+                    artifact_utils.copy_data(src_fd, dst_fd, st.st_size,
+                                             sparse=sparse)
+                # chown clears setuid bits and capabilities, chmod and
+                # xattrs go after
+                self._chown(dst_fd, st)
+                os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+                _copy_xattrs(src_fd, dst_fd)
+                os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def _copy_file(self, source, dest, st, stats, fresh):
+        event = None
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            with self._links_lock:
+                first = self._links.get(key)
+                if first is None:
+                    event = threading.Event()
+                    self._links[key] = (dest, event)
+            if first is not None:
+                first_dest, first_event = first
+                first_event.wait()
+                if not fresh:
+                    self._prepare(dest, False)
+                os.link(first_dest, dest)
+                stats['hardlinks'] += 1
+                return
+
+        try:
+            if not fresh:
+                self._prepare(dest, False)
+            if stat.S_ISREG(st.st_mode):
+                self._copy_regular(source, dest, st)
+                stats['files'] += 1
+                stats['bytes'] += st.st_size
+            else:
+                os.mknod(dest, st.st_mode, st.st_rdev)
+                self._chown(dest, st)
+                os.chmod(dest, stat.S_IMODE(st.st_mode))
+                _copy_xattrs(source, dest)
+                self._utime(dest, st)
+                stats['specials'] += 1
+        finally:
+            if event is not None:
+                event.set()
+
+    def _copy_symlink(self, source, dest, st, stats, fresh):
+        if not fresh:
+            self._prepare(dest, False)
+        os.symlink(os.readlink(source), dest)
+        self._chown(dest, st)
+        _copy_xattrs(source, dest)
+        self._utime(dest, st)
+        stats['symlinks'] += 1
+
+    def _copy_dir(self, index, source_dir, dest_dir, fresh):
+        """
+        Copy the content of source_dir to dest_dir. If dest_dir is fresh,
+        it has just been created and there is nothing to replace in it.
+        """
+        stats = self._stats[index]
+        for entry in os.scandir(source_dir):
+            if self._error is not None:
+                return
+            st = entry.stat(follow_symlinks=False)
+            source = entry.path
+            dest = os.path.join(dest_dir, entry.name)
+            if stat.S_ISDIR(st.st_mode):
+                created = self._make_dir(source, dest, st, fresh)
+                stats['dirs'] += 1
+                if not self._one_file_system or \
+                        st.st_dev == self._root_dev:
+                    self._push(index, (source, dest, created))
+            elif stat.S_ISLNK(st.st_mode):
+                self._copy_symlink(source, dest, st, stats, fresh)
+            else:
+                self._copy_file(source, dest, st, stats, fresh)
+
+    def _worker(self, index):
+        while True:
+            item = self._next(index)
+            if item is None:
+                return
+            error = None
+            try:
+                self._copy_dir(index, *item)
+            except Exception as err:
+                # raised by copy(), whatever it is
+                error = err
+            finally:
+                # never leave the pending count unbalanced, or the other
+                # workers wait forever
+                self._done(error=error)
+
+    def copy(self):
+        created = self._make_dir(self._source, self._dest,
+                                 os.stat(self._source), False)
+        self._push(0, (self._source, self._dest, created))
+
+        threads = []
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._worker, args=(index,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+        for source, dest, st in self._dirs:
+            # set now, default ACLs would have been inherited by the content
+            _copy_xattrs(source, dest)
+            os.chmod(dest, stat.S_IMODE(st.st_mode))
+            self._utime(dest, st)
+
+        totals = dict((k, 0) for k in STATS_KEYS)
+        for stats in self._stats:
+            for key in STATS_KEYS:
+                totals[key] += stats[key]
+        return totals
+
+
+def copy_tree(source, dest, workers=None, one_file_system=False):
+    """
+    Copy the directory tree at source to dest with a pool of threads,
+    preserving hardlinks, ownership (numeric), permissions, ACLs, xattrs,
+    device nodes and timestamps. File data is copied by the kernel when
+    possible and holes are preserved. If dest exists, source content is
+    merged into it, replacing conflicting entries.
+
+    @param source: source directory path
+    @type source: string
+    @param dest: destination directory path
+    @type dest: string
+    @keyword workers: number of threads, default_workers() if None
+    @type workers: int
+    @keyword one_file_system: do not descend into directories on other
+        file systems
+    @type one_file_system: bool
+    @return: dict composed by number of dirs, files, symlinks, specials,
+        hardlinks and copied bytes
+    @rtype: dict
+    @raises OSError: if the copy fails, dest is left partially copied; any
+        other error raised while copying is raised again as well
+    """
+    if not workers:
+        workers = default_workers()
+    copier = _TreeCopier(source, dest, workers, one_file_system)
+    return copier.copy()
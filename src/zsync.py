@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#    Molecule Disc Image builder for Sabayon Linux
+#    Copyright (C) 2009 Fabio Erculiani
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import math
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ZSYNC_VERSION = "0.6.2"
+ZSYNC_EXT = ".zsync"
+DEFAULT_BLOCK_SIZE = 4096
+
+_MD4_TEST_VECTOR = (b"abc", "a448017aaf21d8525fc10ae87aa6729d")
+
+
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+def zsync_path(path):
+    """
+    Return the path of the zsync control file of the file at path.
+    """
+    return path + ZSYNC_EXT
+
+
+def _md4_python(data):
+    """
+    Pure python MD4 (RFC 1320), used when neither hashlib nor libcrypto
+    provide it. Slow.
+    """
+    def _rotl(x, n):
+        x &= 0xFFFFFFFF
+        return ((x << n) | (x >> (32 - n))) & 0xFFFFFFFF
+
+    data = _to_bytes(data)
+    length = len(data)
+    data += b"\x80" + b"\0" * ((55 - length) % 64) + \
+        struct.pack("<Q", (length * 8) & 0xFFFFFFFFFFFFFFFF)
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+
+    for offset in range(0, len(data), 64):
+        x = struct.unpack("<16I", data[offset:offset + 64])
+        a, b, c, d = h
+
+        for i in range(16):
+            k = i
+            s = (3, 7, 11, 19)[i % 4]
+            a = _rotl(a + ((b & c) | (~b & d)) + x[k], s)
+            a, b, c, d = d, a, b, c
+        for i in range(16):
+            k = (i % 4) * 4 + i // 4
+            s = (3, 5, 9, 13)[i % 4]
+            a = _rotl(a + ((b & c) | (b & d) | (c & d)) + x[k] +
+                      0x5A827999, s)
+            a, b, c, d = d, a, b, c
+        for i in range(16):
+            k = (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15)[i]
+            s = (3, 9, 11, 15)[i % 4]
+            a = _rotl(a + (b ^ c ^ d) + x[k] + 0x6ED9EBA1, s)
+            a, b, c, d = d, a, b, c
+
+        h = [(v + n) & 0xFFFFFFFF for v, n in zip(h, (a, b, c, d))]
+
+    return struct.pack("<4I", *h)
+
+
+def _md4_libcrypto():
+    """
+    Return an MD4 function using the libcrypto low level API, which is
+    still available when the OpenSSL 3 default provider hides MD4 from
+    hashlib. Return None if it cannot be used.
+    """
+    name = ctypes.util.find_library("crypto")
+    if name is None:
+        return None
+    try:
+        libcrypto = ctypes.CDLL(name)
+        md4 = libcrypto.MD4
+    except (OSError, AttributeError):
+        return None
+    md4.restype = ctypes.c_void_p
+    md4.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p]
+
+    def _digest(data):
+        data = _to_bytes(data)
+        out = ctypes.create_string_buffer(16)
+        md4(data, len(data), out)
+        return out.raw
+
+    return _digest
+
+
+def _md4_factory():
+    try:
+        hashlib.new("md4")
+        return lambda data: hashlib.new("md4", data).digest()
+    except ValueError:
+        pass
+
+    digest = _md4_libcrypto()
+    if digest is not None:
+        data, expected = _MD4_TEST_VECTOR
+        if bytearray(digest(data)) == bytearray.fromhex(expected):
+            return digest
+    return _md4_python
+
+
+def _rsum(block):
+    """
+    zsync rolling checksum of a block: a is the sum of the bytes, b the
+    sum of the bytes weighted by their distance from the block end, both
+    truncated to 16 bits.
+    """
+    block = bytearray(block)
+    a = sum(block) & 0xFFFF
+    if hasattr(itertools, "accumulate"):
+        b = sum(itertools.accumulate(block)) & 0xFFFF
+    else:
+        b = 0
+        length = len(block)
+        for i, c in enumerate(block):
+            b += (length - i) * c
+        b &= 0xFFFF
+    return struct.pack(">HH", a, b)
+
+
+class ZsyncMaker(object):
+    """
+    Generate a zsync control file (zsync 0.6.2 format) out of a stream of
+    data. It can be fed like a hashlib object, so the control file is
+    built in the same pass computing the artifact checksums.
+    """
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.length = 0
+        self._sha1 = hashlib.sha1()
+        self._md4 = _md4_factory()
+        self._pending = bytearray()
+        # 4 bytes of rsum and 16 bytes of MD4 per block
+        self._rsums = bytearray()
+        self._checksums = bytearray()
+
+        zero_block = b"\0" * block_size
+        self._zero_block = zero_block
+        self._zero_rsum = _rsum(zero_block)
+        self._zero_checksum = self._md4(zero_block)
+        self._weights = None
+        if numpy is not None:
+            self._weights = numpy.arange(block_size, 0, -1,
+                                         dtype=numpy.uint64)
+
+    def _process_rsums(self, view):
+        blocks = len(view) // self.block_size
+        if self._weights is None:
+            for index in range(blocks):
+                start = index * self.block_size
+                block = view[start:start + self.block_size]
+                if block == self._zero_block:
+                    self._rsums += self._zero_rsum
+                else:
+                    self._rsums += _rsum(block)
+            return
+
+        array = numpy.frombuffer(view, dtype=numpy.uint8).reshape(
+            blocks, self.block_size)
+        a = array.sum(axis=1, dtype=numpy.uint64) & 0xFFFF
+        b = array.dot(self._weights) & 0xFFFF
+        self._rsums += numpy.stack([a, b], axis=1).astype(">u2").tobytes()
+
+    def _process(self, view):
+        """
+        Compute the checksums of the full blocks in view.
+        """
+        self._process_rsums(view)
+        for start in range(0, len(view), self.block_size):
+            block = view[start:start + self.block_size]
+            if block == self._zero_block:
+                self._checksums += self._zero_checksum
+            else:
+                self._checksums += self._md4(block)
+
+    def update(self, data):
+        view = memoryview(data)
+        self._sha1.update(view)
+        self.length += len(view)
+
+        if self._pending:
+            missing = self.block_size - len(self._pending)
+            self._pending += view[:missing]
+            view = view[missing:]
+            if len(self._pending) < self.block_size:
+                return
+            self._process(memoryview(bytes(self._pending)))
+            self._pending = bytearray()
+
+        full = len(view) // self.block_size * self.block_size
+        if full:
+            self._process(view[:full])
+        self._pending += view[full:]
+
+    def _hash_lengths(self):
+        """
+        Return the (sequential matches, rsum bytes, checksum bytes) tuple,
+        computed like zsyncmake does.
+        """
+        length = max(self.length, 1)
+        block_size = self.block_size
+        seq_matches = 2 if length > block_size else 1
+
+        rsum_len = int(math.ceil(
+            ((math.log(length) + math.log(block_size)) / math.log(2) - 8.6)
+            / seq_matches / 8))
+        rsum_len = min(max(rsum_len, 2), 4)
+
+        checksum_len = int(math.ceil(
+            (20 + (math.log(length) +
+                   math.log(1 + length // block_size)) / math.log(2))
+            / seq_matches / 8))
+        checksum_len2 = int(
+            (7.9 + (20 + math.log(1 + length // block_size) / math.log(2)))
+            / 8)
+        checksum_len = min(max(checksum_len, checksum_len2), 16)
+        return seq_matches, rsum_len, checksum_len
+
+    def write(self, path, filename, url=None, mtime=None):
+        """
+        Write the zsync control file. No more data can be fed afterwards.
+
+        @param path: control file path
+        @type path: string
+        @param filename: name of the file the control file refers to
+        @type filename: string
+        @keyword url: URL of the file, relative to the control file
+            location, defaults to filename
+        @type url: string
+        @keyword mtime: modification time of the file
+        @type mtime: float
+        """
+        if self._pending:
+            # the last block is padded with zeroes
+            self._pending += b"\0" * (self.block_size - len(self._pending))
+            self._process(memoryview(bytes(self._pending)))
+            self._pending = bytearray()
+
+        seq_matches, rsum_len, checksum_len = self._hash_lengths()
+        header = [
+            "zsync: %s" % (ZSYNC_VERSION,),
+            "Filename: %s" % (filename,),
+        ]
+        if mtime is not None:
+            header.append("MTime: %s" % (
+                time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+                              time.gmtime(mtime)),))
+        header.extend([
+            "Blocksize: %d" % (self.block_size,),
+            "Length: %d" % (self.length,),
+            "Hash-Lengths: %d,%d,%d" % (seq_matches, rsum_len, checksum_len),
+            "URL: %s" % (url or filename,),
+            "SHA-1: %s" % (self._sha1.hexdigest(),),
+        ])
+
+        with open(path, "wb") as f:
+            f.write(("\n".join(header) + "\n\n").encode("utf-8"))
+            blocks = len(self._rsums) // 4
+            for index in range(blocks):
+                rsum = self._rsums[index * 4:index * 4 + 4]
+                checksum = self._checksums[index * 16:index * 16 + 16]
+                f.write(bytes(rsum[4 - rsum_len:]) +
+                        bytes(checksum[:checksum_len]))
@@ -0,0 +1,841 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+import errno
+import gzip
+import hashlib
+import os
+import random
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+
+from src import artifact_utils
+from src import build_cache
+from src import chroot_cleanup
+from src import chunk_store
+from src import image_utils
+from src import loop_device
+from src import mirror_manifest
+from src import mirror_shards
+from src import rsync_progress
+from src import trash
+from src import tree_copy
+from src import zsync
+
+
+class HelpersTest(unittest.TestCase):
+
+    def setUp(self):
+        sys.stdout.write("%s called\n" % (self,))
+        sys.stdout.flush()
+        self._tmp_dir = tempfile.mkdtemp(prefix="molecule-test")
+
+    def tearDown(self):
+        """
+        tearDown is run after each test
+        """
+        shutil.rmtree(self._tmp_dir, True)
+        sys.stdout.write("%s ran\n" % (self,))
+        sys.stdout.flush()
+
+    def _random_data(self, length, seed=0):
+        rnd = random.Random(seed)
+        return bytes(bytearray(rnd.getrandbits(8) for x in range(length)))
+
+    def test_chunk_store_reassemble(self):
+        store_dir = os.path.join(self._tmp_dir, "store")
+        data = self._random_data(3 * chunk_store.CHUNK_MAX_SIZE + 12345) + \
+            b"\0" * (2 * chunk_store.CHUNK_MAX_SIZE) + \
+            self._random_data(54321, seed=1)
+
+        writer = chunk_store.ChunkStoreWriter(store_dir, "artifact.iso")
+        offset = 0
+        rnd = random.Random(2)
+        while offset < len(data):
+            size = rnd.randint(1, 700000)
+            writer.update(memoryview(data)[offset:offset + size])
+            offset += size
+        index_file = writer.finish()
+        self.assertEqual(writer.length, len(data))
+        self.assertEqual(sum(x[1] for x in writer.chunks), len(data))
+        for digest, length in writer.chunks:
+            self.assertTrue(length <= chunk_store.CHUNK_MAX_SIZE)
+
+        dest = os.path.join(self._tmp_dir, "reassembled.iso")
+        chunk_store.reassemble(store_dir, index_file, dest)
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        # the same content is stored once
+        writer = chunk_store.ChunkStoreWriter(store_dir, "copy.iso")
+        writer.update(data)
+        writer.finish()
+        self.assertEqual(writer.new_chunks, 0)
+
+    def _publish(self, store_dir, name, data, feed_sizes=None):
+        writer = chunk_store.ChunkStoreWriter(store_dir, name)
+        offset = 0
+        rnd = random.Random(3)
+        while offset < len(data):
+            size = len(data)
+            if feed_sizes is not None:
+                size = rnd.randint(*feed_sizes)
+            writer.update(memoryview(data)[offset:offset + size])
+            offset += size
+        writer.finish()
+        return writer
+
+    def test_chunk_store_shifted(self):
+        store_dir = os.path.join(self._tmp_dir, "store")
+        data = self._random_data(8 * 1024 * 1024)
+        writer = self._publish(store_dir, "day1.iso", data)
+        sizes = [x[1] for x in writer.chunks]
+        # not fixed size chunks
+        self.assertTrue(len(set(sizes)) > len(sizes) // 2)
+        self.assertTrue(min(sizes[:-1]) >= chunk_store.CHUNK_MIN_SIZE)
+
+        # boundaries don't depend on how data is fed
+        other = self._publish(store_dir, "feed.iso", data, (1, 100000))
+        self.assertEqual(other.chunks, writer.chunks)
+        self.assertEqual(other.new_chunks, 0)
+
+        # data inserted near the start shifts the rest of the artifact
+        shifted = data[:100000] + self._random_data(777, seed=4) + \
+            data[100000:]
+        other = self._publish(store_dir, "day2.iso", shifted, (1, 300000))
+        self.assertEqual(len(shifted), other.length)
+        shared = set(x[0] for x in writer.chunks) & \
+            set(x[0] for x in other.chunks)
+        self.assertTrue(len(shared) >= len(writer.chunks) - 3)
+        self.assertTrue(other.new_bytes < len(data) // 4)
+
+        dest = os.path.join(self._tmp_dir, "day2.iso")
+        chunk_store.reassemble(
+            store_dir, chunk_store.index_path(store_dir, "day2.iso"), dest)
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), shifted)
+
+    def test_chunk_store_reassemble_corrupted(self):
+        store_dir = os.path.join(self._tmp_dir, "store")
+        writer = chunk_store.ChunkStoreWriter(store_dir, "artifact.iso")
+        writer.update(self._random_data(100000))
+        index_file = writer.finish()
+        digest = writer.chunks[0][0]
+        with open(chunk_store.chunk_path(store_dir, digest), "r+b") as f:
+            f.write(b"x")
+
+        dest = os.path.join(self._tmp_dir, "reassembled.iso")
+        self.assertRaises(IOError, chunk_store.reassemble, store_dir,
+                          index_file, dest)
+        self.assertTrue(not os.path.lexists(dest))
+
+    def _write_file(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def test_zsync_control_file(self):
+        block_size = 1024
+        data = self._random_data(3 * block_size) + b"\0" * block_size + \
+            self._random_data(100, seed=1)
+        maker = zsync.ZsyncMaker(block_size=block_size)
+        maker.update(data[:1500])
+        maker.update(memoryview(data)[1500:])
+        path = os.path.join(self._tmp_dir, "artifact.iso.zsync")
+        maker.write(path, "artifact.iso", mtime=0)
+
+        with open(path, "rb") as f:
+            content = f.read()
+        header, body = content.split(b"\n\n", 1)
+        fields = dict(x.split(": ", 1) for x in
+                      header.decode("utf-8").split("\n"))
+        self.assertEqual(fields["zsync"], zsync.ZSYNC_VERSION)
+        self.assertEqual(fields["Filename"], "artifact.iso")
+        self.assertEqual(fields["URL"], "artifact.iso")
+        self.assertEqual(fields["MTime"], "Thu, 01 Jan 1970 00:00:00 +0000")
+        self.assertEqual(fields["Blocksize"], str(block_size))
+        self.assertEqual(fields["Length"], str(len(data)))
+        self.assertEqual(fields["SHA-1"], hashlib.sha1(data).hexdigest())
+        seq_matches, rsum_len, checksum_len = [
+            int(x) for x in fields["Hash-Lengths"].split(",")]
+        self.assertEqual(seq_matches, 2)
+
+        # the last block is padded with zeroes
+        padded = data + b"\0" * (-len(data) % block_size)
+        expected = b""
+        for start in range(0, len(padded), block_size):
+            block = bytearray(padded[start:start + block_size])
+            a = sum(block) & 0xFFFF
+            b = sum((block_size - i) * c for i, c in enumerate(block))
+            rsum = struct.pack(">HH", a, b & 0xFFFF)
+            checksum = zsync._md4_python(bytes(block))
+            expected += rsum[4 - rsum_len:] + checksum[:checksum_len]
+        self.assertEqual(body, expected)
+
+    def test_zsync_md4(self):
+        data, expected = zsync._MD4_TEST_VECTOR
+        self.assertEqual(zsync._md4_python(data),
+                         bytes(bytearray.fromhex(expected)))
+        data = self._random_data(1000)
+        self.assertEqual(zsync._md4_factory()(data),
+                         zsync._md4_python(data))
+
+    def test_image_mb_auto(self):
+        for value, headroom in (("auto", None), ("auto+0%", "0"),
+                                ("auto+25%", "25")):
+            match = image_utils.IMAGE_MB_AUTO_RE.match(value)
+            self.assertTrue(match is not None)
+            self.assertEqual(match.group(1), headroom)
+        for value in ("1024", "auto+", "auto+25", "auto-25%", "auto+x%",
+                      " auto", "auto+25%+"):
+            self.assertEqual(image_utils.IMAGE_MB_AUTO_RE.match(value), None)
+
+    def test_tree_usage(self):
+        root = os.path.join(self._tmp_dir, "tree")
+        self._write_file(os.path.join(root, "a", "file"), b"x" * 5000)
+        self._write_file(os.path.join(root, "empty"), b"")
+        os.link(os.path.join(root, "a", "file"), os.path.join(root, "link"))
+        os.symlink("a", os.path.join(root, "a_link"))
+        used_bytes, used_inodes = image_utils.tree_usage(root)
+        # 2 directories, 2 files (one hardlinked twice) and a symlink
+        self.assertEqual(used_inodes, 5)
+        self.assertEqual(used_bytes, 2 * 4096 + 8192)
+
+    def _write_sparse_file(self, path):
+        """
+        Write a 16MB file made of two 4KB data extents and holes, return
+        its content.
+        """
+        with open(path, "wb") as f:
+            f.write(b"x" * 4096)
+            f.seek(8 * 1024 * 1024)
+            f.write(b"y" * 4096)
+            f.truncate(16 * 1024 * 1024)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _assert_same_sparse_file(self, path, data, sparse):
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        if sparse:
+            st = os.stat(path)
+            self.assertTrue(st.st_blocks * 512 < st.st_size // 2)
+
+    def _cross_device_move(self, source, dest, hashers=None):
+        """
+        Call move_file() as if source and dest were on different
+        filesystems.
+        """
+        def _rename(source, dest):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        rename = os.rename
+        os.rename = _rename
+        try:
+            return artifact_utils.move_file(source, dest, hashers=hashers)
+        finally:
+            os.rename = rename
+
+    def test_sparse_copy(self):
+        source = os.path.join(self._tmp_dir, "image.img")
+        data = self._write_sparse_file(source)
+        st = os.stat(source)
+        sparse = st.st_blocks * 512 < st.st_size // 2
+        os.utime(source, (1000000000, 1000000000))
+
+        dest = os.path.join(self._tmp_dir, "copy.img")
+        artifact_utils.sparse_copy(source, dest)
+        self._assert_same_sparse_file(dest, data, sparse)
+        self.assertEqual(int(os.stat(dest).st_mtime), 1000000000)
+
+    def test_move_file(self):
+        source = os.path.join(self._tmp_dir, "image.img")
+        data = self._write_sparse_file(source)
+        st = os.stat(source)
+        sparse = st.st_blocks * 512 < st.st_size // 2
+
+        dest = os.path.join(self._tmp_dir, "moved.img")
+        self.assertEqual(artifact_utils.move_file(source, dest), False)
+        self.assertTrue(not os.path.lexists(source))
+        self.assertEqual(os.stat(dest).st_ino, st.st_ino)
+
+        other = os.path.join(self._tmp_dir, "other.img")
+        self.assertEqual(self._cross_device_move(dest, other), False)
+        self.assertTrue(not os.path.lexists(dest))
+        self._assert_same_sparse_file(other, data, sparse)
+
+    def test_loop_device_structs(self):
+        # sizes and offsets of linux/loop.h structs on every architecture
+        self.assertEqual(struct.calcsize(loop_device._LOOP_INFO64), 232)
+        self.assertEqual(struct.calcsize(loop_device._LOOP_CONFIG), 304)
+
+        info = loop_device._loop_info(
+            "/var/tmp/" + "x" * 100, loop_device.LO_FLAGS_READ_ONLY)
+        self.assertEqual(len(info), 232)
+        # lo_flags
+        self.assertEqual(struct.unpack("=I", info[52:56])[0],
+                         loop_device.LO_FLAGS_READ_ONLY)
+        # lo_file_name, truncated and NUL terminated
+        name = info[56:56 + loop_device.LO_NAME_SIZE]
+        self.assertEqual(name, b"/var/tmp/" + b"x" * 54 + b"\0")
+        self.assertEqual(info[56 + loop_device.LO_NAME_SIZE:], b"\0" * 112)
+
+        config = struct.pack(loop_device._LOOP_CONFIG, 7, 0, info)
+        self.assertEqual(struct.unpack("=II", config[:8]), (7, 0))
+        self.assertEqual(config[8:240], info)
+        self.assertEqual(config[240:], b"\0" * 64)
+
+    def test_compress_file(self):
+        if not os.access("/bin/gzip", os.X_OK):
+            self.skipTest("gzip not available")
+        source = os.path.join(self._tmp_dir, "image.img")
+        data = self._write_sparse_file(source)
+        dest = os.path.join(self._tmp_dir, "image.img.gz")
+        raw_hasher = hashlib.sha256()
+        hasher = hashlib.sha256()
+        rc = artifact_utils.compress_file(
+            source, dest, ["/bin/gzip", "-c"], raw_hashers=[raw_hasher],
+            hashers=[hasher])
+        self.assertEqual(rc, 0)
+        self.assertEqual(raw_hasher.hexdigest(),
+                         hashlib.sha256(data).hexdigest())
+        with open(dest, "rb") as f:
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.sha256(f.read()).hexdigest())
+        with gzip.open(dest, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_inline_checksums(self):
+        source = os.path.join(self._tmp_dir, "image.img")
+        data = self._write_sparse_file(source)
+        expected = hashlib.sha256(data).hexdigest()
+
+        hasher = hashlib.sha256()
+        artifact_utils.hash_file(source, [hasher])
+        self.assertEqual(hasher.hexdigest(), expected)
+
+        hasher = hashlib.sha256()
+        dest = os.path.join(self._tmp_dir, "copy.img")
+        artifact_utils.sparse_copy(source, dest, hashers=[hasher])
+        self.assertEqual(hasher.hexdigest(), expected)
+
+        # hashers are fed only if the file is copied
+        hasher = hashlib.sha256()
+        moved = os.path.join(self._tmp_dir, "moved.img")
+        self.assertEqual(
+            artifact_utils.move_file(dest, moved, hashers=[hasher]), False)
+        other = os.path.join(self._tmp_dir, "other.img")
+        self.assertEqual(
+            self._cross_device_move(moved, other, hashers=[hasher]), True)
+        self.assertEqual(hasher.hexdigest(), expected)
+
+        hasher = hashlib.sha256()
+        dest = os.path.join(self._tmp_dir, "cat.img")
+        rc = artifact_utils.command_to_file(["cat", source], dest,
+                                            hashers=[hasher])
+        self.assertEqual(rc, 0)
+        self.assertEqual(hasher.hexdigest(), expected)
+
+        paths = artifact_utils.write_checksum_files(
+            dest, [("sha256", expected)])
+        self.assertEqual(paths, [dest + ".sha256"])
+        with open(paths[0], "r") as f:
+            self.assertEqual(f.read(), "%s  cat.img\n" % (expected,))
+
+    def test_multi_hasher(self):
+        data = [self._random_data(100000, seed=x) for x in range(10)]
+        consumer = hashlib.sha1()
+        hasher = artifact_utils.MultiHasher(["sha256", "md5", "sha512"],
+                                            [consumer])
+        for chunk in data:
+            hasher.update(chunk)
+        data = b"".join(data)
+        self.assertEqual(hasher.hexdigests(), [
+            ("sha256", hashlib.sha256(data).hexdigest()),
+            ("md5", hashlib.md5(data).hexdigest()),
+            ("sha512", hashlib.sha512(data).hexdigest()),
+        ])
+        self.assertEqual(consumer.hexdigest(), hashlib.sha1(data).hexdigest())
+
+    def test_multi_hasher_error(self):
+
+        class Failing(object):
+            def update(self, data):
+                raise IOError("no space left")
+
+        hasher = artifact_utils.MultiHasher(["sha256"], [Failing()])
+        data = b"x" * 1024
+        # more data than the queues can hold, update() must not block
+        try:
+            for x in range(artifact_utils.MultiHasher.QUEUE_SIZE * 4):
+                hasher.update(data)
+        except IOError:
+            pass
+        self.assertRaises(IOError, hasher.hexdigests)
+
+    def test_build_cache_key(self):
+        source = os.path.join(self._tmp_dir, "chroot")
+        self._write_file(os.path.join(source, "etc", "hostname"), b"foo\n")
+        metadata = {
+            "source_chroot": source,
+            "release_version": "1",
+            "__plugin": object(),
+        }
+        cache_dir = os.path.join(self._tmp_dir, "cache")
+        key = build_cache.cache_key(metadata, cache_dir)
+        # molecule internals are not part of the key
+        metadata["__plugin"] = object()
+        self.assertEqual(build_cache.cache_key(metadata, cache_dir), key)
+
+        metadata["release_version"] = "2"
+        self.assertNotEqual(build_cache.cache_key(metadata, cache_dir), key)
+        metadata["release_version"] = "1"
+        self.assertEqual(build_cache.cache_key(metadata, cache_dir), key)
+
+        self._write_file(os.path.join(source, "etc", "hostname"), b"bar\n\n")
+        self.assertNotEqual(build_cache.cache_key(metadata, cache_dir), key)
+        key = build_cache.cache_key(metadata, cache_dir)
+
+        # hook scripts are hashed by content
+        script = os.path.join(self._tmp_dir, "hook.sh")
+        self._write_file(script, b"#!/bin/sh\necho foo\n")
+        metadata["post_iso_script"] = [script]
+        script_key = build_cache.cache_key(metadata, cache_dir)
+        self.assertNotEqual(script_key, key)
+        self._write_file(script, b"#!/bin/sh\necho bar\n")
+        self.assertNotEqual(build_cache.cache_key(metadata, cache_dir),
+                            script_key)
+
+    def test_build_cache_store_restore(self):
+        cache_dir = os.path.join(self._tmp_dir, "cache")
+        os.makedirs(cache_dir)
+        artifact = os.path.join(self._tmp_dir, "out", "artifact.iso")
+        data = self._random_data(10000)
+        self._write_file(artifact, data)
+
+        self.assertEqual(build_cache.lookup(cache_dir, "key"), None)
+        entry_dir = build_cache.store(
+            cache_dir, "key", [artifact, artifact + ".missing"])
+        self.assertEqual(build_cache.lookup(cache_dir, "key"), entry_dir)
+        self.assertEqual(os.listdir(entry_dir), ["artifact.iso"])
+
+        # the build rewrites its artifacts in place
+        with open(artifact, "r+b") as f:
+            f.write(b"x" * 100)
+        os.remove(artifact)
+
+        restored = build_cache.restore(entry_dir, [artifact])
+        self.assertEqual(restored, [artifact])
+        with open(artifact, "rb") as f:
+            self.assertEqual(f.read(), data)
+        with open(artifact, "r+b") as f:
+            f.write(b"y" * 100)
+        with open(os.path.join(entry_dir, "artifact.iso"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_mirror_manifest(self):
+        source = os.path.join(self._tmp_dir, "chroot")
+        for path in ("etc/hostname", "etc/fstab", "usr/bin/foo",
+                     "usr/share/doc/foo/README", "var/lib/db"):
+            self._write_file(os.path.join(source, path), b"data")
+        dest = os.path.join(self._tmp_dir, "mirror")
+        manifest_file = mirror_manifest.manifest_path(dest)
+        self.assertEqual(manifest_file,
+                         os.path.join(self._tmp_dir, ".mirror.manifest"))
+
+        script = os.path.join(self._tmp_dir, "hook.sh")
+        self._write_file(script, b"#!/bin/sh\n")
+        metadata = {"inner_chroot_script": [script]}
+        hooks = mirror_manifest.hooks_digest(metadata)
+        args = ["rsync", "-a", source + "/", dest + "/"]
+        mirror_manifest.save(manifest_file, args, hooks,
+                             mirror_manifest.scan_tree(source))
+        self.assertEqual(mirror_manifest.load(manifest_file, args[1:], hooks),
+                         None)
+        manifest = mirror_manifest.load(manifest_file, args, hooks)
+        self.assertNotEqual(manifest, None)
+        self.assertEqual(mirror_manifest.changed_paths(
+            manifest, mirror_manifest.scan_tree(source)), [])
+
+        # content, metadata, new, removed and replaced entries
+        self._write_file(os.path.join(source, "etc/hostname"), b"other")
+        os.chmod(os.path.join(source, "etc/fstab"), 0o600)
+        self._write_file(os.path.join(source, "usr/bin/bar"), b"data")
+        shutil.rmtree(os.path.join(source, "usr/share"))
+        shutil.rmtree(os.path.join(source, "var/lib"))
+        self._write_file(os.path.join(source, "var/lib"), b"data")
+        self.assertEqual(mirror_manifest.changed_paths(
+            manifest, mirror_manifest.scan_tree(source)), [
+                "etc/fstab", "etc/hostname", "usr", "usr/bin",
+                "usr/bin/bar", "usr/share", "var", "var/lib"])
+
+        # hooks changes force a full sync
+        self._write_file(script, b"#!/bin/sh\necho changed\n")
+        self.assertEqual(mirror_manifest.load(
+            manifest_file, args, mirror_manifest.hooks_digest(metadata)),
+            None)
+        mirror_manifest.remove(manifest_file)
+        mirror_manifest.remove(manifest_file)
+        self.assertEqual(mirror_manifest.load(manifest_file, args, hooks),
+                         None)
+
+    def test_tree_copy(self):
+        if not tree_copy.available():
+            self.skipTest("native tree copier not available")
+        source = os.path.join(self._tmp_dir, "source")
+        self._write_file(os.path.join(source, "etc", "shadow"), b"secret")
+        os.chmod(os.path.join(source, "etc", "shadow"), 0o640)
+        self._write_file(os.path.join(source, "usr", "bin", "su"), b"su")
+        os.chmod(os.path.join(source, "usr", "bin", "su"), 0o4755)
+        os.link(os.path.join(source, "usr", "bin", "su"),
+                os.path.join(source, "etc", "su"))
+        os.mkdir(os.path.join(source, "var"))
+        self._write_sparse_file(os.path.join(source, "var", "image.img"))
+        os.mkfifo(os.path.join(source, "var", "fifo"), 0o620)
+        os.symlink("../etc/shadow", os.path.join(source, "usr", "shadow"))
+        os.chmod(os.path.join(source, "var"), 0o750)
+        for root, dirs, files in os.walk(source):
+            for name in dirs + files:
+                os.utime(os.path.join(root, name), (1000000000, 1200000000),
+                         follow_symlinks=False)
+        os.utime(source, (1000000000, 1200000000))
+
+        # conflicting entries are replaced
+        dest = os.path.join(self._tmp_dir, "dest")
+        self._write_file(os.path.join(dest, "etc"), b"not a directory")
+        self._write_file(os.path.join(dest, "var", "fifo", "x"), b"")
+
+        stats = tree_copy.copy_tree(source, dest, workers=4)
+        self.assertEqual(stats["files"], 3)
+        self.assertEqual(stats["hardlinks"], 1)
+        self.assertEqual(stats["symlinks"], 1)
+        self.assertEqual(stats["specials"], 1)
+        self.assertEqual(stats["dirs"], 4)
+
+        for root, dirs, files in os.walk(source):
+            for name in [""] + dirs + files:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, source)
+                st = os.lstat(path)
+                dest_st = os.lstat(os.path.join(dest, rel))
+                self.assertEqual(dest_st.st_mode, st.st_mode, rel)
+                self.assertEqual(dest_st.st_mtime_ns, st.st_mtime_ns, rel)
+                self.assertEqual(dest_st.st_nlink, st.st_nlink, rel)
+                if stat.S_ISREG(st.st_mode):
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    self._assert_same_sparse_file(
+                        os.path.join(dest, rel), data,
+                        st.st_blocks * 512 < st.st_size // 2)
+
+        self.assertTrue(stat.S_ISFIFO(
+            os.lstat(os.path.join(dest, "var", "fifo")).st_mode))
+        self.assertEqual(os.readlink(os.path.join(dest, "usr", "shadow")),
+                         "../etc/shadow")
+        self.assertEqual(os.stat(os.path.join(dest, "etc", "su")).st_ino,
+                         os.stat(os.path.join(dest, "usr", "bin",
+                                              "su")).st_ino)
+
+    def test_mirror_shards_balance(self):
+        sizes = {"usr": 100, "var": 60, "opt": 50, "etc": 10}
+        self.assertEqual(mirror_shards.balance(sorted(sizes), sizes, 2),
+                         [["usr", "etc"], ["var", "opt"]])
+        self.assertEqual(mirror_shards.balance(["usr", "etc"], sizes, 4),
+                         [["usr"], ["etc"]])
+        self.assertEqual(mirror_shards.balance([], sizes, 4), [])
+        # unknown directories weigh as much as the average
+        self.assertEqual(
+            mirror_shards.balance(["usr", "etc", "new"], sizes, 2),
+            [["usr"], ["new", "etc"]])
+
+    def test_mirror_shards_links(self):
+        source = os.path.join(self._tmp_dir, "chroot")
+        for path in ("usr/bin/a", "usr/lib/b", "opt/c", "top"):
+            self._write_file(os.path.join(source, path), b"x" * 10)
+        # same shard, different shards, top level entry
+        os.link(os.path.join(source, "usr/bin/a"),
+                os.path.join(source, "usr/lib/a"))
+        os.link(os.path.join(source, "usr/lib/b"),
+                os.path.join(source, "opt/b"))
+        os.link(os.path.join(source, "top"),
+                os.path.join(source, "usr/top"))
+        os.mkdir(os.path.join(source, "empty"))
+
+        names = mirror_shards.top_level_dirs(source)
+        self.assertEqual(names, ["empty", "opt", "usr"])
+        scanner = mirror_shards.TreeScanner(source, names)
+        scanner.start()
+        scanner.join()
+        self.assertEqual(scanner.error, None)
+        self.assertEqual(scanner.sizes["empty"], 0)
+        self.assertEqual(scanner.sizes["opt"], 20)
+        self.assertTrue(scanner.sizes["usr"] >= 40)
+
+        shards = [["usr"], ["opt", "empty"]]
+        self.assertEqual(scanner.cross_shard_links(shards),
+                         ["opt/b", "top", "usr/lib/b", "usr/top"])
+        self.assertEqual(scanner.cross_shard_links([["usr", "opt"]]),
+                         ["top", "usr/top"])
+
+        sizes_file = mirror_shards.shards_path(source)
+        mirror_shards.save_sizes(sizes_file, scanner.sizes)
+        self.assertEqual(mirror_shards.load_sizes(sizes_file),
+                         scanner.sizes)
+
+    def test_progress_meter(self):
+        clock = [100.0]
+        meter = rsync_progress.ProgressMeter(clock=lambda: clock[0])
+        others = meter.feed(b"sending incremental file list\n"
+                            b"     32,768   0%    0.00kB/s    0:00:00 "
+                            b"(xfr#1, ir-chk=1000/1010)\r  1,048,5")
+        self.assertEqual(others, ["sending incremental file list"])
+        self.assertEqual(meter.bytes, 32768)
+        self.assertEqual(meter.files, 1)
+        self.assertEqual(meter.checked, 10)
+        self.assertEqual(meter.total, None)
+        self.assertEqual(meter.eta, None)
+
+        self.assertEqual(meter.feed(b"76  50%    1.00MB/s    0:01:07 "
+                                    b"(xfr#5, to-chk=100/200)\r"), [])
+        self.assertEqual(meter.bytes, 1048576)
+        self.assertEqual(meter.percent, 50)
+        self.assertEqual(meter.checked, 100)
+        self.assertEqual(meter.total, 200)
+        self.assertEqual(meter.eta, 67)
+
+        meter.feed(b"rsync: some warning\n"
+                   b"  2097152 100%    1.00MB/s    0:00:02 "
+                   b"(xfr#10, to-chk=0/200)")
+        self.assertEqual(meter.close(), [])
+        self.assertEqual(meter.percent, 100)
+        self.assertEqual(meter.eta, 0)
+
+        clock[0] = 102.0
+        stats = meter.stats()
+        self.assertEqual(sorted(stats), sorted(rsync_progress.STATS_KEYS))
+        self.assertEqual(stats["bytes"], 2097152)
+        self.assertEqual(stats["files"], 10)
+        self.assertEqual(stats["checked"], 200)
+        self.assertEqual(stats["elapsed"], 2.0)
+        self.assertEqual(stats["bytes_per_sec"], 1048576)
+        self.assertEqual(stats["files_per_sec"], 5.0)
+
+    def test_progress_run(self):
+        # silent for a while, like rsync on a large file
+        script = "sleep 0.5; printf '  2097152 100%%    1.00MB/s    0:00:02 " \
+            "(xfr#10, to-chk=0/200)\\ndone\\n'; exit 3"
+        meter = rsync_progress.ProgressMeter()
+        progress = []
+        output = []
+        rc = rsync_progress.run(
+            ["/bin/sh", "-c", script], meter,
+            lambda x: progress.append(x.bytes), output.append, interval=0.1)
+        self.assertEqual(rc, 3)
+        self.assertEqual(output, ["done"])
+        self.assertEqual(meter.bytes, 2097152)
+        self.assertTrue(progress.count(0) >= 3)
+
+    def _cleanup_tree(self):
+        root = os.path.join(self._tmp_dir, "chroot")
+        self._write_file(os.path.join(root, "var/cache/pkgs/a.tbz2"),
+                         b"x" * 1000)
+        self._write_file(os.path.join(root, "var/cache/pkgs/b.tbz2"),
+                         b"x" * 24)
+        self._write_file(os.path.join(root, "var/cache/ld.so.cache"),
+                         b"x" * 100)
+        self._write_file(os.path.join(root, "var/tmp/portage/log"), b"x")
+        self._write_file(os.path.join(root, "tmp/.X0-lock"), b"x" * 10)
+        self._write_file(os.path.join(root, "etc/hostname"), b"x" * 5)
+        os.symlink("/etc", os.path.join(root, "outside"))
+        return root
+
+    def test_chroot_cleanup(self):
+        root = self._cleanup_tree()
+        emptied, removed = chroot_cleanup.cleanup(
+            root, ["/tmp"], ["/var/cache/*", "/var/cache/pkgs/a.tbz2",
+                             "/var/tmp", "/not/there"],
+            workers=2, defer=False)
+        self.assertEqual(emptied, [("/tmp", {
+            "files": 1, "dirs": 0, "bytes": 10, "trashed": 0})])
+        self.assertEqual(removed, [
+            # a.tbz2 is removed along with its parent
+            ("/var/cache/*", {
+                "files": 3, "dirs": 1, "bytes": 1124, "trashed": 0}),
+            ("/var/cache/pkgs/a.tbz2", {
+                "files": 0, "dirs": 0, "bytes": 0, "trashed": 0}),
+            ("/var/tmp", {"files": 1, "dirs": 2, "bytes": 1, "trashed": 0}),
+            ("/not/there", {
+                "files": 0, "dirs": 0, "bytes": 0, "trashed": 0}),
+        ])
+        found = []
+        for directory, dirs, files in os.walk(root):
+            for name in dirs + files:
+                found.append(os.path.relpath(os.path.join(directory, name),
+                                             root))
+        self.assertEqual(sorted(found), ["etc", "etc/hostname", "outside",
+                                         "tmp", "var", "var/cache"])
+
+    def test_chroot_cleanup_outside(self):
+        root = self._cleanup_tree()
+        self.assertRaises(OSError, chroot_cleanup.cleanup, root, [],
+                          ["/outside/hostname"], defer=False)
+        self.assertRaises(OSError, chroot_cleanup.cleanup, root,
+                          ["/outside"], [], defer=False)
+        self.assertRaises(ValueError, chroot_cleanup.cleanup, root, [],
+                          ["/"], defer=False)
+        self.assertTrue(os.path.isdir(os.path.join(root, "var/tmp")))
+
+    def test_pattern_set(self):
+        root = os.path.join(self._tmp_dir, "root")
+        for path in ("usr/portage/distfiles/foo.tar.gz",
+                     "usr/portage/distfiles/.keep",
+                     "var/log/emerge.log", "var/log/.hidden.log",
+                     "var/tmp/a*b/file", "var/tmp/axb/file"):
+            self._write_file(os.path.join(root, path), b"")
+
+        patterns = ["/usr/portage/distfiles/*", "/var/log/*.log",
+                    "/var/log/.*", "var/log/emerge.log", "/not/there/*",
+                    chroot_cleanup._escape("/var/tmp/a*b")]
+        matches = chroot_cleanup.PatternSet(patterns).match(root)
+        self.assertEqual(matches, {
+            os.path.join(root, "usr/portage/distfiles/foo.tar.gz"): 0,
+            os.path.join(root, "var/log/emerge.log"): 1,
+            os.path.join(root, "var/log/.hidden.log"): 2,
+            os.path.join(root, "var/tmp/a*b"): 5,
+        })
+        self.assertRaises(ValueError, chroot_cleanup.PatternSet, ["/"])
+
+    def _with_trash(self, function, *args, **kwargs):
+        """
+        Call function with the temporary directory as the only file
+        system, and trash.reap_later() recording the trash directories
+        instead of spawning a reaper. Return its result and the list of
+        the recorded directories.
+        """
+        reaped = []
+        saved = (trash.mount_point, trash.mount_points, trash.reap_later)
+        trash.mount_point = lambda path: self._tmp_dir
+        trash.mount_points = lambda: set([self._tmp_dir])
+        trash.reap_later = reaped.extend
+        try:
+            return function(*args, **kwargs), reaped
+        finally:
+            trash.mount_point, trash.mount_points, trash.reap_later = saved
+
+    def test_trash(self):
+        path = os.path.join(self._tmp_dir, "doomed")
+        self._write_file(os.path.join(path, "sub/file"), b"x")
+        directory = os.path.join(self._tmp_dir, trash.TRASH_NAME)
+
+        self.assertEqual(self._with_trash(trash.move, path)[0], directory)
+        self.assertFalse(os.path.lexists(path))
+        self.assertEqual(stat.S_IMODE(os.lstat(directory).st_mode), 0o700)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        # never inside the tree being packed
+        self._write_file(os.path.join(path, "file"), b"x")
+        self.assertEqual(self._with_trash(
+            trash.move, path, outside=self._tmp_dir)[0], None)
+
+        # leftovers of interrupted runs are reaped once per process
+        trash._resumed = False
+        try:
+            self.assertEqual(self._with_trash(trash.resume)[1],
+                             [directory])
+            self.assertEqual(self._with_trash(trash.resume)[1], [])
+        finally:
+            trash._resumed = False
+
+        trash.reap(directory)
+        self.assertEqual(os.listdir(directory), [".lock"])
+        self.assertEqual(self._with_trash(trash.leftover)[0], [])
+        self.assertEqual(self._with_trash(trash.remove_later, path)[1],
+                         [directory])
+        self.assertFalse(os.path.lexists(path))
+
+    def test_trash_unsafe(self):
+        path = os.path.join(self._tmp_dir, "doomed")
+        directory = os.path.join(self._tmp_dir, trash.TRASH_NAME)
+        elsewhere = os.path.join(self._tmp_dir, "elsewhere")
+        os.mkdir(elsewhere, 0o700)
+        os.symlink(elsewhere, directory)
+        self._write_file(os.path.join(path, "file"), b"x")
+        self.assertEqual(self._with_trash(trash.move, path)[0], None)
+        self.assertRaises(OSError, trash.reap, directory)
+
+        # removed in place instead
+        self.assertEqual(self._with_trash(trash.remove_later, path)[1], [])
+        self.assertFalse(os.path.lexists(path))
+        self.assertEqual(os.listdir(elsewhere), [])
+
+        os.remove(directory)
+        os.mkdir(directory, 0o700)
+        os.chmod(directory, 0o777)
+        self._write_file(os.path.join(path, "file"), b"x")
+        self.assertEqual(self._with_trash(trash.move, path)[0], None)
+        self.assertTrue(os.path.isdir(path))
+        self.assertRaises(OSError, trash.reap, directory)
+
+        # the lock file is never followed
+        os.chmod(directory, 0o700)
+        os.symlink(os.path.join(elsewhere, "lock"),
+                   os.path.join(directory, ".lock"))
+        self.assertRaises(OSError, trash.reap, directory)
+        self.assertEqual(os.listdir(elsewhere), [])
+
+    def test_chroot_cleanup_defer(self):
+        root = self._cleanup_tree()
+        (emptied, removed), reaped = self._with_trash(
+            chroot_cleanup.cleanup, root, ["/tmp"],
+            ["/var/cache/*", "/var/tmp"], workers=2)
+        directory = os.path.join(self._tmp_dir, trash.TRASH_NAME)
+        self.assertEqual(reaped, [directory])
+        # trashed directories are counted, not sized
+        self.assertEqual(emptied, [("/tmp", {
+            "files": 1, "dirs": 0, "bytes": 10, "trashed": 0})])
+        self.assertEqual(removed, [
+            ("/var/cache/*", {
+                "files": 1, "dirs": 0, "bytes": 100, "trashed": 1}),
+            ("/var/tmp", {"files": 0, "dirs": 0, "bytes": 0, "trashed": 1}),
+        ])
+        self.assertEqual(sorted(os.listdir(os.path.join(root, "var"))),
+                         ["cache"])
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_chroot_cleanup_report(self):
+        root = self._cleanup_tree()
+        result = chroot_cleanup.report(
+            root, ["/tmp"], ["/var/cache/*", "/var/tmp", "/not/there"],
+            top=2, workers=2)
+        self.assertEqual(result["patterns"], [
+            {"pattern": "/tmp", "type": "empty",
+             "files": 1, "dirs": 0, "bytes": 10},
+            {"pattern": "/var/cache/*", "type": "remove",
+             "files": 3, "dirs": 1, "bytes": 1124},
+            {"pattern": "/var/tmp", "type": "remove",
+             "files": 1, "dirs": 2, "bytes": 1},
+            {"pattern": "/not/there", "type": "remove",
+             "files": 0, "dirs": 0, "bytes": 0},
+        ])
+        # etc/hostname and the outside symlink, in var, var/cache, tmp
+        # and etc
+        self.assertEqual(result["remaining"],
+                         {"files": 2, "dirs": 4, "bytes": 5})
+        self.assertEqual(result["top_dirs"], [
+            {"path": "/etc", "files": 1, "bytes": 5},
+            {"path": "/tmp", "files": 0, "bytes": 0},
+        ])
+        # nothing is removed
+        self.assertTrue(os.path.isfile(
+            os.path.join(root, "var/cache/pkgs/a.tbz2")))
+        self.assertTrue(os.path.isfile(os.path.join(root, "tmp/.X0-lock")))
+
+
+if __name__ == '__main__':
+    unittest.main()
+    raise SystemExit(0)
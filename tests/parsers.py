@@ -34,6 +34,16 @@ class ParsersTest(unittest.TestCase):
 
         expected_data = {
             'execution_strategy': "iso_remaster",
+            'generate_zsync': 'yes',
+            'checksum_algorithms': ['md5', 'sha256', 'blake2b'],
+            'build_cache_directory': 'specs/out',
+            'chunk_store_directory': 'specs/out',
+            'tree_copy_workers': 8,
+            'cleanup_report': 'specs/out/cleanup-report.json',
+            'cleanup_report_top_dirs': 10,
+            'cleanup_dry_run': 'no',
+            'chroot_cgroup': 'molecule',
+            'chroot_pid_namespace': 'yes',
             'paths_to_remove': ['/this/and/that', '/that/and/this'],
             'post_iso_script': ['specs/data/post_iso_script.sh'],
             'iso_title': 'Sabayon KDE',
@@ -77,6 +87,16 @@ class ParsersTest(unittest.TestCase):
 
         expected_data = {
             'execution_strategy': "livecd",
+            'generate_zsync': 'yes',
+            'checksum_algorithms': ['md5', 'sha256', 'blake2b'],
+            'build_cache_directory': 'specs/out',
+            'chunk_store_directory': 'specs/out',
+            'tree_copy_workers': 8,
+            'cleanup_report': 'specs/out/cleanup-report.json',
+            'cleanup_report_top_dirs': 10,
+            'cleanup_dry_run': 'no',
+            'chroot_cgroup': 'molecule',
+            'chroot_pid_namespace': 'yes',
             'destination_iso_image_name': 'Sabayon_Linux_5.3_x86_chroot_TEST.iso',
             'post_iso_script': ['specs/data/post_iso_script.sh'],
             'extra_mkisofs_parameters': ['-b', 'isolinux/isolinux.bin', '-c',
@@ -130,6 +150,9 @@ class ParsersTest(unittest.TestCase):
             'release_desc': 'x86 SpinBase',
             'inner_chroot_script': ['specs/data/inner_chroot_script.sh',
                                     'spinbase'],
+            'incremental_mirror': 'yes',
+            'mirror_backend': 'rsync',
+            'mirror_rsync_workers': 4,
             'extra_rsync_parameters': [
                 '--one-file-system', '--exclude',
                 '/proc/*', '--exclude', '/dev/pts/*'
@@ -160,6 +183,15 @@ class ParsersTest(unittest.TestCase):
 
         expected_data = {
             'execution_strategy': "iso_to_tar",
+            'checksum_algorithms': ['md5', 'sha256', 'blake2b'],
+            'build_cache_directory': 'specs/out',
+            'chunk_store_directory': 'specs/out',
+            'tree_copy_workers': 8,
+            'cleanup_report': 'specs/out/cleanup-report.json',
+            'cleanup_report_top_dirs': 10,
+            'cleanup_dry_run': 'no',
+            'chroot_cgroup': 'molecule',
+            'chroot_pid_namespace': 'yes',
             'iso_mounter': ['mount', '-t', 'iso9660', '-o', 'loop,ro'],
             'custom_packages_add_cmd': 'equo install --debug',
             'post_tar_script': ['specs/data/post_tar_script.sh'],
@@ -202,6 +234,16 @@ class ParsersTest(unittest.TestCase):
 
         expected_data = {
             'execution_strategy': "iso_to_image",
+            'generate_zsync': 'yes',
+            'checksum_algorithms': ['md5', 'sha256', 'blake2b'],
+            'build_cache_directory': 'specs/out',
+            'chunk_store_directory': 'specs/out',
+            'tree_copy_workers': 8,
+            'cleanup_report': 'specs/out/cleanup-report.json',
+            'cleanup_report_top_dirs': 10,
+            'cleanup_dry_run': 'no',
+            'chroot_cgroup': 'molecule',
+            'chroot_pid_namespace': 'yes',
             'destination_image_directory': '/',
             'outer_chroot_script_after': [
                 'specs/data/outer_chroot_script_after.sh'],
@@ -214,6 +256,13 @@ class ParsersTest(unittest.TestCase):
             'source_iso': 'specs/data/Sabayon_Linux_SpinBase_DAILY_x86.iso',
             'image_mb': 5000,
             'image_randomize': 'yes',
+            'image_allocation': 'random',
+            'image_compaction': 'shrink',
+            'image_compaction_headroom': 20,
+            'image_loop_direct_io': 'yes',
+            'image_population': 'mount',
+            'image_output_compression': 'zstd',
+            'image_output_compression_threads': 4,
             'image_formatter': ['mkfs.ext2'],
             'packages_to_remove': ['app-remove/this', 'app-remove/that'],
             'inner_chroot_script': ['specs/data/inner_chroot_script.sh'],